@@ -2069,9 +2069,6 @@ def run_speculative_cpu(repo_id,
                     batch_size):
     from ipex_llm.transformers import AutoModel, AutoModelForCausalLM
     from transformers import AutoTokenizer, LlamaTokenizer
-    from ipex_llm.transformers.convert import get_enable_ipex
-
-    _enable_ipex = get_enable_ipex()
 
     model_path = get_model_path(repo_id, local_model_hub)
 
@@ -2090,6 +2087,8 @@ def run_speculative_cpu(repo_id,
         tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token
+    # decoder-only models need left padding for batched generation
+    tokenizer.padding_side = "left"
 
     end = time.perf_counter()
     load_time = end - st
@@ -2108,20 +2107,16 @@ def run_speculative_cpu(repo_id,
             input_ids = input_ids[:, :in_len]
             true_str = tokenizer.batch_decode(input_ids)[0]
             input_list = [true_str] * batch_size
-            inputs = tokenizer(input_list, return_tensors="pt")
+            inputs = tokenizer(input_list, return_tensors="pt", padding=True)
             input_ids = inputs.input_ids
             attention_mask = inputs.attention_mask
             actual_in_len = input_ids.shape[1]
             result[in_out] = []
             for i in range(num_trials + warm_up):
                 st = time.perf_counter()
-                if _enable_ipex:
-                    output_ids = model.generate(input_ids, do_sample=False,
-                                                max_new_tokens=out_len, min_new_tokens=out_len,
-                                                num_beams=num_beams, attention_mask=attention_mask)
-                else:
-                    output_ids = model.generate(input_ids, do_sample=False,max_new_tokens=out_len,
-                                                min_new_tokens=out_len, num_beams=num_beams)
+                output_ids = model.generate(input_ids, do_sample=False,
+                                            max_new_tokens=out_len, min_new_tokens=out_len,
+                                            num_beams=num_beams, attention_mask=attention_mask)
                 end = time.perf_counter()
                 print("model generate cost: " + str(end - st))
                 output = tokenizer.batch_decode(output_ids)
@@ -2130,6 +2125,10 @@ def run_speculative_cpu(repo_id,
                 if i >= warm_up:
                     e2e_time = end - st
                     rest_cost_mean = (e2e_time - model.first_token_time)/(model.n_token_generated - 1)
+                    # every row of the batch generates a token in each of the rest steps
+                    print(f"batch size {batch_size}: {batch_size / rest_cost_mean:.2f} tokens/s, "
+                          f"average accepted tokens per step "
+                          f"{np.mean(model.accept_num) if model.accept_num else 0:.2f}")
                     result[in_out].append([model.first_token_time, rest_cost_mean, 0,
                                           actual_in_len, actual_out_len, load_time])
     return result
@@ -0,0 +1,84 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Compare the per-token cost of streaming a long output by decoding the whole output
+# for every token with the incremental detokenizer used by the ipex-llm streamers.
+
+import argparse
+import time
+
+from transformers import AutoTokenizer
+from ipex_llm.transformers.streamer import IncrementalDetokenizer
+
+DEFAULT_TEXT = ("IPEX-LLM is a library for running large language models on Intel CPU, GPU "
+                "and NPU with very low latency. 它支持多种低比特量化格式，"
+                "例如 INT4、FP8 和 FP6。\n")
+
+
+def full_decode(tokenizer, token_ids):
+    # decode the whole output for every new token, as the streamers used to do
+    text = ""
+    times = []
+    for i in range(len(token_ids)):
+        start = time.perf_counter()
+        text = tokenizer.decode(token_ids[:i + 1])
+        times.append(time.perf_counter() - start)
+    return text, times
+
+
+def incremental_decode(tokenizer, token_ids):
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    texts = []
+    times = []
+    for token_id in token_ids:
+        start = time.perf_counter()
+        texts.append(detokenizer.put([token_id]))
+        times.append(time.perf_counter() - start)
+    texts.append(detokenizer.flush())
+    return "".join(texts), times
+
+
+def report(name, times, window):
+    first = sum(times[:window]) / window
+    last = sum(times[-window:]) / window
+    print(f"{name}: first {window} tokens {first * 1e6:.1f} us/token, "
+          f"last {window} tokens {last * 1e6:.1f} us/token, total {sum(times):.2f} s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the detokenization of "
+                                                 "streaming outputs")
+    parser.add_argument("--repo-id-or-model-path", type=str,
+                        default="meta-llama/Llama-2-7b-chat-hf",
+                        help="The huggingface repo id or local path of the tokenizer")
+    parser.add_argument("--num-tokens", type=int, default=8192)
+    parser.add_argument("--window", type=int, default=1024,
+                        help="Number of tokens the per-token cost is averaged over")
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.repo_id_or_model_path,
+                                              trust_remote_code=True)
+    token_ids = []
+    while len(token_ids) < args.num_tokens:
+        token_ids.extend(tokenizer.encode(DEFAULT_TEXT, add_special_tokens=False))
+    token_ids = token_ids[:args.num_tokens]
+
+    full_text, full_times = full_decode(tokenizer, token_ids)
+    incremental_text, incremental_times = incremental_decode(tokenizer, token_ids)
+    report("full decode", full_times, args.window)
+    report("incremental decode", incremental_times, args.window)
+    if incremental_text != full_text:
+        print("Warning: the incremental decode differs from the full decode")
@@ -0,0 +1,66 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Measure the cold import time of a module in fresh interpreters, and optionally list
+# the slowest modules imported with it (from `python -X importtime`).
+
+import argparse
+import statistics
+import subprocess
+import sys
+
+
+def time_import(module):
+    code = ("import time; start = time.perf_counter(); "
+            f"import {module}; print(time.perf_counter() - start)")
+    output = subprocess.run([sys.executable, "-c", code], check=True,
+                            capture_output=True, text=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def slowest_imports(module, top):
+    # each line is `import time: self [us] | cumulative | imported package`
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            check=True, capture_output=True, text=True).stderr
+    records = []
+    for line in stderr.splitlines():
+        fields = line[len("import time:"):].split("|")
+        if not line.startswith("import time:") or not fields[0].strip().isdigit():
+            continue
+        records.append((int(fields[1]), int(fields[0]), fields[2].rstrip()))
+    return sorted(records, reverse=True)[:top]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the import time of ipex_llm")
+    parser.add_argument("--module", type=str, default="ipex_llm",
+                        help="Module to import, e.g. ipex_llm.transformers")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--top", type=int, default=0,
+                        help="Also list the N imports with the largest cumulative time")
+    args = parser.parse_args()
+
+    # the first run warms up the page cache and the bytecode cache
+    time_import(args.module)
+    times = [time_import(args.module) for _ in range(args.repeat)]
+    print(f"import {args.module}: median {statistics.median(times) * 1000:.1f} ms, "
+          f"min {min(times) * 1000:.1f} ms, max {max(times) * 1000:.1f} ms "
+          f"over {args.repeat} runs")
+
+    if args.top > 0:
+        print(f"{'cumulative (ms)':>16} {'self (ms)':>10}  module")
+        for cumulative, self_time, name in slowest_imports(args.module, args.top):
+            print(f"{cumulative / 1000:>16.1f} {self_time / 1000:>10.1f}  {name}")
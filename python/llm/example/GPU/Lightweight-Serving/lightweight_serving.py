@@ -22,7 +22,7 @@ import uvicorn
 import asyncio
 import argparse
 from ipex_llm.serving.fastapi import FastApp
-from ipex_llm.serving.fastapi import ModelWorker
+from ipex_llm.serving.fastapi import ModelWorker, BatchModelWorker
 logger = logging.get_logger(__name__)
 
 async def main():
@@ -34,14 +34,32 @@ async def main():
                         help='The quantization type the model will convert to.')
     parser.add_argument('--port', type=int, default=8000,
                         help='The port number on which the server will run.')
+    parser.add_argument('--prefix-cache-bytes', type=int, default=None,
+                        help='The memory budget in bytes of the prefix KV cache, 0 to disable it. '
+                             'It can not be used together with continuous batching.')
+    parser.add_argument('--max-num-seqs', type=int, default=1,
+                        help='The maximum number of sequences decoded together, '
+                             'values larger than 1 enable continuous batching, '
+                             'which does not support the prefix KV cache.')
+    parser.add_argument('--max-num-batched-tokens', type=int, default=4096,
+                        help='The maximum number of tokens processed in one step '
+                             'when continuous batching is enabled.')
     
     args = parser.parse_args()
+    if args.max_num_seqs > 1 and args.prefix_cache_bytes:
+        parser.error('--prefix-cache-bytes can not be used together with --max-num-seqs > 1')
     model_path = args.repo_id_or_model_path
     low_bit = args.low_bit
 
     processor = None
     if "whisper" not in model_path.lower():
-        local_model = ModelWorker(model_path, low_bit)
+        if args.max_num_seqs > 1:
+            local_model = BatchModelWorker(model_path, low_bit,
+                                           max_num_seqs=args.max_num_seqs,
+                                           max_num_batched_tokens=args.max_num_batched_tokens)
+        else:
+            local_model = ModelWorker(model_path, low_bit,
+                                      prefix_cache_bytes=args.prefix_cache_bytes)
         # Load tokenizer
         tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True, padding_side='left')
         if tokenizer.pad_token is None:
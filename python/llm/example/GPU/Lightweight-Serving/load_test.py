@@ -0,0 +1,114 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Open many concurrent streaming (SSE) requests against the lightweight serving
+# and report the distribution of time to first token and inter-token latency.
+
+import argparse
+import asyncio
+import json
+import time
+
+import aiohttp
+import numpy as np
+
+
+async def stream_request(session, url, payload):
+    start_time = time.perf_counter()
+    first_token_time = None
+    last_token_time = None
+    inter_token_times = []
+    async with session.post(url, json=payload) as response:
+        response.raise_for_status()
+        async for line in response.content:
+            line = line.decode("utf-8").strip()
+            if not line.startswith("data: "):
+                continue
+            try:
+                choice = json.loads(line[len("data: "):])["choices"][0]
+            except (json.JSONDecodeError, KeyError, IndexError):
+                continue
+            if choice.get("finish_reason") is not None:
+                continue
+            token_time = time.perf_counter()
+            if first_token_time is None:
+                first_token_time = token_time - start_time
+            else:
+                inter_token_times.append(token_time - last_token_time)
+            last_token_time = token_time
+    return first_token_time, inter_token_times, time.perf_counter() - start_time
+
+
+def print_percentiles(name, values):
+    if len(values) == 0:
+        print(f"{name}: no samples")
+        return
+    values = np.array(values) * 1000
+    print(f"{name}: mean {values.mean():.2f} ms, p50 {np.percentile(values, 50):.2f} ms, "
+          f"p90 {np.percentile(values, 90):.2f} ms, p99 {np.percentile(values, 99):.2f} ms")
+
+
+async def run(args):
+    payload = {
+        "model": args.model,
+        "prompt": args.prompt,
+        "max_tokens": args.max_tokens,
+        "stream": True,
+    }
+    url = f"http://{args.host}:{args.port}/v1/completions"
+    semaphore = asyncio.Semaphore(args.concurrency)
+    timeout = aiohttp.ClientTimeout(total=None)
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        async def limited_request():
+            async with semaphore:
+                return await stream_request(session, url, payload)
+
+        start_time = time.perf_counter()
+        results = await asyncio.gather(*[limited_request() for _ in range(args.num_requests)],
+                                       return_exceptions=True)
+        total_time = time.perf_counter() - start_time
+
+    failed = [r for r in results if isinstance(r, BaseException)]
+    results = [r for r in results if not isinstance(r, BaseException)]
+    first_token_times = [r[0] for r in results if r[0] is not None]
+    inter_token_times = [t for r in results for t in r[1]]
+    num_tokens = sum(len(r[1]) + 1 for r in results if r[0] is not None)
+
+    print(f"{len(results)} requests succeeded, {len(failed)} failed, "
+          f"concurrency {args.concurrency}, total time {total_time:.2f} s")
+    if failed:
+        print(f"First failure: {failed[0]!r}")
+    print(f"Token throughput: {num_tokens / total_time:.2f} tokens/s")
+    print_percentiles("Time to first token", first_token_times)
+    print_percentiles("Inter-token latency", inter_token_times)
+    print_percentiles("Request latency", [r[2] for r in results])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the streaming api of "
+                                                 "the lightweight serving")
+    parser.add_argument("--host", type=str, default="localhost")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--model", type=str, default="default_model")
+    parser.add_argument("--prompt", type=str, default="What is AI?")
+    parser.add_argument("--max-tokens", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=256,
+                        help="Number of requests streaming at the same time")
+    parser.add_argument("--num-requests", type=int, default=1024)
+    args = parser.parse_args()
+    asyncio.run(run(args))
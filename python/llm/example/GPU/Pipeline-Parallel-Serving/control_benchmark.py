@@ -0,0 +1,81 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Measure the per-step cost of sending the batch control state of pipeline parallel
+# serving to the other stages, as a pickled `BatchTask` and as a control tensor.
+# e.g. `IPEX_LLM_PP_BACKEND=gloo torchrun --standalone --nproc-per-node 2 control_benchmark.py`
+
+import argparse
+import time
+
+import torch
+import torch.distributed as dist
+from ipex_llm.transformers import init_pipeline_parallel
+from ipex_llm.transformers.pipeline_parallel import BatchTask, _pp_device, \
+    encode_batch_control, decode_batch_control, batch_control_length
+
+
+def run(name, step, num_steps):
+    for _ in range(10):
+        step()
+    dist.barrier()
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        step()
+    cost = (time.perf_counter() - start) / num_steps
+    if dist.get_rank() == 0:
+        print(f"{name}: {cost * 1e6:.1f} us per step")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the control overhead of "
+                                                 "pipeline parallel serving")
+    parser.add_argument("--max-num-seqs", type=int, default=8)
+    parser.add_argument("--num-steps", type=int, default=1000)
+    args = parser.parse_args()
+
+    init_pipeline_parallel()
+    rank = dist.get_rank()
+    device = _pp_device(rank)
+    batch = BatchTask(
+        batch_id="batch_0",
+        batch_index=0,
+        request_ids=[f"request_{i}" for i in range(args.max_num_seqs)],
+        max_tokens=128,
+        batch_size=args.max_num_seqs,
+        input_len=1,
+        prompt_lengths=[1024] * args.max_num_seqs,
+        stopped=False,
+        prefilled_index=0,
+        partial_prefilling=0,
+    )
+    control_buff = torch.empty((batch_control_length(args.max_num_seqs),),
+                               dtype=torch.int64, device=device)
+
+    def object_step():
+        batch_list = [batch if rank == 0 else None]
+        dist.broadcast_object_list(batch_list, src=0)
+
+    def tensor_step():
+        if rank == 0:
+            dist.broadcast(encode_batch_control(batch, args.max_num_seqs, device), src=0)
+        else:
+            dist.broadcast(control_buff, src=0)
+            decode_batch_control(control_buff, args.max_num_seqs)
+
+    run("broadcast_object_list", object_step, args.num_steps)
+    run("control tensor", tensor_step, args.num_steps)
+    dist.destroy_process_group()
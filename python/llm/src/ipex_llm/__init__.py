@@ -19,13 +19,32 @@
 # Otherwise there would be module not found error in non-pip's setting as Python would
 # only search the first bigdl package and end up finding only one sub-package.
 
-from .convert_model import llm_convert
-from .optimize import optimize_model
+import importlib
 import os
-from .llm_patching import llm_patch, llm_unpatch
 import sys
 import types
 
+# Imported on first access (PEP 562), so `import ipex_llm` does not import torch and
+# transformers, while `ipex_llm.optimize_model` is still the function itself
+_LAZY_ATTRS = {
+    'llm_convert': 'ipex_llm.convert_model',
+    'optimize_model': 'ipex_llm.optimize',
+    'llm_patch': 'ipex_llm.llm_patching',
+    'llm_unpatch': 'ipex_llm.llm_patching',
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_LAZY_ATTRS[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRS))
+
 # Default is True, set to False to disable auto importing Intel Extension for PyTorch.
 USE_NPU = os.getenv("BIGDL_USE_NPU", 'False').lower() in ('true', '1', 't')
 BIGDL_IMPORT_IPEX = os.getenv("BIGDL_IMPORT_IPEX", 'True').lower() in ('true', '1', 't')
@@ -48,7 +48,9 @@
 
 import os
 import sys
+import mmap
 import uuid
+import bisect
 import time
 import math
 import multiprocessing
@@ -60,36 +62,156 @@ from . import llama_cpp
 from .llama_types import *
 
 
+class _TokenTrieNode:
+    def __init__(self, tokens: Tuple[int, ...], parent: Optional["_TokenTrieNode"]):
+        # `tokens` is the edge label from `parent`, `key` is set if a cached key ends here
+        self.tokens = tokens
+        self.parent = parent
+        self.children = {}
+        self.key = None
+
+
+class _TokenTrie:
+    """Radix tree of cached keys, finds the longest common prefix in O(len(query))."""
+
+    def __init__(self):
+        self.root = _TokenTrieNode((), None)
+
+    def insert(self, key: Tuple[int, ...]):
+        node = self.root
+        pos = 0
+        while pos < len(key):
+            child = node.children.get(key[pos], None)
+            if child is None:
+                child = _TokenTrieNode(key[pos:], node)
+                node.children[key[pos]] = child
+                pos = len(key)
+            else:
+                n = Llama.longest_token_prefix(child.tokens, key[pos:])
+                if n < len(child.tokens):
+                    child = self._split(child, n)
+                pos += n
+            node = child
+        node.key = key
+
+    def _split(self, node: _TokenTrieNode, length: int) -> _TokenTrieNode:
+        # split `node` into a parent holding its first `length` tokens and itself
+        parent = _TokenTrieNode(node.tokens[:length], node.parent)
+        node.parent.children[node.tokens[0]] = parent
+        node.tokens = node.tokens[length:]
+        node.parent = parent
+        parent.children[node.tokens[0]] = node
+        return parent
+
+    def remove(self, key: Tuple[int, ...]):
+        node = self.root
+        pos = 0
+        while pos < len(key):
+            node = node.children.get(key[pos], None)
+            if node is None:
+                return
+            pos += len(node.tokens)
+        if node.key != key:
+            return
+        node.key = None
+        # drop nodes which no longer lead to any key
+        while node is not self.root and node.key is None and not node.children:
+            del node.parent.children[node.tokens[0]]
+            node = node.parent
+
+    def longest_prefix_key(self, query: Tuple[int, ...]) -> Optional[Tuple[int, ...]]:
+        node = self.root
+        pos = 0
+        while pos < len(query):
+            child = node.children.get(query[pos], None)
+            if child is None:
+                break
+            n = Llama.longest_token_prefix(child.tokens, query[pos:])
+            pos += n
+            node = child
+            if n < len(child.tokens):
+                break
+        if pos == 0:
+            return None
+        # every key below `node` shares the first `pos` tokens with `query`
+        while node.key is None:
+            node = next(iter(node.children.values()))
+        return node.key
+
+
 class LlamaCache:
-    """Cache for a llama.cpp model."""
+    """
+    Cache for a llama.cpp model.
 
-    def __init__(self, capacity_bytes: int = (2 << 30)):
+    States evicted from the `capacity_bytes` memory budget are spilled to an mmapped
+    file of `disk_capacity_bytes` at `disk_path` if it is set, which is written as a
+    ring buffer that overwrites the oldest spilled states.
+
+    The file is scratch space of this cache only: it is truncated when the cache is
+    created, and unmapped and deleted by `close()`, which also runs when the cache is
+    garbage collected.
+    """
+
+    def __init__(self, capacity_bytes: int = (2 << 30), disk_path: Optional[str] = None,
+                 disk_capacity_bytes: int = (8 << 30)):
         self.cache_state: OrderedDict[Tuple[int, ...], "LlamaState"] = OrderedDict()
         self.capacity_bytes = capacity_bytes
+        self._cache_size = 0
+        self._trie = _TokenTrie()
+
+        # key -> (offset, size, eval_tokens, eval_logits) of states spilled to disk
+        self.disk_state: OrderedDict[Tuple[int, ...], Tuple] = OrderedDict()
+        self.disk_capacity_bytes = disk_capacity_bytes
+        self._disk_mmap = None
+        self._disk_offsets: List[int] = []
+        self._disk_keys: List[Tuple[int, ...]] = []
+        self._disk_head = 0
+        self._disk_path = disk_path
+        if disk_path is not None:
+            with open(disk_path, "w+b") as f:
+                f.truncate(disk_capacity_bytes)
+                self._disk_mmap = mmap.mmap(f.fileno(), disk_capacity_bytes)
 
     @property
     def cache_size(self):
-        return sum([state.llama_state_size for state in self.cache_state.values()])
+        return self._cache_size
+
+    def close(self):
+        """Drop the states spilled to disk, unmap and delete the file at `disk_path`"""
+        if self._disk_mmap is None:
+            return
+        for key in self.disk_state:
+            self._trie.remove(key)
+        self.disk_state.clear()
+        self._disk_offsets.clear()
+        self._disk_keys.clear()
+        self._disk_head = 0
+        self._disk_mmap.close()
+        self._disk_mmap = None
+        try:
+            os.remove(self._disk_path)
+        except OSError:
+            pass
+
+    def __del__(self):
+        if getattr(self, "_disk_mmap", None) is not None:
+            self.close()
 
     def _find_longest_prefix_key(
         self,
         key: Tuple[int, ...],
     ) -> Optional[Tuple[int, ...]]:
-        min_len = 0
-        min_key = None
-        keys = (
-            (k, Llama.longest_token_prefix(k, key)) for k in self.cache_state.keys()
-        )
-        for k, prefix_len in keys:
-            if prefix_len > min_len:
-                min_len = prefix_len
-                min_key = k
-        return min_key
+        return self._trie.longest_prefix_key(key)
 
     def __getitem__(self, key: Sequence[int]) -> "LlamaState":
         key = tuple(key)
         _key = self._find_longest_prefix_key(key)
         invalidInputError(_key is not None, "Key not found.")
+        if _key in self.disk_state:
+            # promote a spilled state back to memory
+            value = self._load_from_disk(_key)
+            self[_key] = value
+            return value
         value = self.cache_state[_key]
         self.cache_state.move_to_end(_key)
         return value
@@ -100,10 +222,61 @@ class LlamaCache:
     def __setitem__(self, key: Sequence[int], value: "LlamaState"):
         key = tuple(key)
         if key in self.cache_state:
-            del self.cache_state[key]
+            self._cache_size -= self.cache_state.pop(key).llama_state_size
+        elif key in self.disk_state:
+            self._remove_from_disk(key)
+        else:
+            self._trie.insert(key)
         self.cache_state[key] = value
-        while self.cache_size > self.capacity_bytes:
-            self.cache_state.popitem(last=False)
+        self._cache_size += value.llama_state_size
+        while self._cache_size > self.capacity_bytes and len(self.cache_state) > 0:
+            evicted_key, evicted_value = self.cache_state.popitem(last=False)
+            self._cache_size -= evicted_value.llama_state_size
+            if not self._spill_to_disk(evicted_key, evicted_value):
+                self._trie.remove(evicted_key)
+
+    def _spill_to_disk(self, key: Tuple[int, ...], value: "LlamaState") -> bool:
+        size = value.llama_state_size
+        if self._disk_mmap is None or size > self.disk_capacity_bytes:
+            return False
+        if self._disk_head + size > self.disk_capacity_bytes:
+            self._disk_head = 0
+        start, end = self._disk_head, self._disk_head + size
+        # drop the spilled states overwritten by [start, end)
+        idx = bisect.bisect_left(self._disk_offsets, start)
+        if idx > 0:
+            prev_key = self._disk_keys[idx - 1]
+            prev_offset, prev_size = self.disk_state[prev_key][:2]
+            if prev_offset + prev_size > start:
+                idx -= 1
+        while idx < len(self._disk_offsets) and self._disk_offsets[idx] < end:
+            overwritten_key = self._disk_keys[idx]
+            self._remove_from_disk(overwritten_key)
+            self._trie.remove(overwritten_key)
+
+        self._disk_mmap[start:end] = bytes(value.llama_state)
+        self.disk_state[key] = (start, size, value.eval_tokens, value.eval_logits)
+        idx = bisect.bisect_left(self._disk_offsets, start)
+        self._disk_offsets.insert(idx, start)
+        self._disk_keys.insert(idx, key)
+        self._disk_head = end
+        return True
+
+    def _remove_from_disk(self, key: Tuple[int, ...]):
+        offset = self.disk_state.pop(key)[0]
+        idx = bisect.bisect_left(self._disk_offsets, offset)
+        del self._disk_offsets[idx]
+        del self._disk_keys[idx]
+
+    def _load_from_disk(self, key: Tuple[int, ...]) -> "LlamaState":
+        offset, size, eval_tokens, eval_logits = self.disk_state[key]
+        llama_state = (llama_cpp.c_uint8 * size).from_buffer_copy(self._disk_mmap, offset)
+        return LlamaState(
+            eval_tokens=eval_tokens,
+            eval_logits=eval_logits,
+            llama_state=llama_state,
+            llama_state_size=size,
+        )
 
 
 class LlamaState:
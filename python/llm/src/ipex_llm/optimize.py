@@ -24,13 +24,18 @@ from accelerate import init_empty_weights
 from accelerate.utils import set_module_tensor_to_device
 from ipex_llm.ggml.quantize import ggml_tensor_qtype
 from ipex_llm.utils.common import invalidInputError
-from ipex_llm.transformers.utils import extract_local_archive_file, get_local_shard_files
+from ipex_llm.transformers.utils import extract_local_archive_file, get_local_shard_files, \
+    load_safetensors_mmap, logger
 import transformers
 import warnings
 from transformers import PreTrainedModel
 from .utils.common import MuteHFLogger
 from .utils.lazy_load_torch import LazyLoadTensors
 from contextlib import ExitStack, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import inspect
+import platform
+import time
 
 
 # Simulate the Hugging Face format
@@ -134,6 +139,31 @@ def low_memory_init():
         yield
 
 
+def _load_shard(model_file):
+    # map the shard instead of reading it, tensors are only paged in when assigned
+    fd = os.open(model_file, os.O_RDONLY)
+    try:
+        if hasattr(os, "posix_fadvise"):
+            # start the kernel readahead, overlapped with assigning the previous shard
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+    if model_file.endswith(".safetensors"):
+        return load_safetensors_mmap(model_file)
+    if "mmap" in inspect.signature(torch.load).parameters:
+        return torch.load(model_file, map_location="cpu", mmap=True)
+    return torch.load(model_file, map_location="cpu")
+
+
+def _peak_rss_bytes():
+    if platform.system() == "Windows":
+        return None
+    import resource
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return peak_rss if platform.system() == "Darwin" else peak_rss * 1024
+
+
 def load_low_bit(model, model_path):
     """
     Load the optimized pytorch model.
@@ -187,12 +217,27 @@ def load_low_bit(model, model_path):
                                   resolved_archive_file,
                                   subfolder="")
     else:
-        resolved_archive_file = [os.path.join(model_path, PYTORCH_MODEL_NAME)]
-
-    for model_file in resolved_archive_file:
-        state_dict = torch.load(model_file)
-        for param_name, param in state_dict.items():
-            set_module_tensor_to_device(model, param_name, "cpu", param)
+        resolved_archive_file = [resolved_archive_file]
+
+    start = time.perf_counter()
+    loaded_bytes = 0
+    # load shards one by one, the next shard is mapped while the current one is assigned
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_shard = executor.submit(_load_shard, resolved_archive_file[0])
+        for idx in range(len(resolved_archive_file)):
+            state_dict = next_shard.result()
+            if idx + 1 < len(resolved_archive_file):
+                next_shard = executor.submit(_load_shard, resolved_archive_file[idx + 1])
+            for param_name, param in state_dict.items():
+                set_module_tensor_to_device(model, param_name, "cpu", param)
+                loaded_bytes += param.numel() * param.element_size()
+            del state_dict
+    elapsed = time.perf_counter() - start
+    peak_rss = _peak_rss_bytes()
+    logger.info(f"Loaded {loaded_bytes / 2**30:.2f} GB from {len(resolved_archive_file)} "
+                f"shard(s) in {elapsed:.2f}s ({loaded_bytes / 2**30 / max(elapsed, 1e-6):.2f}"
+                f" GB/s)" + ("" if peak_rss is None else
+                             f", peak RSS {peak_rss / 2**30:.2f} GB"))
     return model
 
 
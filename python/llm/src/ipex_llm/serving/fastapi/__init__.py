@@ -15,4 +15,4 @@
 #
 
 from .api_server import FastApp
-from .model_worker import ModelWorker
\ No newline at end of file
+from .model_worker import ModelWorker, BatchModelWorker
\ No newline at end of file
@@ -23,6 +23,7 @@ from openai.types.chat import ChatCompletionMessageParam
 from pydantic import BaseModel
 from ipex_llm.utils.common import invalidInputError
 import asyncio
+import functools
 import uuid
 from typing import List, Optional, Union, Dict
 from fastapi.middleware.cors import CORSMiddleware
@@ -46,6 +47,8 @@ from .openai_protocol import (
 
 result_dict: Dict[str, str] = {}
 logger = logging.get_logger(__name__)
+# seconds between checks whether the model worker has created the streamer of a request
+STREAMER_POLL_INTERVAL = 0.005
 
 
 class InputsRequest(BaseModel):
@@ -111,9 +114,16 @@ class FastApp():
         self.app = app
 
 
-def get_queue_next_token(delta_text_queue):
+async def get_queue_next_token(delta_text_queue):
     timeout = int(os.getenv("IPEX_LLM_FASTAPI_TIMEOUT", 60))
-    delta_text = delta_text_queue.text_queue.get(timeout=timeout)
+    if isinstance(delta_text_queue.text_queue, asyncio.Queue):
+        delta_text = await asyncio.wait_for(delta_text_queue.text_queue.get(), timeout)
+    else:
+        # wait on a blocking queue in a thread, so other streams are not stalled
+        loop = asyncio.get_running_loop()
+        delta_text = await loop.run_in_executor(
+            None, functools.partial(delta_text_queue.text_queue.get, timeout=timeout)
+        )
     if "whisper" in local_model.model_name.lower():
         if delta_text is not None and "<|" in delta_text and "|>" in delta_text:
             import re
@@ -139,7 +149,7 @@ async def chat_stream_generator(local_model, delta_text_queue, request_id):
     while True:
         await asyncio.sleep(0)
         if not hasattr(delta_text_queue, 'empty'):
-            delta_text, remain = get_queue_next_token(delta_text_queue)
+            delta_text, remain = await get_queue_next_token(delta_text_queue)
         else:
             if not delta_text_queue.empty():
                 with local_model.dict_lock:
@@ -183,7 +193,7 @@ async def completion_stream_generator(local_model, delta_text_queue, request_id)
     while True:
         await asyncio.sleep(0)
         if not hasattr(delta_text_queue, 'empty'):
-            delta_text, remain = get_queue_next_token(delta_text_queue)
+            delta_text, remain = await get_queue_next_token(delta_text_queue)
         else:
             if not delta_text_queue.empty():
                 with local_model.dict_lock:
@@ -224,7 +234,7 @@ async def completion_stream_generator(local_model, delta_text_queue, request_id)
 async def generator(local_model, delta_text_queue, request_id):
     while True:
         if not hasattr(delta_text_queue, 'empty'):
-            delta_text, remain = get_queue_next_token(delta_text_queue)
+            delta_text, remain = await get_queue_next_token(delta_text_queue)
             if delta_text is None:
                 break
             else:
@@ -250,7 +260,7 @@ async def generate(inputs_request: InputsRequest):
     request_id = str(uuid.uuid4())
     await local_model.waiting_requests.put((request_id, inputs_request))
     while True:
-        await asyncio.sleep(0)
+        await asyncio.sleep(STREAMER_POLL_INTERVAL)
         cur_streamer = local_model.streamer.get(request_id, None)
         if cur_streamer is not None:
             output_str = []
@@ -269,7 +279,7 @@ async def generate_stream(inputs_request: InputsRequest):
     request_id = str(uuid.uuid4()) + "stream"
     await local_model.waiting_requests.put((request_id, inputs_request))
     while True:
-        await asyncio.sleep(0.1)
+        await asyncio.sleep(STREAMER_POLL_INTERVAL)
         cur_streamer = local_model.streamer.get(request_id, None)
         if cur_streamer is not None:
             if inputs_request.req_type == 'completion':
@@ -426,6 +436,14 @@ async def transcriptions(
     return rsp
 
 
+@app.get("/prefix_cache_stats")
+async def prefix_cache_stats():
+    prefix_cache = getattr(local_model, "prefix_cache", None)
+    if prefix_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **prefix_cache.stats()}
+
+
 @app.on_event("startup")
 async def startup_event():
     asyncio.create_task(process_requests(local_model, result_dict))
@@ -434,4 +452,8 @@ async def startup_event():
 async def process_requests(local_model, result_dict):
     while True:
         await asyncio.sleep(0)
-        await local_model.process_step(tokenizer, result_dict, processor)
+        try:
+            await local_model.process_step(tokenizer, result_dict, processor)
+        except Exception as e:
+            # keep serving the other requests
+            logger.error(f"Failed to process requests: {e}")
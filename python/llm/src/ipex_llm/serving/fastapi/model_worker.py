@@ -19,14 +19,18 @@ from transformers.utils import logging
 import os
 import time
 import asyncio
+from collections import deque
 from PIL import Image
 import requests
-from transformers import TextIteratorStreamer
+from ipex_llm.transformers.streamer import AsyncTextIteratorStreamer
+from ipex_llm.utils.common import invalidInputError
+from .tgi_protocol import Parameters
 logger = logging.get_logger(__name__)
 
 
 class ModelWorker:
-    def __init__(self, checkpoint, low_bit, model_type="normal", torch_dtype=torch.float16):
+    def __init__(self, checkpoint, low_bit, model_type="normal", torch_dtype=torch.float16,
+                 prefix_cache_bytes=None):
         self.dtype = torch_dtype
         start = time.perf_counter()
         if model_type == "audio":
@@ -44,6 +48,14 @@ class ModelWorker:
         self.waiting_requests = asyncio.Queue()
         self.streamer = {}
         self.model_name = checkpoint
+        # reuse the kv of shared prompt prefixes across requests, disabled by default
+        if prefix_cache_bytes is None:
+            prefix_cache_bytes = int(os.getenv("IPEX_LLM_PREFIX_CACHE_BYTES", "0"))
+        if prefix_cache_bytes > 0 and model_type != "audio":
+            from .prefix_cache import RadixPrefixCache
+            self.prefix_cache = RadixPrefixCache(prefix_cache_bytes)
+        else:
+            self.prefix_cache = None
 
     def load_model(self, model_path, low_bit='sym_int4', model_type="normal"):
         if model_type == "audio":
@@ -80,6 +92,14 @@ class ModelWorker:
         model = model.eval().to("xpu")
         return model
 
+    def generate_with_prefix_cache(self, input_ids, streamer, generate_kwargs):
+        _, past_key_values = self.prefix_cache.match(input_ids[0].tolist())
+        if past_key_values is not None:
+            generate_kwargs["past_key_values"] = past_key_values
+        output = self.model.generate(input_ids, streamer=streamer,
+                                     return_dict_in_generate=True, **generate_kwargs)
+        self.prefix_cache.insert(output.sequences[0].tolist(), output.past_key_values)
+
     def get_local_image_path(self, image_path):
         local_dir = './local_images/'
         local_path = local_dir + os.path.basename(image_path)
@@ -170,7 +190,7 @@ class ModelWorker:
         if not self.waiting_requests.empty():
             if processor is not None and "whisper" in self.model_name.lower():
                 input_features, decoder_ids, request_id = await self.add_asr_request(processor)
-                self.streamer[request_id] = TextIteratorStreamer(tokenizer, skip_prompt=True)
+                self.streamer[request_id] = AsyncTextIteratorStreamer(tokenizer, skip_prompt=True)
 
                 def model_generate():
                     self.model.generate(input_features,
@@ -179,7 +199,7 @@ class ModelWorker:
             else:
                 input_ids, parameters, request_id, inputs_embeds, inputs = \
                     await self.add_request(tokenizer)
-                self.streamer[request_id] = TextIteratorStreamer(tokenizer, skip_prompt=True)
+                self.streamer[request_id] = AsyncTextIteratorStreamer(tokenizer, skip_prompt=True)
 
                 def model_generate():
                     generate_kwargs = {k: v for k, v in parameters.dict().items() if v is not None}
@@ -194,7 +214,11 @@ class ModelWorker:
                             tokenizer.convert_tokens_to_ids(['[UNUSED_TOKEN_145]'])[0]
                         ]
                         generate_kwargs["eos_token_id"] = eos_token_id
-                    if input_ids is not None:
+                    if input_ids is not None and self.prefix_cache is not None \
+                            and input_ids.size(0) == 1:
+                        self.generate_with_prefix_cache(input_ids, self.streamer[request_id],
+                                                        generate_kwargs)
+                    elif input_ids is not None:
                         self.model.generate(input_ids,
                                             streamer=self.streamer[request_id], **generate_kwargs)
                     elif inputs_embeds is not None:
@@ -208,3 +232,340 @@ class ModelWorker:
             from threading import Thread
             t1 = Thread(target=model_generate)
             t1.start()
+
+
+class _SequenceState:
+    def __init__(self, request_id, token_ids, parameters, streamer, eos_token_ids):
+        self.request_id = request_id
+        self.token_ids = token_ids
+        self.prompt_length = len(token_ids)
+        self.streamer = streamer
+        self.eos_token_ids = eos_token_ids
+        self.max_new_tokens = parameters.max_new_tokens
+        self.min_new_tokens = parameters.min_new_tokens or 0
+        self.do_sample = bool(parameters.do_sample)
+        self.finished = False
+
+        from transformers.generation.logits_process import (
+            LogitsProcessorList, RepetitionPenaltyLogitsProcessor,
+            TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper,
+        )
+        self.logits_processor = LogitsProcessorList()
+        if parameters.repetition_penalty is not None and parameters.repetition_penalty != 1.0:
+            self.logits_processor.append(
+                RepetitionPenaltyLogitsProcessor(parameters.repetition_penalty))
+        if self.do_sample:
+            if parameters.temperature is not None and parameters.temperature != 1.0:
+                self.logits_processor.append(TemperatureLogitsWarper(parameters.temperature))
+            if parameters.top_k is not None and parameters.top_k > 0:
+                self.logits_processor.append(TopKLogitsWarper(parameters.top_k))
+            if parameters.top_p is not None and parameters.top_p < 1.0:
+                self.logits_processor.append(TopPLogitsWarper(parameters.top_p))
+
+    @property
+    def num_new_tokens(self):
+        return len(self.token_ids) - self.prompt_length
+
+    def is_greedy(self):
+        return not self.do_sample and len(self.logits_processor) == 0 \
+            and self.num_new_tokens >= self.min_new_tokens
+
+    def next_token(self, logits):
+        # logits: [1, vocab_size]
+        if len(self.logits_processor) > 0:
+            input_ids = torch.tensor([self.token_ids], device=logits.device)
+            logits = self.logits_processor(input_ids, logits)
+        if self.num_new_tokens < self.min_new_tokens:
+            logits[:, list(self.eos_token_ids)] = -float("inf")
+        if self.do_sample:
+            probs = torch.nn.functional.softmax(logits.float(), dim=-1)
+            return torch.multinomial(probs, num_samples=1).item()
+        return torch.argmax(logits, dim=-1).item()
+
+    def append(self, token_id):
+        self.token_ids.append(token_id)
+        self.streamer.put(torch.tensor([token_id]))
+        if token_id in self.eos_token_ids or self.num_new_tokens >= self.max_new_tokens:
+            self.finished = True
+            self.streamer.end()
+
+    def abort(self, message):
+        # end the stream with the error as its last text
+        if not self.finished:
+            self.finished = True
+            self.streamer.on_finalized_text(message, stream_end=True)
+
+
+def _new_kv_cache_like(past_key_values, batch_size, length):
+    # empty cache of the same class with room for `KV_ALLOC_BLOCK_LENGTH` more tokens
+    from ipex_llm.transformers.kv import DynamicNormalCache, alloc_kv_cache
+    new_cache = type(past_key_values)()
+    for k in past_key_values.key_cache:
+        k_cache, v_cache = alloc_kv_cache(
+            batch_size, k.size(1), k.size(3),
+            length, length + DynamicNormalCache.KV_ALLOC_BLOCK_LENGTH,
+            k.dtype, k.device
+        )
+        k_cache.zero_()
+        v_cache.zero_()
+        new_cache.key_cache.append(k_cache)
+        new_cache.value_cache.append(v_cache)
+    if hasattr(new_cache, "_seen_tokens"):
+        # 4.39 uses `_seen_tokens`
+        new_cache._seen_tokens = length
+    else:
+        # 4.37 uses `seen_tokens`
+        new_cache.seen_tokens = length
+    return new_cache
+
+
+def _release_kv_cache(past_key_values):
+    # hand the buffers of a cache which is no longer used back to the kv cache pool
+    from ipex_llm.transformers.kv import DynamicNormalCache
+    if isinstance(past_key_values, DynamicNormalCache):
+        past_key_values.release()
+
+
+def merge_kv_cache(cache_1, mask_1, cache_2, mask_2):
+    """
+    Concatenate two left-padded batches along the batch dim,
+    left-padding the shorter one so that both end at the latest token.
+    """
+    batch_1, length_1 = mask_1.shape
+    batch_2, length_2 = mask_2.shape
+    length = max(length_1, length_2)
+    new_cache = _new_kv_cache_like(cache_1, batch_1 + batch_2, length)
+    for layer_idx in range(len(new_cache.key_cache)):
+        new_cache.key_cache[layer_idx][:batch_1, :, length - length_1:] = \
+            cache_1.key_cache[layer_idx]
+        new_cache.value_cache[layer_idx][:batch_1, :, length - length_1:] = \
+            cache_1.value_cache[layer_idx]
+        new_cache.key_cache[layer_idx][batch_1:, :, length - length_2:] = \
+            cache_2.key_cache[layer_idx]
+        new_cache.value_cache[layer_idx][batch_1:, :, length - length_2:] = \
+            cache_2.value_cache[layer_idx]
+    new_mask = torch.zeros((batch_1 + batch_2, length), dtype=mask_1.dtype, device=mask_1.device)
+    new_mask[:batch_1, length - length_1:] = mask_1
+    new_mask[batch_1:, length - length_2:] = mask_2
+    _release_kv_cache(cache_1)
+    _release_kv_cache(cache_2)
+    return new_cache, new_mask
+
+
+def select_kv_cache(past_key_values, attention_mask, indices):
+    """
+    Keep the batch rows in `indices` and drop leading positions padded in all of them.
+    """
+    attention_mask = attention_mask[indices]
+    start = int(torch.nonzero(attention_mask.sum(dim=0))[0])
+    attention_mask = attention_mask[:, start:]
+    new_cache = _new_kv_cache_like(past_key_values, attention_mask.size(0),
+                                   attention_mask.size(1))
+    for layer_idx in range(len(new_cache.key_cache)):
+        new_cache.key_cache[layer_idx][...] = \
+            past_key_values.key_cache[layer_idx][indices, :, start:]
+        new_cache.value_cache[layer_idx][...] = \
+            past_key_values.value_cache[layer_idx][indices, :, start:]
+    _release_kv_cache(past_key_values)
+    return new_cache, attention_mask
+
+
+class BatchModelWorker(ModelWorker):
+    """
+    Model worker with iteration-level (continuous) batching.
+
+    Instead of running a separate `generate` per request, the worker keeps one running
+    decode batch. Every step it decodes one token for all running sequences in a single
+    forward, prefills newly arrived requests and merges them into the running batch,
+    and retires finished sequences. Only text inputs are supported.
+
+    :param max_num_seqs: the maximum number of sequences in the running batch.
+    :param max_num_batched_tokens: the maximum number of tokens (padded prefill tokens
+        plus one token per running sequence) processed in one step.
+    """
+
+    def __init__(self, checkpoint, low_bit, torch_dtype=torch.float16,
+                 max_num_seqs=8, max_num_batched_tokens=4096):
+        if int(os.getenv("IPEX_LLM_PREFIX_CACHE_BYTES", "0")) > 0:
+            logger.warning("IPEX_LLM_PREFIX_CACHE_BYTES is ignored, "
+                           "the prefix cache is not supported with continuous batching.")
+        super().__init__(checkpoint, low_bit, torch_dtype=torch_dtype, prefix_cache_bytes=0)
+        self.check_kv_cache()
+        self.max_num_seqs = max_num_seqs
+        self.max_num_batched_tokens = max_num_batched_tokens
+        self.pending_requests = deque()
+        self.running = []
+        self.past_key_values = None
+        self.attention_mask = None
+        self.loop = None
+
+    def get_eos_token_ids(self, tokenizer):
+        eos_token_ids = self.model.generation_config.eos_token_id
+        if eos_token_ids is None:
+            eos_token_ids = []
+        elif isinstance(eos_token_ids, int):
+            eos_token_ids = [eos_token_ids]
+        eos_token_ids = set(eos_token_ids)
+        if tokenizer.eos_token_id is not None:
+            eos_token_ids.add(tokenizer.eos_token_id)
+        if "codegeex" in self.model_name.lower():
+            eos_token_ids.add(tokenizer.convert_tokens_to_ids("<|user|>"))
+            eos_token_ids.add(tokenizer.convert_tokens_to_ids("<|observation|>"))
+        return eos_token_ids
+
+    @torch.no_grad()
+    def check_kv_cache(self):
+        # the running batch is merged and sliced as a DynamicCache, so check it up front
+        from transformers.cache_utils import DynamicCache
+        from ipex_llm.transformers.kv import DynamicCompressCache
+        input_ids = torch.zeros((1, 1), dtype=torch.int64, device=self.model.device)
+        _, past_key_values = self.forward(input_ids, torch.ones_like(input_ids), None)
+        invalidInputError(isinstance(past_key_values, DynamicCache) and
+                          not isinstance(past_key_values, DynamicCompressCache),
+                          "Continuous batching requires a model using DynamicCache.")
+        _release_kv_cache(past_key_values)
+
+    def abort_request(self, tokenizer, request_id, message):
+        streamer = self.streamer.get(request_id, None)
+        if streamer is None:
+            streamer = AsyncTextIteratorStreamer(tokenizer, skip_prompt=False, loop=self.loop)
+            self.streamer[request_id] = streamer
+        streamer.on_finalized_text(message, stream_end=True)
+
+    def abort(self, tokenizer, new_requests, message):
+        """
+        End the streams of all running and newly admitted requests after a failed step,
+        and drop the running batch.
+        """
+        aborted = set()
+        for seq in self.running:
+            seq.abort(message)
+            aborted.add(seq.request_id)
+        for request_id, _, _ in new_requests:
+            if request_id not in aborted:
+                self.abort_request(tokenizer, request_id, message)
+        _release_kv_cache(self.past_key_values)
+        self.running = []
+        self.past_key_values = None
+        self.attention_mask = None
+
+    async def schedule(self, tokenizer):
+        while not self.waiting_requests.empty():
+            request_id, prompt_request = await self.waiting_requests.get()
+            try:
+                token_ids = tokenizer(prompt_request.inputs).input_ids
+            except Exception as e:
+                logger.error(f"Failed to tokenize request {request_id}: {e}")
+                self.abort_request(tokenizer, request_id, f"Error: {e}")
+                continue
+            self.pending_requests.append((request_id, prompt_request, token_ids))
+
+        # one token for each running sequence, plus the padded prompts of admitted ones
+        num_batched_tokens = len(self.running)
+        max_prompt_length = 0
+        new_requests = []
+        while self.pending_requests and \
+                len(self.running) + len(new_requests) < self.max_num_seqs:
+            _, _, token_ids = self.pending_requests[0]
+            prompt_length = max(max_prompt_length, len(token_ids))
+            num_prefill_tokens = prompt_length * (len(new_requests) + 1)
+            if new_requests and \
+                    num_batched_tokens + num_prefill_tokens > self.max_num_batched_tokens:
+                break
+            max_prompt_length = prompt_length
+            new_requests.append(self.pending_requests.popleft())
+        return new_requests
+
+    def forward(self, input_ids, attention_mask, past_key_values):
+        past_length = 0 if past_key_values is None else past_key_values.get_seq_length()
+        cache_position = torch.arange(past_length, attention_mask.size(1),
+                                      device=input_ids.device)
+        model_inputs = self.model.prepare_inputs_for_generation(
+            input_ids, past_key_values=past_key_values, attention_mask=attention_mask,
+            use_cache=True, cache_position=cache_position,
+        )
+        output = self.model(**model_inputs, return_dict=True)
+        return output.logits[:, -1, :], output.past_key_values
+
+    def sample(self, sequences, logits):
+        if all(seq.is_greedy() for seq in sequences):
+            return torch.argmax(logits, dim=-1).tolist()
+        return [seq.next_token(logits[i:i + 1]) for i, seq in enumerate(sequences)]
+
+    def decode_step(self):
+        device = self.attention_mask.device
+        input_ids = torch.tensor([[seq.token_ids[-1]] for seq in self.running], device=device)
+        self.attention_mask = torch.cat([
+            self.attention_mask,
+            self.attention_mask.new_ones((len(self.running), 1))
+        ], dim=-1)
+        logits, self.past_key_values = self.forward(input_ids, self.attention_mask,
+                                                    self.past_key_values)
+        for seq, token_id in zip(self.running, self.sample(self.running, logits)):
+            seq.append(token_id)
+
+    def prefill_step(self, tokenizer, new_requests):
+        device = self.model.device
+        pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+        eos_token_ids = self.get_eos_token_ids(tokenizer)
+        max_length = max(len(token_ids) for _, _, token_ids in new_requests)
+        input_ids = torch.full((len(new_requests), max_length), pad_token_id,
+                               dtype=torch.int64, device=device)
+        attention_mask = torch.zeros((len(new_requests), max_length),
+                                     dtype=torch.int64, device=device)
+        sequences = []
+        for i, (request_id, prompt_request, token_ids) in enumerate(new_requests):
+            input_ids[i, max_length - len(token_ids):] = torch.tensor(token_ids)
+            attention_mask[i, max_length - len(token_ids):] = 1
+            # created in the executor thread, so the event loop is passed explicitly
+            streamer = AsyncTextIteratorStreamer(tokenizer, skip_prompt=False, loop=self.loop)
+            self.streamer[request_id] = streamer
+            sequences.append(_SequenceState(request_id, list(token_ids),
+                                            prompt_request.parameters or Parameters(), streamer,
+                                            eos_token_ids))
+
+        logits, past_key_values = self.forward(input_ids, attention_mask, None)
+        for seq, token_id in zip(sequences, self.sample(sequences, logits)):
+            seq.append(token_id)
+
+        if self.past_key_values is None:
+            self.past_key_values, self.attention_mask = past_key_values, attention_mask
+        else:
+            self.past_key_values, self.attention_mask = merge_kv_cache(
+                self.past_key_values, self.attention_mask, past_key_values, attention_mask
+            )
+        self.running.extend(sequences)
+
+    def retire_finished(self):
+        indices = [i for i, seq in enumerate(self.running) if not seq.finished]
+        if len(indices) == len(self.running):
+            return
+        if len(indices) == 0:
+            _release_kv_cache(self.past_key_values)
+            self.past_key_values, self.attention_mask = None, None
+        else:
+            self.past_key_values, self.attention_mask = select_kv_cache(
+                self.past_key_values, self.attention_mask,
+                torch.tensor(indices, device=self.attention_mask.device)
+            )
+        self.running = [self.running[i] for i in indices]
+
+    @torch.no_grad()
+    def step(self, tokenizer, new_requests):
+        if self.running:
+            self.decode_step()
+        if new_requests:
+            self.prefill_step(tokenizer, new_requests)
+        self.retire_finished()
+
+    async def process_step(self, tokenizer, result_dict, processor=None):
+        new_requests = await self.schedule(tokenizer)
+        if not new_requests and not self.running:
+            return
+        # run the forward in a thread, so that the event loop keeps serving streams
+        self.loop = asyncio.get_running_loop()
+        try:
+            await self.loop.run_in_executor(None, self.step, tokenizer, new_requests)
+        except Exception as e:
+            logger.error(f"Continuous batching step failed: {e}")
+            self.abort(tokenizer, new_requests, f"Error: {e}")
@@ -0,0 +1,257 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import heapq
+import itertools
+import threading
+import torch
+from typing import List, Optional, Tuple
+from transformers.utils import logging
+from ipex_llm.transformers.kv import DynamicNormalCache, DynamicFp8Cache, DynamicCompressCache
+from ipex_llm.transformers.models.utils import init_kv_cache, append_kv_cache
+logger = logging.get_logger(__name__)
+
+
+class _RadixNode:
+    def __init__(self, tokens, key_cache, value_cache, parent, cache_cls):
+        # `tokens` is the edge label from `parent` to this node, `key_cache` and
+        # `value_cache` hold the kv of exactly these tokens for every layer
+        self.tokens = tokens
+        self.key_cache = key_cache
+        self.value_cache = value_cache
+        self.parent = parent
+        self.cache_cls = cache_cls
+        self.children = {}
+        self.last_access = 0
+        self.nbytes = sum(k.numel() * k.element_size() + v.numel() * v.element_size()
+                          for k, v in zip(key_cache, value_cache))
+
+
+def _common_prefix_length(a, b):
+    length = min(len(a), len(b))
+    for i in range(length):
+        if a[i] != b[i]:
+            return i
+    return length
+
+
+def _slice_segments(caches, start, end):
+    return [c[:, :, start:end, :].clone() for c in caches]
+
+
+class RadixPrefixCache:
+    """
+    Prefix kv cache keyed by a radix tree of token ids.
+
+    Every edge of the tree stores the kv segment of its tokens, so requests sharing a
+    prompt prefix (e.g. a system prompt) only need to prefill their own suffix.
+    Leaves are evicted in LRU order once the stored kv exceeds `max_bytes`.
+    Only `DynamicNormalCache` and `DynamicFp8Cache` with batch size 1 are cached.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.root = _RadixNode((), [], [], None, None)
+        self.total_bytes = 0
+        self.num_nodes = 0
+        self.hits = 0
+        self.misses = 0
+        self.hit_tokens = 0
+        self.query_tokens = 0
+        self.evictions = 0
+        self._clock = 0
+        # min-heap of (last_access, seq, leaf), entries whose leaf has been accessed
+        # again, got children or been evicted since they were pushed are skipped
+        self._leaves = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def _push_leaf(self, node):
+        heapq.heappush(self._leaves, (node.last_access, next(self._seq), node))
+        if len(self._leaves) > 2 * self.num_nodes + 64:
+            # drop the stale entries
+            self._leaves = [e for e in self._leaves if self._is_lru_entry(e)]
+            heapq.heapify(self._leaves)
+
+    @staticmethod
+    def _is_lru_entry(entry):
+        last_access, _, node = entry
+        return not node.children and node.parent is not None \
+            and last_access == node.last_access
+
+    def _touch(self, node):
+        self._clock += 1
+        leaf = node
+        while node is not None:
+            node.last_access = self._clock
+            node = node.parent
+        if not leaf.children and leaf.parent is not None:
+            self._push_leaf(leaf)
+
+    def match(self, token_ids: List[int]) -> Tuple[int, Optional[DynamicNormalCache]]:
+        """
+        Find the longest cached prefix of `token_ids`.
+
+        At least the last token is always left out of the match, so that the model
+        still computes the logits of the next token.
+
+        :return: matched length and a new kv cache holding the matched prefix,
+                 or (0, None) when nothing matches.
+        """
+        with self._lock:
+            max_length = len(token_ids) - 1
+            self.query_tokens += len(token_ids)
+            node = self.root
+            pos = 0
+            path = []
+            while pos < max_length:
+                child = node.children.get(token_ids[pos], None)
+                if child is None:
+                    break
+                n = _common_prefix_length(child.tokens, token_ids[pos:max_length])
+                path.append((child, n))
+                pos += n
+                if n < len(child.tokens):
+                    break
+                node = child
+
+            if pos == 0:
+                self.misses += 1
+                return 0, None
+            self.hits += 1
+            self.hit_tokens += pos
+            self._touch(path[-1][0])
+
+            cache_cls = path[0][0].cache_cls
+            past_key_values = cache_cls()
+            num_layers = len(path[0][0].key_cache)
+            for layer_idx in range(num_layers):
+                key_states = torch.cat([n.key_cache[layer_idx][:, :, :length, :]
+                                        for n, length in path], dim=2)
+                value_states = torch.cat([n.value_cache[layer_idx][:, :, :length, :]
+                                          for n, length in path], dim=2)
+                batch_size, num_heads, _, head_dim = key_states.shape
+                k_cache, v_cache = init_kv_cache(
+                    batch_size, num_heads, head_dim,
+                    0, pos + DynamicNormalCache.KV_ALLOC_BLOCK_LENGTH,
+                    key_states.dtype, key_states.device
+                )
+                k_cache, v_cache = append_kv_cache(k_cache, v_cache, key_states, value_states)
+                past_key_values.key_cache.append(k_cache)
+                past_key_values.value_cache.append(v_cache)
+            if hasattr(past_key_values, "_seen_tokens"):
+                # 4.39 uses `_seen_tokens`
+                past_key_values._seen_tokens = pos
+            else:
+                # 4.37 uses `seen_tokens`
+                past_key_values.seen_tokens = pos
+            return pos, past_key_values
+
+    def insert(self, token_ids: List[int], past_key_values) -> bool:
+        """
+        Store the kv of `token_ids` computed by `model.generate`.
+
+        The kv of the last token is never computed by `generate`, so `past_key_values`
+        is expected to hold `len(token_ids) - 1` tokens.
+
+        :return: whether the kv cache was inserted.
+        """
+        if not isinstance(past_key_values, (DynamicNormalCache, DynamicFp8Cache)) \
+                or isinstance(past_key_values, DynamicCompressCache) \
+                or len(past_key_values.key_cache) == 0:
+            return False
+        kv_length = len(token_ids) - 1
+        key_cache = past_key_values.key_cache
+        value_cache = past_key_values.value_cache
+        if key_cache[0].size(0) != 1 or key_cache[0].size(2) != kv_length:
+            return False
+        tokens = tuple(token_ids[:kv_length])
+
+        with self._lock:
+            node = self.root
+            pos = 0
+            while pos < kv_length:
+                child = node.children.get(tokens[pos], None)
+                if child is None:
+                    child = _RadixNode(tokens[pos:],
+                                       _slice_segments(key_cache, pos, kv_length),
+                                       _slice_segments(value_cache, pos, kv_length),
+                                       node, type(past_key_values))
+                    node.children[tokens[pos]] = child
+                    self.total_bytes += child.nbytes
+                    self.num_nodes += 1
+                    pos = kv_length
+                else:
+                    n = _common_prefix_length(child.tokens, tokens[pos:])
+                    if n < len(child.tokens):
+                        child = self._split(child, n)
+                    pos += n
+                node = child
+            self._touch(node)
+            self._evict()
+        return True
+
+    def _split(self, node, length):
+        # split `node` into a parent holding its first `length` tokens and itself
+        parent = _RadixNode(node.tokens[:length],
+                            _slice_segments(node.key_cache, 0, length),
+                            _slice_segments(node.value_cache, 0, length),
+                            node.parent, node.cache_cls)
+        parent.last_access = node.last_access
+        node.parent.children[node.tokens[0]] = parent
+        self.total_bytes -= node.nbytes
+
+        remain = len(node.tokens)
+        node.tokens = node.tokens[length:]
+        node.key_cache = _slice_segments(node.key_cache, length, remain)
+        node.value_cache = _slice_segments(node.value_cache, length, remain)
+        node.nbytes = sum(k.numel() * k.element_size() + v.numel() * v.element_size()
+                          for k, v in zip(node.key_cache, node.value_cache))
+        node.parent = parent
+        parent.children[node.tokens[0]] = node
+
+        self.total_bytes += parent.nbytes + node.nbytes
+        self.num_nodes += 1
+        return parent
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self._leaves:
+            entry = heapq.heappop(self._leaves)
+            if not self._is_lru_entry(entry):
+                continue
+            victim = entry[2]
+            parent = victim.parent
+            del parent.children[victim.tokens[0]]
+            victim.parent = None
+            self.total_bytes -= victim.nbytes
+            self.num_nodes -= 1
+            self.evictions += 1
+            if not parent.children and parent is not self.root:
+                self._push_leaf(parent)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / max(self.hits + self.misses, 1),
+                "hit_tokens": self.hit_tokens,
+                "query_tokens": self.query_tokens,
+                "evictions": self.evictions,
+                "nodes": self.num_nodes,
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+            }
@@ -26,10 +26,13 @@ import gc
 import argparse
 import asyncio
 import atexit
+import base64
+import hashlib
 import json
+from collections import OrderedDict
 from typing import List
 import uuid
-from threading import Thread
+from threading import Lock, Thread
 from fastapi import FastAPI, Request, BackgroundTasks
 from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import StreamingResponse, JSONResponse
@@ -73,6 +76,8 @@ class BigDLLLMWorker(BaseModelWorker):
         load_low_bit_model: bool = False,
         stream_interval: int = 4,
         benchmark: str = "true",
+        embed_batch_size: int = 32,
+        embed_cache_size: int = 10000,
     ):
         super().__init__(
             controller_addr,
@@ -112,6 +117,11 @@ class BigDLLLMWorker(BaseModelWorker):
         self.stream_interval = stream_interval
         self.context_len = get_context_length(self.model.config)
         self.embed_in_truncate = embed_in_truncate
+        self.embed_batch_size = embed_batch_size
+        # LRU cache of normalized embeddings keyed by the sha256 of their input text
+        self.embed_cache_size = embed_cache_size
+        self.embed_cache = OrderedDict()
+        self.embed_cache_lock = Lock()
         if not no_register:
             self.init_heart_beat()
 
@@ -135,13 +145,80 @@ class BigDLLLMWorker(BaseModelWorker):
         if hasattr(self.model, "use_cls_pooling") and self.model.use_cls_pooling:
             sum_embeddings = data[:, 0]
         else:
-            mask = attention_mask.unsqueeze(-1).expand(data.size()).float()
-            masked_embeddings = data * mask
-            sum_embeddings = torch.sum(masked_embeddings, dim=1)
-        token_num = torch.sum(attention_mask).item()
+            # masked sum as a batched matmul, the mask is never expanded to hidden size
+            mask = attention_mask.unsqueeze(1).to(data.dtype)
+            sum_embeddings = torch.bmm(mask, data).squeeze(1)
+        token_num = attention_mask.sum(dim=1, keepdim=True)
 
         return sum_embeddings, token_num
 
+    def __encode_base64(self, embeddings: torch.Tensor) -> List[str]:
+        embeddings = embeddings.cpu()
+        return [
+            base64.b64encode(e.numpy().tobytes()).decode("utf-8") for e in embeddings
+        ]
+
+    def __embed_bucket(self, bucket_input_ids, **model_type_dict):
+        # Right pad inputs of similar length and embed them with one forward per chunk
+        use_cls_pooling = hasattr(self.model, "use_cls_pooling") and self.model.use_cls_pooling
+        pad_token_id = self.tokenizer.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = 0
+        max_len = max(len(ids) for ids in bucket_input_ids)
+        input_ids = torch.full((len(bucket_input_ids), max_len), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(bucket_input_ids), max_len), dtype=torch.long)
+        for i, ids in enumerate(bucket_input_ids):
+            input_ids[i, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[i, :len(ids)] = 1
+        input_ids = input_ids.to(self.device)
+        attention_mask = attention_mask.to(self.device)
+
+        if self.embed_in_truncate:
+            embedding, token_num = self.__process_embed_chunk(
+                input_ids, attention_mask, **model_type_dict
+            )
+            if not use_cls_pooling:
+                embedding = embedding / token_num
+            return F.normalize(embedding.float(), p=2, dim=1), token_num.squeeze(1)
+
+        embedding = 0
+        all_token_num = 0
+        for i in range(0, max_len, self.context_len):
+            chunk_input_ids = input_ids[:, i:i + self.context_len]
+            chunk_attention_mask = attention_mask[:, i:i + self.context_len]
+            token_num = chunk_attention_mask.sum(dim=1, keepdim=True)
+
+            # add cls token and mask to get cls embedding
+            if use_cls_pooling:
+                cls_tokens = (
+                    torch.zeros(
+                        (chunk_input_ids.size(0), 1),
+                        dtype=chunk_input_ids.dtype,
+                        device=chunk_input_ids.device,
+                    )
+                    + self.tokenizer.cls_token_id
+                )
+                chunk_input_ids = torch.cat([cls_tokens, chunk_input_ids], dim=-1)
+                mask = torch.ones(
+                    (chunk_attention_mask.size(0), 1),
+                    dtype=chunk_attention_mask.dtype,
+                    device=chunk_attention_mask.device,
+                )
+                chunk_attention_mask = torch.cat([mask, chunk_attention_mask], dim=-1)
+
+            chunk_embeddings, _ = self.__process_embed_chunk(
+                chunk_input_ids, chunk_attention_mask, **model_type_dict
+            )
+            if use_cls_pooling:
+                # weight cls embeddings of chunks by their token num,
+                # so chunks which are all padding of shorter inputs are ignored
+                chunk_embeddings = chunk_embeddings * token_num
+            embedding = embedding + chunk_embeddings
+            all_token_num = all_token_num + token_num
+
+        embedding = embedding / all_token_num
+        return F.normalize(embedding.float(), p=2, dim=1), all_token_num.squeeze(1)
+
     @torch.inference_mode()
     def get_embeddings(self, params):
         self.call_ct += 1
@@ -160,85 +237,61 @@ class BigDLLLMWorker(BaseModelWorker):
                 "is_robert": "robert" in str(type(self.model)),
             }
 
-            if self.embed_in_truncate:
-                encoding = tokenizer.batch_encode_plus(
-                    params["input"],
-                    padding=True,
-                    truncation="longest_first",
-                    return_tensors="pt",
-                    max_length=self.context_len,
-                )
-            else:
-                encoding = tokenizer.batch_encode_plus(
-                    params["input"], padding=True, return_tensors="pt"
-                )
-            input_ids = encoding["input_ids"].to(self.device)
-            # Check if we need attention_mask or not.
-            attention_mask = input_ids != tokenizer.pad_token_id
-
-            base64_encode = params.get("encoding_format", None)
-
-            if self.embed_in_truncate:
-                embedding, token_num = self.__process_embed_chunk(
-                    input_ids, attention_mask, **model_type_dict
-                )
-                if (
-                    not hasattr(self.model, "use_cls_pooling")
-                    or not self.model.use_cls_pooling
-                ):
-                    embedding = embedding / token_num
-                normalized_embeddings = F.normalize(embedding, p=2, dim=1)
-                ret["token_num"] = token_num
-            else:
-                all_embeddings = []
-                all_token_num = 0
-                for i in range(0, input_ids.size(1), self.context_len):
-                    chunk_input_ids = input_ids[:, i:i + self.context_len]
-                    chunk_attention_mask = attention_mask[:, i:i + self.context_len]
-
-                    # add cls token and mask to get cls embedding
-                    if (
-                        hasattr(self.model, "use_cls_pooling")
-                        and self.model.use_cls_pooling
-                    ):
-                        cls_tokens = (
-                            torch.zeros(
-                                (chunk_input_ids.size(0), 1),
-                                dtype=chunk_input_ids.dtype,
-                                device=chunk_input_ids.device,
-                            )
-                            + tokenizer.cls_token_id
-                        )
-                        chunk_input_ids = torch.cat(
-                            [cls_tokens, chunk_input_ids], dim=-1
-                        )
-                        mask = torch.ones(
-                            (chunk_attention_mask.size(0), 1),
-                            dtype=chunk_attention_mask.dtype,
-                            device=chunk_attention_mask.device,
-                        )
-                        chunk_attention_mask = torch.cat(
-                            [mask, chunk_attention_mask], dim=-1
-                        )
-
-                    chunk_embeddings, token_num = self.__process_embed_chunk(
-                        chunk_input_ids, chunk_attention_mask, **model_type_dict
-                    )
-                    if (
-                        hasattr(self.model, "use_cls_pooling")
-                        and self.model.use_cls_pooling
-                    ):
-                        all_embeddings.append(chunk_embeddings * token_num)
+            inputs = params["input"]
+            if isinstance(inputs, str):
+                inputs = [inputs]
+            embeddings = [None] * len(inputs)
+            token_nums = [0] * len(inputs)
+
+            # Reuse cached embeddings of identical inputs
+            keys = [hashlib.sha256(text.encode("utf-8")).hexdigest() for text in inputs]
+            missed = {}
+            with self.embed_cache_lock:
+                for i, key in enumerate(keys):
+                    if key in self.embed_cache:
+                        self.embed_cache.move_to_end(key)
+                        embeddings[i], token_nums[i] = self.embed_cache[key]
                     else:
-                        all_embeddings.append(chunk_embeddings)
-                    all_token_num += token_num
-
-                all_embeddings_tensor = torch.stack(all_embeddings)
-                embedding = torch.sum(all_embeddings_tensor, dim=0) / all_token_num
-                normalized_embeddings = F.normalize(embedding, p=2, dim=1)
-
-                ret["token_num"] = all_token_num
+                        missed.setdefault(key, []).append(i)
+
+            if missed:
+                texts = [inputs[indices[0]] for indices in missed.values()]
+                if self.embed_in_truncate:
+                    encoding = tokenizer(
+                        texts,
+                        truncation="longest_first",
+                        max_length=self.context_len,
+                    )
+                else:
+                    encoding = tokenizer(texts)
+                all_input_ids = encoding["input_ids"]
+
+                # Sort inputs by length and split them into buckets,
+                # so each forward only pads to the longest input of its bucket
+                order = sorted(range(len(texts)), key=lambda i: len(all_input_ids[i]))
+                missed_indices = list(missed.values())
+                missed_keys = list(missed.keys())
+                for start in range(0, len(order), self.embed_batch_size):
+                    bucket = order[start:start + self.embed_batch_size]
+                    bucket_embeddings, bucket_token_nums = self.__embed_bucket(
+                        [all_input_ids[i] for i in bucket], **model_type_dict
+                    )
+                    bucket_embeddings = bucket_embeddings.cpu()
+                    bucket_token_nums = bucket_token_nums.tolist()
+                    with self.embed_cache_lock:
+                        for j, i in enumerate(bucket):
+                            value = (bucket_embeddings[j], bucket_token_nums[j])
+                            for index in missed_indices[i]:
+                                embeddings[index], token_nums[index] = value
+                            if self.embed_cache_size > 0:
+                                self.embed_cache[missed_keys[i]] = value
+                                if len(self.embed_cache) > self.embed_cache_size:
+                                    self.embed_cache.popitem(last=False)
+
+            normalized_embeddings = torch.stack(embeddings)
+            ret["token_num"] = sum(token_nums)
 
+            base64_encode = params.get("encoding_format", None)
             if base64_encode == "base64":
                 out_embeddings = self.__encode_base64(normalized_embeddings)
             else:
@@ -518,6 +571,18 @@ if __name__ == "__main__":
         help="Load models that have been converted/saved using ipex-llm's save_low_bit interface",
     )
     parser.add_argument("--embed-in-truncate", action="store_true")
+    parser.add_argument(
+        "--embed-batch-size",
+        type=int,
+        default=32,
+        help="Max number of inputs embedded in one forward, inputs are bucketed by length",
+    )
+    parser.add_argument(
+        "--embed-cache-size",
+        type=int,
+        default=10000,
+        help="Number of embeddings cached by input content, 0 to disable the cache",
+    )
 
     args = parser.parse_args()
     worker = BigDLLLMWorker(
@@ -537,5 +602,7 @@ if __name__ == "__main__":
         args.load_low_bit_model,
         args.stream_interval,
         args.benchmark,
+        args.embed_batch_size,
+        args.embed_cache_size,
     )
     uvicorn.run(app, host=args.host, port=args.port, log_level="info")
@@ -52,6 +52,7 @@ from typing import List, Optional, Tuple, Union
 from types import MethodType
 import subprocess
 import sys
+import time
 
 _IS_VLLM_AVAILABLE = None
 _USE_VLLM = False
@@ -469,6 +470,76 @@ def use_scale_search(model_config, qtype):
     return False
 
 
+class LowBitQuantizer:
+    """
+    Quantize the weights of `LowBitLinear` in a thread pool.
+
+    The ggml quantize kernels are called through ctypes and release the GIL, so layers
+    are quantized concurrently. At most `max_inflight_bytes` of fp32 weight are being
+    quantized at the same time, and the quantized weight is written back into its module
+    (and moved to the target device) in submission order.
+    """
+
+    def __init__(self, num_threads: int, max_inflight_bytes: int):
+        from concurrent.futures import ThreadPoolExecutor
+        from collections import deque
+        self.executor = ThreadPoolExecutor(max_workers=num_threads)
+        self.max_inflight_bytes = max_inflight_bytes
+        self.inflight_bytes = 0
+        self.pending = deque()
+        self.layer_times = []
+
+    @staticmethod
+    def _quantize(param):
+        start = time.perf_counter()
+        param.quantize("cpu")
+        return time.perf_counter() - start
+
+    def submit(self, module, param, device, name):
+        nbytes = param.data.numel() * 4
+        while self.pending and self.inflight_bytes + nbytes > self.max_inflight_bytes:
+            self._finish_oldest()
+        future = self.executor.submit(self._quantize, param)
+        self.pending.append((future, module, param, device, name, nbytes))
+        self.inflight_bytes += nbytes
+
+    def _finish_oldest(self):
+        future, module, param, device, name, nbytes = self.pending.popleft()
+        self.layer_times.append((name, future.result()))
+        module._parameters['weight'] = param.to(device)
+        self.inflight_bytes -= nbytes
+
+    def shutdown(self):
+        # drop the layers not written back yet, e.g. when the conversion failed
+        for future, *_ in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.inflight_bytes = 0
+        self.executor.shutdown()
+
+    def wait(self):
+        while self.pending:
+            self._finish_oldest()
+        self.executor.shutdown()
+        if self.layer_times:
+            for name, seconds in self.layer_times:
+                logger.debug(f"Quantized {name} in {seconds * 1000:.1f} ms")
+            slowest = max(self.layer_times, key=lambda t: t[1])
+            logger.info(f"Quantized {len(self.layer_times)} linear layers, "
+                        f"{sum(t for _, t in self.layer_times):.2f}s in total, "
+                        f"the slowest is {slowest[0]} ({slowest[1]:.2f}s)")
+
+
+def get_low_bit_quantizer(convert_shape_only=False):
+    # opt-in with `IPEX_LLM_QUANTIZE_THREADS` > 1, as up to
+    # `IPEX_LLM_QUANTIZE_INFLIGHT_BYTES` (4GB by default) more memory may be used
+    num_threads = int(os.environ.get("IPEX_LLM_QUANTIZE_THREADS", "1"))
+    if convert_shape_only or num_threads <= 1:
+        return None
+    max_inflight_bytes = int(os.environ.get("IPEX_LLM_QUANTIZE_INFLIGHT_BYTES", 4 << 30))
+    return LowBitQuantizer(num_threads, max_inflight_bytes)
+
+
 def _replace_with_low_bit_linear(model, qtype, modules_to_not_convert=None,
                                  convert_shape_only=False,
                                  cpu_embedding=False,
@@ -478,6 +549,7 @@ def _replace_with_low_bit_linear(model, qtype, modules_to_not_convert=None,
                                  mixed_precision=False,
                                  act_order=False,
                                  enable_scale_search=False,
+                                 quantizer=None,
                                  ):
     from ipex_llm.transformers.low_bit_linear import LowBitLinear, FP4Params, \
         FP16Linear, BF16Linear
@@ -657,8 +729,13 @@ def _replace_with_low_bit_linear(model, qtype, modules_to_not_convert=None,
                                              qtype=cur_qtype,
                                              imatrix=cur_imatrix,
                                              in_features=in_features,
-                                             enable_scale_search=enable_scale_search).to(device)
-                    new_linear._parameters['weight'] = paramsLowBit
+                                             enable_scale_search=enable_scale_search)
+                    if quantizer is not None and device.type == "cpu":
+                        # quantized in background, written back by `quantizer.wait()`
+                        new_linear._parameters['weight'] = paramsLowBit
+                        quantizer.submit(new_linear, paramsLowBit, device, full_module_name)
+                    else:
+                        new_linear._parameters['weight'] = paramsLowBit.to(device)
                     if module.bias is not None:
                         new_linear._parameters['bias'] = nn.Parameter(module.bias.data)\
                             .to(device)
@@ -747,6 +824,7 @@ def _replace_with_low_bit_linear(model, qtype, modules_to_not_convert=None,
                 mixed_precision=mixed_precision,
                 act_order=act_order,
                 enable_scale_search=enable_scale_search,
+                quantizer=quantizer,
             )
             has_been_replaced = _flag or has_been_replaced
     return model, has_been_replaced
@@ -1142,17 +1220,25 @@ def ggml_convert_low_bit(model, qtype, optimize_model=True,
 
     # mixed quantization needs model_config to choose custom quantization strategy
     if qtype is not None:
-        model, has_been_replaced = _replace_with_low_bit_linear(
-            model, qtype, modules_to_not_convert,
-            convert_shape_only, cpu_embedding,
-            imatrix_data=imatrix_data,
-            embedding_qtype=embedding_qtype,
-            model_config=model_config,
-            torch_dtype=torch_dtype,
-            mixed_precision=mixed_precision,
-            act_order=act_order,
-            enable_scale_search=enable_scale_search,
-        )
+        quantizer = get_low_bit_quantizer(convert_shape_only)
+        try:
+            model, has_been_replaced = _replace_with_low_bit_linear(
+                model, qtype, modules_to_not_convert,
+                convert_shape_only, cpu_embedding,
+                imatrix_data=imatrix_data,
+                embedding_qtype=embedding_qtype,
+                model_config=model_config,
+                torch_dtype=torch_dtype,
+                mixed_precision=mixed_precision,
+                act_order=act_order,
+                enable_scale_search=enable_scale_search,
+                quantizer=quantizer,
+            )
+            if quantizer is not None:
+                quantizer.wait()
+        finally:
+            if quantizer is not None:
+                quantizer.shutdown()
         if not has_been_replaced:
             warnings.warn(
                 "No linear modules were found in "
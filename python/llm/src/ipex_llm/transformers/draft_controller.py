@@ -0,0 +1,208 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import json
+import logging
+import threading
+from typing import List, Optional, Union
+from ipex_llm.utils.common import invalidInputError
+
+logger = logging.getLogger("ipex_llm.draft_controller")
+
+_state_lock = threading.Lock()
+
+
+class DraftLengthController:
+    """
+    Chooses the draft length of speculative and lookup decoding online.
+
+    Every verify step reports how many tokens were drafted and accepted and how long
+    drafting and verification took. The controller keeps exponentially decayed
+    statistics of
+
+    - the per-token acceptance rate `a`, assuming draft tokens are accepted independently,
+    - the latency of drafting one token `t_d`,
+    - a linear fit `t_v(n) = t0 + t1 * n` of the target forward over `n` verified tokens,
+
+    and picks the length `k` maximizing the expected accepted tokens per second
+    `(1 - a^(k + 1)) / (1 - a) / (k * t_d + t_v(k + 1))`.
+
+    Any object with the same `next_length` and `update` methods can be passed to
+    `generate(draft_controller=...)` instead. With batch size > 1, `update` receives
+    the accepted numbers of all unfinished rows as a list.
+
+    :param min_length: the minimum draft length.
+    :param max_length: the maximum draft length.
+    :param decay: weight of the previous statistics in every update.
+    :param explore_interval: every `explore_interval` steps a neighbour of the best length
+           is drafted, so that the latency fit sees different lengths.
+    :param path: json file the tuned statistics are loaded from and saved to.
+    :param key: entry of this model in `path`.
+    """
+
+    def __init__(self, min_length: int = 1, max_length: int = 8, decay: float = 0.9,
+                 explore_interval: int = 8, path: Optional[str] = None,
+                 key: Optional[str] = None):
+        invalidInputError(0 < min_length <= max_length,
+                          f"Invalid draft length range [{min_length}, {max_length}]")
+        invalidInputError(0.0 <= decay < 1.0, f"decay should be in [0, 1), but got {decay}")
+        self.min_length = min_length
+        self.max_length = max_length
+        self.decay = decay
+        self.explore_interval = explore_interval
+        self.path = path
+        self.key = key
+        self.num_steps = 0
+        # one accepted and one rejected token as prior
+        self.accepted = 1.0
+        self.rejected = 1.0
+        self.draft_weight = 0.0
+        self.draft_token_time = 0.0
+        # decayed sums of the verify latency regression
+        self.verify_sums = [0.0] * 5    # w, w * n, w * t, w * n * n, w * n * t
+        self.best_length = (min_length + max_length) // 2
+
+    def acceptance_rate(self) -> float:
+        return self.accepted / (self.accepted + self.rejected)
+
+    def verify_latency(self, num_tokens: int) -> float:
+        w, wn, wt, wnn, wnt = self.verify_sums
+        if w == 0:
+            return 1.0
+        var = wnn * w - wn * wn
+        slope = (wnt * w - wn * wt) / var if var > 1e-6 * w * w else 0.0
+        slope = max(slope, 0.0)
+        intercept = max((wt - slope * wn) / w, 0.0)
+        return intercept + slope * num_tokens
+
+    def expected_throughput(self, length: int) -> float:
+        a = min(self.acceptance_rate(), 1.0 - 1e-6)
+        expected_tokens = (1 - a ** (length + 1)) / (1 - a)
+        latency = length * self.draft_token_time + self.verify_latency(length + 1)
+        return expected_tokens / max(latency, 1e-9)
+
+    def next_length(self) -> int:
+        self.num_steps += 1
+        length = self.best_length
+        if self.explore_interval > 0 and self.num_steps % self.explore_interval == 0:
+            step = 1 if (self.num_steps // self.explore_interval) % 2 else -1
+            length = min(max(length + step, self.min_length), self.max_length)
+        return length
+
+    def update(self, num_drafted: int, num_accepted: Union[int, List[int]],
+               draft_time: float, verify_time: float):
+        """
+        Record a verify step which drafted `num_drafted` tokens and accepted
+        `num_accepted` of them, excluding the token generated by the target model.
+        `num_accepted` is a list of the accepted numbers of every row for a batched step.
+        """
+        if not isinstance(num_accepted, (list, tuple)):
+            num_accepted = [num_accepted]
+        d = self.decay
+        self.accepted = self.accepted * d + sum(num_accepted)
+        self.rejected = self.rejected * d + sum(1 for num in num_accepted if num < num_drafted)
+        if num_drafted > 0:
+            self.draft_weight = self.draft_weight * d + 1
+            self.draft_token_time += (draft_time / num_drafted - self.draft_token_time) \
+                / self.draft_weight
+        n = num_drafted + 1
+        self.verify_sums = [s * d + x for s, x in zip(self.verify_sums,
+                                                      (1, n, verify_time, n * n,
+                                                       n * verify_time))]
+        self.best_length = max(range(self.min_length, self.max_length + 1),
+                               key=self.expected_throughput)
+
+    def state_dict(self):
+        return {
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "draft_weight": self.draft_weight,
+            "draft_token_time": self.draft_token_time,
+            "verify_sums": self.verify_sums,
+            "best_length": self.best_length,
+        }
+
+    def load_state_dict(self, state):
+        self.accepted = state["accepted"]
+        self.rejected = state["rejected"]
+        self.draft_weight = state["draft_weight"]
+        self.draft_token_time = state["draft_token_time"]
+        self.verify_sums = list(state["verify_sums"])
+        self.best_length = min(max(state["best_length"], self.min_length), self.max_length)
+
+    def load(self):
+        """Start from the statistics saved for `key` in `path`, if any"""
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                state = json.load(f).get(self.key, None)
+            if state is not None:
+                self.load_state_dict(state)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Failed to load draft length statistics from {self.path}: {e}")
+
+    def save(self):
+        """Save the statistics as `key` in `path`, keeping the entries of other models"""
+        if self.path is None:
+            return
+        with _state_lock:
+            try:
+                states = {}
+                if os.path.exists(self.path):
+                    with open(self.path, "r") as f:
+                        states = json.load(f)
+                states[self.key] = self.state_dict()
+                tmp_path = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(states, f, indent=2)
+                os.replace(tmp_path, self.path)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Failed to save draft length statistics to {self.path}: {e}")
+
+
+def get_draft_controller(model, draft_controller, mode: str,
+                         min_length: int, max_length: int):
+    """
+    Resolve the `draft_controller` argument of speculative and lookup generate.
+
+    `None` follows `IPEX_LLM_DRAFT_CONTROLLER=1`, `True` creates a `DraftLengthController`
+    which persists its statistics in `IPEX_LLM_DRAFT_CONTROLLER_PATH` if set, `False`
+    keeps the fixed heuristics, any other object is used as the controller.
+    """
+    if draft_controller is None:
+        draft_controller = os.environ.get("IPEX_LLM_DRAFT_CONTROLLER", "0") == "1"
+    if draft_controller is False:
+        return None
+    if draft_controller is not True:
+        return draft_controller
+    name = getattr(model.config, "_name_or_path", "") or model.config.model_type
+    controller = DraftLengthController(
+        min_length=min_length, max_length=max_length,
+        path=os.environ.get("IPEX_LLM_DRAFT_CONTROLLER_PATH", None),
+        key=f"{name}:{model.device.type}:{mode}"
+    )
+    controller.load()
+    return controller
+
+
+def accept_histogram(accept_num: List[int]) -> List[int]:
+    """`accept_histogram(accept_num)[i]` is the number of verify steps accepting i tokens"""
+    hist = [0] * (max(accept_num, default=0) + 1)
+    for num in accept_num:
+        hist[num] += 1
+    return hist
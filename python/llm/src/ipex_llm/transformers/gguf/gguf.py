@@ -18,16 +18,24 @@
 # and https://github.com/ggerganov/llama.cpp/blob/master/ggml-quants.c
 # and https://github.com/ggerganov/llama.cpp/blob/master/llama.cpp
 
+import os
+import mmap
 import struct
 import functools
 import torch
-import numpy
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from io import BufferedReader
 from tqdm import tqdm
+from ipex_llm.ggml.quantize import ggml_tensor_qtype
 from ipex_llm.utils.common import invalidInputError
 
 
+K_QUANTS = [ggml_tensor_qtype["q2_k"], ggml_tensor_qtype["q4_k"],
+            ggml_tensor_qtype["q5_k"], ggml_tensor_qtype["q6_k"]]
+
+
 class GGUFReader:
     def __init__(self, f: BufferedReader):
         self.f = f
@@ -193,12 +201,12 @@ class GGUFTensorLoader:
             7: 24,      # q5_1
             8: 34,      # q8_0
             9: 40,      # q8_1
-            10: 0,      # q2_k
-            11: 0,      # q3_k
-            12: 0,      # q4_k
-            13: 0,      # q5_k
+            10: 84,     # q2_k
+            11: 110,    # q3_k
+            12: 144,    # q4_k
+            13: 176,    # q5_k
             14: 210,    # q6_k
-            15: 0,      # q8_k
+            15: 292,    # q8_k
             16: 1,      # i8
             17: 2,      # i16
             18: 4,      # i32
@@ -213,56 +221,103 @@ class GGUFTensorLoader:
             7: self.convert_q5_1_tensor,        # q5_1
             8: self.convert_q8_0_tensor,        # q8_0
             9: self.convert_unknown_tensor,     # q8_1
-            10: self.convert_unknown_tensor,    # q2_k
-            11: self.convert_unknown_tensor,    # q3_k
-            12: self.convert_unknown_tensor,    # q4_k
-            13: self.convert_unknown_tensor,    # q5_k
+            10: self.convert_q2_k_tensor,       # q2_k
+            11: self.convert_q3_k_tensor,       # q3_k
+            12: self.convert_q4_k_tensor,       # q4_k
+            13: self.convert_q5_k_tensor,       # q5_k
             14: self.convert_q6_k_tensor,       # q6_k
-            15: self.convert_unknown_tensor,    # q8_k
+            15: self.convert_q8_k_tensor,       # q8_k
             16: self.convert_unknown_tensor,    # i8
             17: self.convert_unknown_tensor,    # i16
             18: self.convert_unknown_tensor,    # i32
         }
 
+        # gguf qtypes whose block layout is the same as an ipex-llm qtype,
+        # their blocks can be used by `LowBitLinear` as is
+        self.native_qtypes = {
+            2: ggml_tensor_qtype["sym_int4"],   # q4_0
+            3: ggml_tensor_qtype["asym_int4"],  # q4_1
+            6: ggml_tensor_qtype["sym_int5"],   # q5_0
+            7: ggml_tensor_qtype["asym_int5"],  # q5_1
+            8: ggml_tensor_qtype["sym_int8"],   # q8_0
+            10: ggml_tensor_qtype["q2_k"],      # q2_k
+            12: ggml_tensor_qtype["q4_k"],      # q4_k
+            13: ggml_tensor_qtype["q5_k"],      # q5_k
+            14: ggml_tensor_qtype["q6_k"],      # q6_k
+        }
+
         self.fpath = fpath
         self.infos = tensor_infos.infos
         self.base_offset = tensor_infos.base_offset
+        self.num_threads = int(os.environ.get("IPEX_LLM_GGUF_LOAD_THREADS",
+                                              min(8, os.cpu_count() or 1)))
+
+    def _tensor_size(self, dims, qtype):
+        total_ne = functools.reduce(lambda x, y: x * y, dims)
+        invalidInputError(total_ne % self.block_ne[qtype] == 0,
+                          f"wrong elements num: {dims}")
+
+        size = total_ne // self.block_ne[qtype] * self.block_size[qtype]
+        invalidInputError(size != 0, f"unsupported quantize type: {qtype}")
+        return size
+
+    def _keep_quantized(self, ndims, gguf_qtype, qtype):
+        native_qtype = self.native_qtypes.get(gguf_qtype, None)
+        if qtype is None or ndims != 2 or native_qtype is None:
+            return False
+        # k-quants are mixed per tensor, e.g. q4_k_m also contains q6_k tensors
+        return native_qtype == qtype or (native_qtype in K_QUANTS and qtype in K_QUANTS)
+
+    def _convert(self, buffer, ndims, dims, gguf_qtype, offset, qtype=None):
+        size = self._tensor_size(dims, gguf_qtype)
+        offset += self.base_offset
+        # a view of the mmapped file, f32 and f16 tensors are returned without any copy
+        tensor = buffer[offset:offset + size]
+        if self._keep_quantized(ndims, gguf_qtype, qtype):
+            dequantize = functools.partial(self.convert_funcs[gguf_qtype],
+                                           size=size, ndims=ndims, dims=dims)
+            return GGUFQuantizedTensor(tensor.reshape(dims[0], -1), dims,
+                                       self.native_qtypes[gguf_qtype], dequantize)
+        return self.convert_funcs[gguf_qtype](tensor, size, ndims, dims)
+
+    def _iter_tensors(self, qtype=None):
+        with open(self.fpath, 'rb') as f:
+            # copy-on-write mapping, so callers may modify the returned tensors in place
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        buffer = torch.frombuffer(mm, dtype=torch.uint8)
+
+        # dequantize tensors in a thread pool (torch ops release the GIL), while keeping
+        # at most `2 * num_threads` converted tensors in flight to bound memory usage
+        num_threads = self.num_threads
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            infos = iter(self.infos)
+            pending = deque()
+
+            def submit_next():
+                info = next(infos, None)
+                if info is not None:
+                    name, ndims, dims, gguf_qtype, offset = info
+                    future = executor.submit(self._convert, buffer, ndims, dims, gguf_qtype,
+                                             offset, qtype)
+                    pending.append((name, future))
+
+            for _ in range(2 * num_threads):
+                submit_next()
+            for _ in tqdm(range(len(self.infos)), desc="Loading gguf tensors"):
+                name, future = pending.popleft()
+                submit_next()
+                yield name, future.result()
 
     def __iter__(self):
-        with open(self.fpath, 'rb') as f:
-            for name, ndims, dims, qtype, offset in tqdm(self.infos, desc="Loading gguf tensors"):
-                total_ne = functools.reduce(lambda x, y: x * y, dims)
-                invalidInputError(total_ne % self.block_ne[qtype] == 0,
-                                  f"wrong elements num: {dims}")
-
-                size = total_ne // self.block_ne[qtype] * self.block_size[qtype]
-                invalidInputError(size != 0, f"unsupported quantize type: {qtype}")
-
-                offset += self.base_offset
-                f.seek(offset)
-                data = f.read(size)
-                arr = numpy.frombuffer(data, dtype=numpy.uint8).copy()
-                tensor = torch.from_numpy(arr)
-                tensor = self.convert_funcs[qtype](tensor, size, ndims, dims)
-                yield name, tensor
-
-    def load_while_process(self, process):
-        with open(self.fpath, 'rb') as f:
-            for name, ndims, dims, qtype, offset in tqdm(self.infos, desc="Loading gguf tensors"):
-                total_ne = functools.reduce(lambda x, y: x * y, dims)
-                invalidInputError(total_ne % self.block_ne[qtype] == 0,
-                                  f"wrong elements num: {dims}")
-
-                size = total_ne // self.block_ne[qtype] * self.block_size[qtype]
-                invalidInputError(size != 0, f"unsupported quantize type: {qtype}")
-
-                offset += self.base_offset
-                f.seek(offset)
-                data = f.read(size)
-                arr = numpy.frombuffer(data, dtype=numpy.uint8)
-                tensor = torch.from_numpy(arr)
-                tensor = self.convert_funcs[qtype](tensor, size, ndims, dims)
-                process(name, tensor)
+        return self._iter_tensors()
+
+    def load_while_process(self, process, qtype=None):
+        # `process` runs on the caller thread in file order, overlapping with the
+        # dequantization of the following tensors.
+        # If `qtype` is given, 2D tensors which can be used by a `qtype` `LowBitLinear`
+        # without requantization are passed as `GGUFQuantizedTensor`.
+        for name, tensor in self._iter_tensors(qtype):
+            process(name, tensor)
 
     def convert_f32_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
         return tensor.view(torch.float)
@@ -366,10 +421,219 @@ class GGUFTensorLoader:
         result = result.reshape(dims)
         return result
 
+    def convert_q2_k_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
+        # see https://github.com/ggerganov/llama.cpp/blob
+        # /8e672efe632bb6a7333964a255c4b96f018b9a65/ggml-quants.c#L1864
+
+        block_size = self.block_size[10]
+        tensor = tensor.reshape((-1, block_size))
+        scales, qs, d, dmin = (tensor[:, :16], tensor[:, 16:80],
+                               tensor[:, 80:82], tensor[:, 82:84])
+        # each byte of qs holds 4 values, which are 32 elements apart
+        shift = torch.arange(0, 8, 2, dtype=torch.uint8).reshape(1, 1, 4, 1)
+        data = ((qs.reshape(-1, 2, 1, 32) >> shift) & 3).reshape(-1, 16, 16)
+        d = d.view(torch.half) * (scales & 0xF)
+        dmin = dmin.view(torch.half) * (scales >> 4)
+        result = data * d.unsqueeze(-1) - dmin.unsqueeze(-1)
+        result = result.reshape(dims)
+        return result
+
+    def convert_q3_k_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
+        # see https://github.com/ggerganov/llama.cpp/blob
+        # /8e672efe632bb6a7333964a255c4b96f018b9a65/ggml-quants.c#L2118
+
+        block_size = self.block_size[11]
+        tensor = tensor.reshape((-1, block_size))
+        hmask, qs, scales, d = (tensor[:, :32], tensor[:, 32:96],
+                                tensor[:, 96:108], tensor[:, 108:110])
+        # 16 6-bit scales, low 4 bits in the first 8 bytes, high 2 bits in the last 4 bytes
+        low = torch.cat([scales[:, :8] & 0xF, scales[:, :8] >> 4], dim=-1)
+        high = scales[:, 8:].unsqueeze(1) >> torch.arange(0, 8, 2, dtype=torch.uint8).reshape(4, 1)
+        high = (high & 3).reshape(-1, 16)
+        scales = (low | (high << 4)).view(torch.int8) - 32
+
+        shift = torch.arange(0, 8, 2, dtype=torch.uint8).reshape(1, 1, 4, 1)
+        data = ((qs.reshape(-1, 2, 1, 32) >> shift) & 3).reshape(-1, 256)
+        # the high bit is stored inverted, a cleared bit means subtracting 4
+        hbit = torch.arange(0, 8, dtype=torch.uint8).reshape(1, 8, 1)
+        hdata = ((hmask.unsqueeze(1) >> hbit) & 1).reshape(-1, 256)
+        data = data.view(torch.int8) - ((1 - hdata) << 2).view(torch.int8)
+        result = data.reshape(-1, 16, 16) * (d.view(torch.half) * scales).unsqueeze(-1)
+        result = result.reshape(dims)
+        return result
+
+    def get_scale_min_k4(self, scales: torch.Tensor):
+        # see https://github.com/ggerganov/llama.cpp/blob
+        # /8e672efe632bb6a7333964a255c4b96f018b9a65/ggml-quants.c#L2360
+        sc = torch.cat([scales[:, :4] & 63,
+                        (scales[:, 8:] & 0xF) | ((scales[:, :4] >> 6) << 4)], dim=-1)
+        m = torch.cat([scales[:, 4:8] & 63,
+                       (scales[:, 8:] >> 4) | ((scales[:, 4:8] >> 6) << 4)], dim=-1)
+        return sc, m
+
+    def convert_q4_k_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
+        # see https://github.com/ggerganov/llama.cpp/blob
+        # /8e672efe632bb6a7333964a255c4b96f018b9a65/ggml-quants.c#L2412
+
+        block_size = self.block_size[12]
+        tensor = tensor.reshape((-1, block_size))
+        d, dmin, scales, qs = (tensor[:, :2], tensor[:, 2:4],
+                               tensor[:, 4:16], tensor[:, 16:])
+        sc, m = self.get_scale_min_k4(scales)
+        qs = qs.reshape(-1, 4, 32)
+        data = torch.cat([qs & 0xF, qs >> 4], dim=-1).reshape(-1, 8, 32)
+        d = d.view(torch.half) * sc
+        dmin = dmin.view(torch.half) * m
+        result = data * d.unsqueeze(-1) - dmin.unsqueeze(-1)
+        result = result.reshape(dims)
+        return result
+
+    def convert_q5_k_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
+        # see https://github.com/ggerganov/llama.cpp/blob
+        # /8e672efe632bb6a7333964a255c4b96f018b9a65/ggml-quants.c#L2618
+
+        block_size = self.block_size[13]
+        tensor = tensor.reshape((-1, block_size))
+        d, dmin, scales, qh, qs = (tensor[:, :2], tensor[:, 2:4], tensor[:, 4:16],
+                                   tensor[:, 16:48], tensor[:, 48:])
+        sc, m = self.get_scale_min_k4(scales)
+        qs = qs.reshape(-1, 4, 32)
+        ldata = torch.cat([qs & 0xF, qs >> 4], dim=-1).reshape(-1, 8, 32)
+        hbit = torch.arange(0, 8, dtype=torch.uint8).reshape(1, 8, 1)
+        hdata = ((qh.unsqueeze(1) >> hbit) & 1) << 4
+        data = ldata | hdata
+        d = d.view(torch.half) * sc
+        dmin = dmin.view(torch.half) * m
+        result = data * d.unsqueeze(-1) - dmin.unsqueeze(-1)
+        result = result.reshape(dims)
+        return result
+
+    def convert_q8_k_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
+        # see https://github.com/ggerganov/llama.cpp/blob
+        # /8e672efe632bb6a7333964a255c4b96f018b9a65/ggml-quants.c#L2891
+
+        block_size = self.block_size[15]
+        tensor = tensor.reshape((-1, block_size))
+        d, qs = tensor[:, :4], tensor[:, 4:260]
+        result = qs.view(torch.int8) * d.view(torch.float)
+        result = result.reshape(dims)
+        return result
+
     def convert_unknown_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
         invalidInputError(False, "Unsupported qtype")
 
 
+class GGUFQuantizedTensor:
+    """
+    Raw gguf blocks of a 2D weight, whose block layout is shared by the ipex-llm
+    `qtype`. Blocks never cross rows, so rows can be reshaped and permuted (e.g. to
+    restore q_proj/k_proj heads) before the blocks are handed to `LowBitLinear`.
+    """
+
+    def __init__(self, data: torch.Tensor, shape, qtype: int, dequantize_fn):
+        # `data` has the shape of the weight, except that the last dim is in bytes
+        self.data = data
+        self.shape = torch.Size(shape)
+        self.qtype = qtype
+        self.dequantize_fn = dequantize_fn
+
+    def reshape(self, *shape):
+        if len(shape) == 1 and isinstance(shape[0], (tuple, list, torch.Size)):
+            shape = shape[0]
+        invalidInputError(shape[-1] == self.shape[-1],
+                          "the last dim of a quantized gguf tensor cannot be reshaped")
+        data = self.data.reshape(*shape[:-1], self.data.size(-1))
+        return GGUFQuantizedTensor(data, shape, self.qtype, self.dequantize_fn)
+
+    def swapaxes(self, axis0, axis1):
+        last = len(self.shape) - 1
+        invalidInputError(axis0 % len(self.shape) != last and axis1 % len(self.shape) != last,
+                          "the last dim of a quantized gguf tensor cannot be swapped")
+        shape = list(self.shape)
+        shape[axis0], shape[axis1] = shape[axis1], shape[axis0]
+        return GGUFQuantizedTensor(self.data.swapaxes(axis0, axis1), shape,
+                                   self.qtype, self.dequantize_fn)
+
+    def dequantize(self):
+        return self.dequantize_fn(self.data.reshape(-1)).reshape(self.shape)
+
+    def same_layout(self):
+        """
+        Whether ipex-llm reads the first row of these blocks as the same values as the
+        gguf dequantization, i.e. the `qtype` block layout is the gguf one.
+        """
+        from ipex_llm.transformers.low_bit_linear import ggml_convert_fp32
+
+        cols = self.shape[-1]
+        row = self.data.reshape(-1, self.data.size(-1))[0].contiguous()
+        expected = self.dequantize_fn(row, size=row.numel(), ndims=1, dims=(cols,)).float()
+        actual = ggml_convert_fp32(row, (cols,), cols, self.qtype)
+        # the gguf dequantization computes in fp16
+        atol = 1e-2 * max(expected.abs().max().item(), 1e-6)
+        return torch.allclose(actual, expected, rtol=1e-2, atol=atol)
+
+    def to_low_bit_linear(self, model, module_name):
+        """
+        Replace the linear module owning `module_name` with a `LowBitLinear` using
+        these blocks as its weight.
+
+        :return: whether the module is replaced, i.e. it is a linear whose weight
+                 has the shape of this tensor, and ipex-llm uses the same block layout.
+        """
+        from accelerate import init_empty_weights
+        from ipex_llm.transformers.convert import is_linear_module
+        from ipex_llm.transformers.low_bit_linear import LowBitLinear, FP4Params, \
+            get_qk_size, ggml
+
+        parent_name, _, param_name = module_name.rpartition(".")
+        module = model.get_submodule(parent_name)
+        is_linear, linear_args = is_linear_module(module)
+        if not is_linear or param_name != "weight" or isinstance(module, LowBitLinear):
+            return False
+        in_features, out_features, mp_group = linear_args
+        if tuple(self.shape) != (out_features, in_features):
+            return False
+        num_blocks = self.shape.numel() // get_qk_size(self.qtype)
+        if num_blocks * ggml.ggml_type_size(self.qtype) != self.data.numel():
+            return False
+        if not self.same_layout():
+            return False
+
+        with init_empty_weights():
+            new_linear = LowBitLinear(in_features, out_features, self.qtype,
+                                      module.bias is not None, mp_group=mp_group)
+        new_linear._parameters['weight'] = FP4Params(data=self.data.reshape(-1).clone(),
+                                                     requires_grad=False,
+                                                     quantized=True,
+                                                     _shape=(out_features, in_features),
+                                                     qtype=self.qtype)
+        if module.bias is not None:
+            new_linear._parameters['bias'] = module.bias
+        new_linear.eval()
+        new_linear.requires_grad_(False)
+
+        grandparent_name, _, child_name = parent_name.rpartition(".")
+        grandparent = model.get_submodule(grandparent_name)
+        grandparent._modules[child_name] = new_linear
+        return True
+
+
+def set_gguf_module_tensor(model, module_name: str, tensor, dtype: torch.dtype, qtype: int):
+    """
+    Set `tensor` loaded by `GGUFTensorLoader.load_while_process` to `module_name`
+    of `model`, and convert the owning linear module to a `qtype` `LowBitLinear`.
+    """
+    from accelerate.utils import set_module_tensor_to_device
+    from ipex_llm.transformers.convert import replace_with_low_bit_linear_for_module
+
+    if isinstance(tensor, GGUFQuantizedTensor):
+        if tensor.to_low_bit_linear(model, module_name):
+            return model
+        tensor = tensor.dequantize()
+    set_module_tensor_to_device(model, module_name, "cpu", tensor, dtype=dtype)
+    return replace_with_low_bit_linear_for_module(model, qtype=qtype, module_name=module_name)
+
+
 class GGUFFileLoader:
     def __init__(self, fpath: str):
         with open(fpath, 'rb') as f:
@@ -17,13 +17,11 @@
 import os
 import torch
 from accelerate import init_empty_weights
-from accelerate.utils import set_module_tensor_to_device
 from tempfile import NamedTemporaryFile
 from transformers import LlamaConfig, LlamaForCausalLM, LlamaTokenizer
 
-from ..gguf import GGUFFileLoader
+from ..gguf import GGUFFileLoader, set_gguf_module_tensor
 from ipex_llm.ggml.quantize import ggml_tensor_qtype
-from ipex_llm.transformers.convert import replace_with_low_bit_linear_for_module
 
 
 def load_gguf_llama(loader: GGUFFileLoader, dtype: torch.dtype = torch.float,
@@ -60,27 +58,21 @@ def load_gguf_llama(loader: GGUFFileLoader, dtype: torch.dtype = torch.float,
         if 'q_proj' in module_name:
             # gguf weight needs to reshape for q_proj
             head, hd_size = tensor.shape[0], tensor.shape[1:]
-            set_module_tensor_to_device(model, module_name, "cpu",
-                                        tensor.reshape(n_head, head // n_head // 2, 2, *hd_size)
-                                              .swapaxes(1, 2)
-                                              .reshape(tensor.shape),
-                                        dtype=dtype)
+            tensor = (tensor.reshape(n_head, head // n_head // 2, 2, *hd_size)
+                            .swapaxes(1, 2)
+                            .reshape(tensor.shape))
         elif 'k_proj' in module_name:
             # gguf weight needs to reshape for k_proj
             head, hd_size = tensor.shape[0], tensor.shape[1:]
-            set_module_tensor_to_device(model, module_name, "cpu",
-                                        tensor.reshape(n_head_kv,
-                                                       head // n_head_kv // 2,
-                                                       2,
-                                                       *hd_size)
-                                              .swapaxes(1, 2)
-                                              .reshape(tensor.shape),
-                                        dtype=dtype)
-        else:
-            set_module_tensor_to_device(model, module_name, "cpu", tensor, dtype=dtype)
-        model = replace_with_low_bit_linear_for_module(model, qtype=qtype, module_name=module_name)
+            tensor = (tensor.reshape(n_head_kv,
+                                     head // n_head_kv // 2,
+                                     2,
+                                     *hd_size)
+                            .swapaxes(1, 2)
+                            .reshape(tensor.shape))
+        model = set_gguf_module_tensor(model, module_name, tensor, dtype, qtype)
     tensor_loader = loader.tensor_loader
-    tensor_loader.load_while_process(process_llama)
+    tensor_loader.load_while_process(process_llama, qtype=qtype)
 
     # see https://github.com/google/sentencepiece/blob/master/src/sentencepiece_model.proto
     from transformers.convert_slow_tokenizer import import_protobuf
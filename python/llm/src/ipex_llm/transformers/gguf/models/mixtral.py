@@ -17,13 +17,11 @@
 import os
 import torch
 from accelerate import init_empty_weights
-from accelerate.utils import set_module_tensor_to_device
 from tempfile import NamedTemporaryFile
 from transformers import MixtralConfig, MixtralForCausalLM, LlamaTokenizer
 
-from ..gguf import GGUFFileLoader
+from ..gguf import GGUFFileLoader, set_gguf_module_tensor
 from ipex_llm.ggml.quantize import ggml_tensor_qtype
-from ipex_llm.transformers.convert import replace_with_low_bit_linear_for_module
 
 
 def load_gguf_mixtral(loader: GGUFFileLoader, dtype: torch.dtype = torch.float,
@@ -81,15 +79,10 @@ def load_gguf_mixtral(loader: GGUFFileLoader, dtype: torch.dtype = torch.float,
                                      *hd_size)
                             .swapaxes(1, 2)
                             .reshape(tensor.shape))
-        set_module_tensor_to_device(model,
-                                    module_name,
-                                    "cpu",
-                                    tensor,
-                                    dtype=dtype)
-        model = replace_with_low_bit_linear_for_module(model, qtype=qtype, module_name=module_name)
+        model = set_gguf_module_tensor(model, module_name, tensor, dtype, qtype)
 
     tensor_loader = loader.tensor_loader
-    tensor_loader.load_while_process(process_mixtral)
+    tensor_loader.load_while_process(process_mixtral, qtype=qtype)
 
     from transformers.convert_slow_tokenizer import import_protobuf
     spm_pb2 = import_protobuf("Failed to import protobuf")
@@ -15,6 +15,11 @@
 #
 
 
+import os
+import mmap
+import bisect
+import tempfile
+import threading
 import torch
 import torch.nn.functional as F
 import torch.nn as nn
@@ -24,13 +29,125 @@ from .models.utils import (
     init_fp8_kv_cache, append_fp8_kv_cache,
     init_kv_cache, append_kv_cache, extend_kv_cache,
     init_unbalanced_fp8_kv_cache, append_unbalanced_fp8_kv_cache,
+    init_cpu_quant_kv_cache, append_cpu_quant_kv_cache, get_cpu_kv_quant_type,
 )
 from typing import Optional, Dict, Tuple, Any, List
+from concurrent.futures import ThreadPoolExecutor
 from transformers.cache_utils import DynamicCache
 from ipex_llm.utils.common.log4Error import invalidInputError
 
 
+class KVCachePool:
+    """
+    Free list of cpu kv cache buffers.
+
+    Buffers released by finished sequences are handed out again to new sequences or
+    batch slots (best fit, at most twice the requested size) instead of going back to
+    the system allocator, which avoids fragmenting memory with large kv caches of
+    many different sizes. At most `max_free_bytes` are kept in the free list.
+    """
+
+    def __init__(self, max_free_bytes: int):
+        self.max_free_bytes = max_free_bytes
+        self.free_bytes = 0
+        # (dtype, device) -> list of (numel, id, flat buffer) sorted by numel
+        self.free_buffers = {}
+        self.lock = threading.Lock()
+
+    def empty(self, shape, dtype: torch.dtype, device: torch.device) -> torch.Tensor:
+        numel = math.prod(shape)
+        with self.lock:
+            buffers = self.free_buffers.get((dtype, device), [])
+            idx = bisect.bisect_left(buffers, (numel,))
+            if idx < len(buffers) and buffers[idx][0] <= 2 * numel:
+                size, _, buffer = buffers.pop(idx)
+                self.free_bytes -= size * buffer.element_size()
+                return buffer[:numel].view(shape)
+        return torch.empty(shape, dtype=dtype, device=device)
+
+    def release(self, tensor: torch.Tensor):
+        buffer = tensor if tensor._base is None else tensor._base
+        if not buffer.is_contiguous() or buffer.numel() == 0:
+            return
+        buffer = buffer.view(-1)
+        with self.lock:
+            buffers = self.free_buffers.setdefault((buffer.dtype, buffer.device), [])
+            bisect.insort(buffers, (buffer.numel(), id(buffer), buffer))
+            self.free_bytes += buffer.numel() * buffer.element_size()
+            while self.free_bytes > self.max_free_bytes:
+                # drop the largest free buffer
+                key = max(self.free_buffers,
+                          key=lambda k: self.free_buffers[k][-1][0] if self.free_buffers[k]
+                          else -1)
+                size, _, largest = self.free_buffers[key].pop()
+                self.free_bytes -= size * largest.element_size()
+
+
+KV_CACHE_POOL = KVCachePool(int(os.environ.get("IPEX_LLM_KV_CACHE_POOL_BYTES", 1 << 30)))
+
+
+def alloc_kv_cache(batch_size, num_heads, head_dim, current_length, max_length, dtype, device):
+    """`init_kv_cache` which takes cpu buffers from `KV_CACHE_POOL`"""
+    if device.type != "cpu":
+        return init_kv_cache(batch_size, num_heads, head_dim,
+                             current_length, max_length, dtype, device)
+    shape = (batch_size, num_heads, max_length, head_dim)
+    key_cache_storage = KV_CACHE_POOL.empty(shape, dtype, device)
+    value_cache_storage = KV_CACHE_POOL.empty(shape, dtype, device)
+    key_cache = key_cache_storage.as_strided((batch_size, num_heads,
+                                              current_length, head_dim),
+                                             key_cache_storage.stride(),
+                                             storage_offset=0)
+    value_cache = value_cache_storage.as_strided((batch_size, num_heads,
+                                                  current_length, head_dim),
+                                                 value_cache_storage.stride(),
+                                                 storage_offset=0)
+    return key_cache, value_cache
+
+
+def rollback_kv_cache(cache: DynamicCache, max_length: int) -> int:
+    """
+    Truncate `cache` to `max_length` tokens, or drop `-max_length` tokens if negative.
+
+    Only the views in `key_cache` and `value_cache` are narrowed, the storage behind them
+    keeps its capacity, so the next append reuses the rolled back slots without copying
+    or reallocating any kv.
+
+    :return: the number of dropped tokens.
+    """
+    cur_length = cache.get_seq_length()
+    if max_length < 0:
+        max_length = cur_length + max_length
+    num_tokens = cur_length - max(max_length, 0)
+    if num_tokens <= 0 or len(cache.key_cache) == 0:
+        return 0
+    # a compressed cache holds fewer tokens than it has seen
+    cached_length = min(k.size(2) for k in cache.key_cache)
+    invalidInputError(num_tokens <= cached_length,
+                      f"Can not roll back {num_tokens} tokens, "
+                      f"only the last {cached_length} tokens are cached.")
+    for idx in range(len(cache.key_cache)):
+        kv_length = cache.key_cache[idx].size(2) - num_tokens
+        cache.key_cache[idx] = cache.key_cache[idx][:, :, :kv_length, :]
+        cache.value_cache[idx] = cache.value_cache[idx][:, :, :kv_length, :]
+    if hasattr(cache, "_seen_tokens"):
+        # 4.39 uses `_seen_tokens`
+        cache._seen_tokens -= num_tokens
+    else:
+        # 4.37 uses `seen_tokens`
+        cache.seen_tokens -= num_tokens
+    return num_tokens
+
+
 class DynamicFp8Cache(DynamicCache):
+    """
+    Quantized kv cache, fp8 on xpu and int8/int4 (`IPEX_LLM_CPU_KV_QUANT_TYPE`) on cpu.
+
+    On cpu the first forward attends to the unquantized kv, later forwards get the
+    quantized rows, which `scaled_dot_product_attention` reads without dequantizing
+    the whole cache.
+    """
+
     def __init__(self, num_hidden_layers: Optional[int] = None) -> None:
         # ignore num_hidden_layers to fix transformers >= 4.45
         super().__init__()
@@ -57,6 +174,24 @@ class DynamicFp8Cache(DynamicCache):
                 self.seen_tokens += seq_len
 
         # Update the cache
+        if key_states.device.type == "cpu":
+            if len(self.key_cache) <= layer_idx:
+                k_cache, v_cache = init_cpu_quant_kv_cache(
+                    batch_size, num_heads, seq_len, head_dim,
+                    get_cpu_kv_quant_type(), key_states.device
+                )
+                k_cache, v_cache = append_cpu_quant_kv_cache(k_cache, v_cache,
+                                                             key_states, value_states)
+                self.key_cache.append(k_cache)
+                self.value_cache.append(v_cache)
+                return key_states, value_states
+            k_cache, v_cache = append_cpu_quant_kv_cache(self.key_cache[layer_idx],
+                                                         self.value_cache[layer_idx],
+                                                         key_states, value_states)
+            self.key_cache[layer_idx] = k_cache
+            self.value_cache[layer_idx] = v_cache
+            return k_cache, v_cache
+
         if len(self.key_cache) <= layer_idx:
             k_cache, v_cache = init_fp8_kv_cache(
                 batch_size, num_heads, seq_len, head_dim,
@@ -75,9 +210,16 @@ class DynamicFp8Cache(DynamicCache):
 
         return self.key_cache[layer_idx], self.value_cache[layer_idx]
 
+    def crop(self, max_length: int):
+        """Roll back to `max_length` tokens (or by `-max_length` tokens) without copying kv"""
+        rollback_kv_cache(self, max_length)
+
 
 class DynamicNormalCache(DynamicCache):
     KV_ALLOC_BLOCK_LENGTH = 256
+    # On cpu the capacity grows geometrically in whole blocks, so that a generation of
+    # n tokens copies O(n) tokens in total instead of O(n^2 / KV_ALLOC_BLOCK_LENGTH).
+    KV_ALLOC_GROWTH_FACTOR = 2
 
     def __init__(self, num_hidden_layers: Optional[int] = None) -> None:
         # ignore num_hidden_layers to fix transformers >= 4.45
@@ -106,7 +248,7 @@ class DynamicNormalCache(DynamicCache):
 
         # Update the cache
         if len(self.key_cache) <= layer_idx:
-            k_cache, v_cache = init_kv_cache(
+            k_cache, v_cache = alloc_kv_cache(
                 batch_size, num_heads, head_dim,
                 0, key_states.size(2) + self.KV_ALLOC_BLOCK_LENGTH,
                 key_states.dtype, key_states.device
@@ -121,9 +263,15 @@ class DynamicNormalCache(DynamicCache):
 
             kv_seq_len = k_cache.size(2) + key_states.size(2)
             if k_cache.stride(1) < kv_seq_len * k_cache.size(3):
-                new_k_cache, new_v_cache = init_kv_cache(
+                new_kv_len = kv_seq_len + self.KV_ALLOC_BLOCK_LENGTH
+                if key_states.device.type == "cpu":
+                    capacity = k_cache.stride(1) // k_cache.size(3)
+                    new_kv_len = max(new_kv_len, capacity * self.KV_ALLOC_GROWTH_FACTOR)
+                    new_kv_len = math.ceil(new_kv_len / self.KV_ALLOC_BLOCK_LENGTH) \
+                        * self.KV_ALLOC_BLOCK_LENGTH
+                new_k_cache, new_v_cache = alloc_kv_cache(
                     batch_size, num_heads, head_dim,
-                    k_cache.size(2), kv_seq_len + self.KV_ALLOC_BLOCK_LENGTH,
+                    k_cache.size(2), new_kv_len,
                     key_states.dtype, key_states.device
                 )
                 new_k_cache[...] = k_cache[...]
@@ -142,7 +290,7 @@ class DynamicNormalCache(DynamicCache):
                       dtype: torch.dtype, device: torch.device):
         past_key_values = cls()
         for _i in range(layers):
-            k_cache, v_cache = init_kv_cache(
+            k_cache, v_cache = alloc_kv_cache(
                 bsz, n_head, head_dim,
                 0, length + cls.KV_ALLOC_BLOCK_LENGTH,
                 dtype, device
@@ -151,6 +299,213 @@ class DynamicNormalCache(DynamicCache):
             past_key_values.value_cache.append(v_cache)
         return past_key_values
 
+    @classmethod
+    def from_legacy_cache(cls, past_key_values=None, num_hidden_layers=None):
+        # IPEX_LLM_KV_OFFLOAD=1 makes every model using `DynamicNormalCache` offload its kv
+        if cls is DynamicNormalCache and os.environ.get("IPEX_LLM_KV_OFFLOAD", "0") == "1":
+            cls = DynamicOffloadCache
+        return super(DynamicNormalCache, cls).from_legacy_cache(past_key_values)
+
+    def crop(self, max_length: int):
+        """Roll back to `max_length` tokens (or by `-max_length` tokens) without copying kv"""
+        rollback_kv_cache(self, max_length)
+
+    def release(self):
+        """
+        Return the cpu buffers of this cache to `KV_CACHE_POOL` and empty the cache.
+        The cache and any tensor obtained from it must not be used afterwards.
+        """
+        for k_cache, v_cache in zip(self.key_cache, self.value_cache):
+            if k_cache.device.type == "cpu":
+                KV_CACHE_POOL.release(k_cache)
+                KV_CACHE_POOL.release(v_cache)
+        self.key_cache.clear()
+        self.value_cache.clear()
+
+
+_kv_prefetch_executor = None
+_kv_prefetch_lock = threading.Lock()
+
+
+def _get_kv_prefetch_executor():
+    global _kv_prefetch_executor
+    with _kv_prefetch_lock:
+        if _kv_prefetch_executor is None:
+            _kv_prefetch_executor = ThreadPoolExecutor(max_workers=1,
+                                                       thread_name_prefix="kv_prefetch")
+    return _kv_prefetch_executor
+
+
+class DynamicOffloadCache(DynamicNormalCache):
+    """
+    `DynamicNormalCache` whose cpu kv lives in memory-mapped files instead of anonymous
+    memory, so long contexts are not bounded by RAM and no token is dropped.
+
+    Every layer gets its own sparse file in `offload_dir`, which is unlinked right away
+    and removed with the cache. The latest `window` tokens of a layer stay hot, older
+    blocks of `KV_OFFLOAD_BLOCK_LENGTH` tokens are written back to the file once they
+    leave the window and marked cold, so the kernel reclaims them first under memory
+    pressure and reads them back when attention needs them. The kv of the next layer
+    is prefetched on a background thread while the current layer computes attention.
+
+    It is used for all models using `DynamicNormalCache` with `IPEX_LLM_KV_OFFLOAD=1`,
+    `IPEX_LLM_KV_OFFLOAD_DIR` and `IPEX_LLM_KV_OFFLOAD_WINDOW` set the defaults of
+    `offload_dir` and `window`. Caches on other devices behave like `DynamicNormalCache`.
+    """
+    KV_OFFLOAD_BLOCK_LENGTH = 256
+
+    def __init__(self, num_hidden_layers: Optional[int] = None,
+                 offload_dir: Optional[str] = None, window: Optional[int] = None) -> None:
+        super().__init__()
+        self.offload_dir = offload_dir or os.environ.get("IPEX_LLM_KV_OFFLOAD_DIR", None)
+        if window is None:
+            window = int(os.environ.get("IPEX_LLM_KV_OFFLOAD_WINDOW", 4096))
+        self.window = window
+        # per layer: the mmap holding its key and value storage, the byte offset of the
+        # value storage and the number of leading tokens already written back
+        self._mmaps = []
+        self._value_offsets = []
+        self._released = []
+
+    def _alloc(self, layer_idx, batch_size, num_heads, head_dim,
+               current_length, max_length, dtype):
+        shape = (batch_size, num_heads, max_length, head_dim)
+        nbytes = math.prod(shape) * torch.empty([], dtype=dtype).element_size()
+        value_offset = (nbytes + mmap.PAGESIZE - 1) // mmap.PAGESIZE * mmap.PAGESIZE
+        fd, path = tempfile.mkstemp(prefix="ipex_llm_kv_", dir=self.offload_dir)
+        try:
+            os.unlink(path)
+            os.ftruncate(fd, value_offset + nbytes)
+            mm = mmap.mmap(fd, value_offset + nbytes)
+        finally:
+            os.close(fd)
+        # the tensors keep `mm` alive
+        key_storage = torch.frombuffer(mm, dtype=dtype, count=math.prod(shape)).view(shape)
+        value_storage = torch.frombuffer(mm, dtype=dtype, count=math.prod(shape),
+                                         offset=value_offset).view(shape)
+        if layer_idx == len(self._mmaps):
+            self._mmaps.append(None)
+            self._value_offsets.append(0)
+            self._released.append(0)
+        self._mmaps[layer_idx] = mm
+        self._value_offsets[layer_idx] = value_offset
+        self._released[layer_idx] = 0
+        size = (batch_size, num_heads, current_length, head_dim)
+        return key_storage.as_strided(size, key_storage.stride(), storage_offset=0), \
+            value_storage.as_strided(size, value_storage.stride(), storage_offset=0)
+
+    def _page_ranges(self, layer_idx, start, end):
+        # page aligned byte ranges of tokens [start, end) of every head of a layer
+        k_cache = self.key_cache[layer_idx]
+        token_bytes = k_cache.size(3) * k_cache.element_size()
+        head_bytes = k_cache.stride(1) * k_cache.element_size()
+        num_heads = k_cache.size(0) * k_cache.size(1)
+        for base in (0, self._value_offsets[layer_idx]):
+            for head in range(num_heads):
+                head_start = base + head * head_bytes
+                range_start = head_start + start * token_bytes
+                range_start = (range_start + mmap.PAGESIZE - 1) // mmap.PAGESIZE * mmap.PAGESIZE
+                range_end = head_start + end * token_bytes
+                range_end = range_end // mmap.PAGESIZE * mmap.PAGESIZE
+                if range_end > range_start:
+                    yield range_start, range_end - range_start
+
+    def _release_old_blocks(self, layer_idx):
+        # write back the blocks which left the window and let them be reclaimed first
+        kv_length = self.key_cache[layer_idx].size(2)
+        end = max(kv_length - self.window, 0) \
+            // self.KV_OFFLOAD_BLOCK_LENGTH * self.KV_OFFLOAD_BLOCK_LENGTH
+        start = min(self._released[layer_idx], end)
+        if end <= start:
+            return
+        mm = self._mmaps[layer_idx]
+        madv_cold = getattr(mmap, "MADV_COLD", None)
+        for offset, length in self._page_ranges(layer_idx, start, end):
+            mm.flush(offset, length)
+            if madv_cold is not None:
+                mm.madvise(madv_cold, offset, length)
+        self._released[layer_idx] = end
+
+    def _prefetch(self, layer_idx):
+        madv_willneed = getattr(mmap, "MADV_WILLNEED", None)
+        if madv_willneed is None or layer_idx >= len(self._mmaps):
+            return
+        mm = self._mmaps[layer_idx]
+        ranges = list(self._page_ranges(layer_idx, 0, self._released[layer_idx]))
+        if ranges:
+            _get_kv_prefetch_executor().submit(
+                lambda: [mm.madvise(madv_willneed, offset, length) for offset, length in ranges]
+            )
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]]=None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # fix converting empty DynamicCache in transformers >= 4.45
+        if key_states == []:
+            return key_states, value_states
+        if key_states.device.type != "cpu":
+            return super().update(key_states, value_states, layer_idx, cache_kwargs)
+
+        batch_size, num_heads, seq_len, head_dim = key_states.shape
+
+        if layer_idx == 0:
+            if hasattr(self, "_seen_tokens"):
+                # 4.39 uses `_seen_tokens`
+                self._seen_tokens += seq_len
+            else:
+                # 4.37 uses `seen_tokens`
+                self.seen_tokens += seq_len
+
+        # Update the cache
+        if len(self.key_cache) <= layer_idx:
+            k_cache, v_cache = self._alloc(
+                layer_idx, batch_size, num_heads, head_dim,
+                0, seq_len + self.KV_ALLOC_BLOCK_LENGTH, key_states.dtype
+            )
+            self.key_cache.append(k_cache)
+            self.value_cache.append(v_cache)
+        k_cache = self.key_cache[layer_idx]
+        v_cache = self.value_cache[layer_idx]
+
+        kv_seq_len = k_cache.size(2) + seq_len
+        if layer_idx >= len(self._mmaps) or k_cache.stride(1) < kv_seq_len * head_dim:
+            # move to a larger file, or into a file at all for kv filled in from outside
+            # (e.g. `from_reserved`), the old storage is freed with its last view
+            capacity = k_cache.stride(1) // head_dim
+            new_kv_len = max(kv_seq_len + self.KV_ALLOC_BLOCK_LENGTH,
+                             capacity * self.KV_ALLOC_GROWTH_FACTOR)
+            new_kv_len = math.ceil(new_kv_len / self.KV_ALLOC_BLOCK_LENGTH) \
+                * self.KV_ALLOC_BLOCK_LENGTH
+            new_k_cache, new_v_cache = self._alloc(
+                layer_idx, batch_size, num_heads, head_dim,
+                k_cache.size(2), new_kv_len, key_states.dtype
+            )
+            new_k_cache[...] = k_cache[...]
+            new_v_cache[...] = v_cache[...]
+            k_cache = new_k_cache
+            v_cache = new_v_cache
+        k_cache, v_cache = append_kv_cache(k_cache, v_cache, key_states, value_states)
+        self.key_cache[layer_idx] = k_cache
+        self.value_cache[layer_idx] = v_cache
+
+        self._release_old_blocks(layer_idx)
+        # the next layer, or the first layer of the next forward
+        self._prefetch(layer_idx + 1 if layer_idx + 1 < len(self._mmaps) else 0)
+
+        return self.key_cache[layer_idx], self.value_cache[layer_idx]
+
+    def release(self):
+        """Drop the kv, the files are removed once no tensor views them any more"""
+        self.key_cache.clear()
+        self.value_cache.clear()
+        self._mmaps.clear()
+        self._value_offsets.clear()
+        self._released.clear()
+
 
 class DynamicUnbalancedFp8Cache(DynamicCache):
     def __init__(self, num_hidden_layers: Optional[int] = None) -> None:
@@ -200,6 +555,10 @@ class DynamicUnbalancedFp8Cache(DynamicCache):
 
         return self.key_cache[layer_idx], self.value_cache[layer_idx]
 
+    def crop(self, max_length: int):
+        """Roll back to `max_length` tokens (or by `-max_length` tokens) without copying kv"""
+        rollback_kv_cache(self, max_length)
+
 
 # Copied from transformers.models.llama.modeling_llama.repeat_kv
 def repeat_kv(hidden_states: torch.Tensor, n_rep: int) -> torch.Tensor:
@@ -406,6 +765,13 @@ class DynamicCompressCache(DynamicCache):
             return 0
         return self.real_kv_len
 
+    def crop(self, max_length: int):
+        """
+        Roll back to `max_length` tokens (or by `-max_length` tokens) without copying kv,
+        lengths count all seen tokens, including the ones dropped by compression.
+        """
+        self.real_kv_len -= rollback_kv_cache(self, max_length)
+
     @classmethod
     def from_legacy_cache(
         cls, past_key_values: Optional[Tuple[Tuple[torch.FloatTensor]]] = None,
@@ -31,9 +31,10 @@ import transformers
 from transformers import GenerationConfig, LogitsProcessorList, StoppingCriteriaList
 from ipex_llm.transformers.speculative import greedy, deepmind_sample, logits_to_probs,\
     _crop_past_key_values, _prepare_generate_args, _non_cpu_ipex_verify, clear_benchmarks,\
-    _prepare_generate_args_4_45
+    _prepare_generate_args_4_45, _tree_verify, _tree_verify_supported
 from ipex_llm.utils.common import invalidInputError
 from ipex_llm.transformers.utils import get_xpu_device_name
+from ipex_llm.transformers.draft_controller import get_draft_controller, accept_histogram
 
 logger = logging.getLogger("ipex_llm.lookup")
 
@@ -90,14 +91,14 @@ def generate(
             logger.warning("Prompt lookup is currently not supported on CPU with IPEX, "
                            "fallback to original generate.")
             kwargs.pop("max_matching_ngram_size", None)
-        elif input_tensor_shape is not None and input_tensor_shape[0] > 1:
-            logger.warning("Prompt lookup is currently not supported with batch inference, "
-                           "fallback to original generate.")
-            kwargs.pop("max_matching_ngram_size", None)
+            kwargs.pop("num_branches", None)
+            kwargs.pop("draft_controller", None)
         elif kwargs.get("num_beams", None) not in [None, 1]:
             logger.warning("Prompt lookup is currently not supported with num_beams != 1, "
                            "fallback to original generate.")
             kwargs.pop("max_matching_ngram_size", None)
+            kwargs.pop("num_branches", None)
+            kwargs.pop("draft_controller", None)
         else:
             # Do prompt lookup generation
             # If lookahead is provided, we will use lookup_generate instead of
@@ -136,11 +137,15 @@ def generate(
 GenerationMixin.generate = generate
 
 
-def tensor2key(key_tensor: torch.LongTensor):
-    return tuple(key_tensor.tolist())
+# n-grams are hashed as sum(token * hash_weights[i]) with
+# hash_weights[i] = NGRAM_HASH_BASE^i mod NGRAM_HASH_MOD (see
+# `PromptLookupCandidateGenerator.hash_weights`), which stays far below 2^63 for any
+# vocabulary size and n-gram size in use, so torch and python agree on the value
+NGRAM_HASH_BASE = 1000003
+NGRAM_HASH_MOD = 2 ** 31 - 1
 
 
-# This class is copied from https://github.com/huggingface/transformers/blob/main/src
+# This class is adapted from https://github.com/huggingface/transformers/blob/main/src
 # /transformers/generation/candidate_generator.py
 class PromptLookupCandidateGenerator():
     """
@@ -151,6 +156,10 @@ class PromptLookupCandidateGenerator():
     Read the following blog post for more information:
     https://github.com/apoorvumang/prompt-lookup-decoding
 
+    For every sequence of the batch, the n-grams of its tokens are kept in a hash index
+    pointing to their most recent occurrence, which is built in one vectorized pass over
+    the prompt and extended with the windows of each accepted token.
+
     Args:
         max_matching_ngram_size (`int`):
             The maximum ngram size to be considered for matching in the prompt
@@ -174,33 +183,86 @@ class PromptLookupCandidateGenerator():
             self.max_candidates = 9
             self.min_candidates = 0
 
-        self.lookup_table = {}
+        # lookup_table[batch_idx][ngram_size - 1]: n-gram hash -> start of its latest occurrence
+        self.lookup_table = []
+        # token ids of every sequence mirrored on cpu
+        self.token_ids = []
+        self.hash_weights = [pow(NGRAM_HASH_BASE, i, NGRAM_HASH_MOD)
+                             for i in range(self.max_matching_ngram_size)]
         invalidInputError(self.max_matching_ngram_size > 0 and self.num_output_tokens > 0,
                           "Invalid max_matching_ngram_size or num_output_tokens")
 
+    def _ngram_hash(self, ngram: List[int]):
+        return sum(token * weight for token, weight in zip(ngram, self.hash_weights))
+
+    def _index_windows(self, batch_idx: int, start: int, end: int):
+        # index the n-grams starting in [start, end) of every size, only n-grams
+        # followed by at least one token are indexed, so the current suffix never
+        # matches itself
+        token_ids = self.token_ids[batch_idx]
+        for ngram_size in range(1, self.max_matching_ngram_size + 1):
+            ngram_start = max(start - ngram_size, 0)
+            ngram_end = end - ngram_size
+            if ngram_end <= ngram_start:
+                continue
+            ids = torch.tensor(token_ids[ngram_start:ngram_end + ngram_size - 1])
+            windows = ids.unfold(dimension=0, size=ngram_size, step=1)
+            weights = torch.tensor(self.hash_weights[:ngram_size])
+            hashes = (windows * weights).sum(-1).tolist()
+            # later occurrences overwrite earlier ones
+            self.lookup_table[batch_idx][ngram_size - 1].update(
+                zip(hashes, range(ngram_start, ngram_end))
+            )
+
     def init_look_up_table(self,
                            input_ids: torch.LongTensor):
-        for ngram_size in range(min(self.max_matching_ngram_size, input_ids.shape[1]), 0, -1):
-            # Create sliding windows of size ngram_size
-            windows = input_ids.cpu().unfold(dimension=1, size=ngram_size, step=1)
-            for idx in range(windows.size(1)):
-                window = tensor2key(windows[0, idx])
-                if window not in self.lookup_table:
-                    self.lookup_table[window] = idx
+        self.token_ids = input_ids.cpu().tolist()
+        self.lookup_table = [[{} for _ in range(self.max_matching_ngram_size)]
+                             for _ in range(len(self.token_ids))]
+        for batch_idx, token_ids in enumerate(self.token_ids):
+            self._index_windows(batch_idx, 0, len(token_ids))
 
     def update_look_up_table(self,
                              new_input_ids: torch.LongTensor):
-        # Maintain a look up table
-        window = tensor2key(new_input_ids[0, -self.max_matching_ngram_size:])
-        for ngram_size in range(self.max_matching_ngram_size):
-            if window[ngram_size:] not in self.lookup_table:
-                self.lookup_table[window[ngram_size:]] = \
-                    new_input_ids.size(1)-self.max_matching_ngram_size+ngram_size
+        # Index the windows ending at the newly accepted tokens
+        cur_len = len(self.token_ids[0])
+        new_tokens = new_input_ids[:, cur_len:].cpu().tolist()
+        for batch_idx, tokens in enumerate(new_tokens):
+            self.token_ids[batch_idx].extend(tokens)
+            self._index_windows(batch_idx, cur_len, len(self.token_ids[batch_idx]))
 
     def get_n_gram_idx(self,
-                       ngram_tensor: torch.LongTensor):
-        key = tensor2key(ngram_tensor)
-        return self.lookup_table[key]
+                       batch_idx: int,
+                       ngram: List[int]):
+        idx = self.lookup_table[batch_idx][len(ngram) - 1].get(self._ngram_hash(ngram), None)
+        token_ids = self.token_ids[batch_idx]
+        if idx is not None and token_ids[idx:idx + len(ngram)] != ngram:
+            # hash collision
+            idx = None
+        return idx
+
+    def _get_continuations(self, batch_idx: int, num_branches: int):
+        # distinct continuations of the matching n-grams, longest n-gram first
+        token_ids = self.token_ids[batch_idx]
+        input_length = len(token_ids)
+        continuations = []
+        for ngram_size in range(min(self.max_matching_ngram_size, input_length - 1), 0, -1):
+            idx = self.get_n_gram_idx(batch_idx, token_ids[-ngram_size:])
+            if idx is None:
+                continue
+
+            start_idx = idx + ngram_size
+            end_idx = min(start_idx + self.num_output_tokens, input_length)
+            continuation = token_ids[start_idx:end_idx]
+            if start_idx < end_idx and continuation not in continuations:
+                continuations.append(continuation)
+                if len(continuations) == num_branches:
+                    break
+        return continuations
+
+    def _get_continuation(self, batch_idx: int):
+        continuations = self._get_continuations(batch_idx, 1)
+        return continuations[0] if continuations else []
 
     def get_candidates(self,
                        input_ids: torch.LongTensor)-> Tuple[torch.LongTensor,
@@ -214,42 +276,42 @@ class PromptLookupCandidateGenerator():
                 [What are input IDs?](../glossary#input-ids)
 
         Return:
-            `torch.LongTensor` of shape `(num_candidates, candidate_length)`:
-            The candidate sequences to be tried.
+            `torch.LongTensor` of shape `(batch_size, candidate_length)`:
+            The candidate sequences to be tried, all sequences of the batch
+            get the same number of candidates.
         """
         if self.num_output_tokens == 0:
             return input_ids, None
-        input_length = input_ids.size(1)
-
-        chosen_ids = None
-        for ngram_size in range(min(self.max_matching_ngram_size, input_length - 1), 0, -1):
-            # Convert ngram to a tensor for comparison
-            ngram_tensor = input_ids[0, -ngram_size:]
-
-            # # Get the indices of matches
-            idx = self.get_n_gram_idx(ngram_tensor)
-
-            # Iterate through match indices to find a valid continuation
-            start_idx = idx + ngram_size
-            end_idx = start_idx + self.num_output_tokens
-            end_idx = min(end_idx, input_length)
 
-            if start_idx < end_idx:
-                chosen_ids = input_ids[0, start_idx:end_idx]
-                break
+        continuations = [self._get_continuation(batch_idx)
+                         for batch_idx in range(input_ids.size(0))]
+        candidate_length = min(len(c) for c in continuations)
 
-        if chosen_ids is None or len(chosen_ids) == 0:
+        if candidate_length == 0:
             # In case we didn't find a match return the input sequence unchanged,
             # reverts back to autoregressive decoding
             return input_ids, None
 
         # Now need extend input_ids with chosen_ids
-        chosen_ids = chosen_ids.unsqueeze(0)
+        chosen_ids = torch.tensor([c[:candidate_length] for c in continuations],
+                                  dtype=input_ids.dtype, device=input_ids.device)
         candidate_input_ids = torch.cat((input_ids, chosen_ids), dim=1)
         # assisted_generation expects logits as well, but we don't have those here,
         # so returning None
         return candidate_input_ids, None
 
+    def get_candidate_branches(self, num_branches: int) -> List[List[int]]:
+        """
+        Fetches up to `num_branches` distinct candidate continuations of the first sequence,
+        which are verified together as a token tree.
+
+        Every matching n-gram size contributes at most one branch, so the number of
+        branches is also bounded by `max_matching_ngram_size`.
+        """
+        if self.num_output_tokens == 0:
+            return []
+        return self._get_continuations(0, num_branches)
+
     def update_candidate_strategy(self, candidate_num: int, num_matches: int, accept_rate: float):
         """
         Updates the candidate generation strategy based on the outcomes.
@@ -270,6 +332,12 @@ class PromptLookupCandidateGenerator():
                 self.num_output_tokens = max(self.num_output_tokens - 1, self.min_candidates)
 
 
+def _next_draft_length(self, draft_controller, max_length):
+    length = min(max(draft_controller.next_length(), 1), max_length)
+    self.draft_length_trace.append(length)
+    return length
+
+
 @torch.no_grad()
 def lookup_generate(self,
                     inputs: Optional[torch.Tensor] = None,
@@ -279,6 +347,8 @@ def lookup_generate(self,
                     generation_config: Optional[GenerationConfig] = None,
                     streamer: Optional["BaseStreamer"] = None,
                     attention_mask=None,
+                    num_branches: int = 1,
+                    draft_controller=None,
                     **sampling_kwargs):
     from packaging import version
     trans_version = transformers.__version__
@@ -292,15 +362,16 @@ def lookup_generate(self,
             model_kwargs = _prepare_generate_args(self, inputs, generation_config,
                                                   streamer, **sampling_kwargs)
 
-    invalidInputError(input_ids.shape[0] == 1,
-                      "Prompt lookup is currently not supported with batch inference.")
-
     device_name = get_xpu_device_name(input_ids.device)
 
     candidates_generator = PromptLookupCandidateGenerator(
         num_output_tokens=num_output_tokens,
         max_matching_ngram_size=max_matching_ngram_size,
         device=device_name)
+    # The draft controller replaces `update_candidate_strategy` and picks the number
+    # of candidate tokens of every step from the measured acceptance and latencies
+    draft_controller = get_draft_controller(self, draft_controller, "lookup",
+                                            1, candidates_generator.max_candidates)
 
     step = 0
     step_verify = 0
@@ -310,6 +381,9 @@ def lookup_generate(self,
 
     past_key_values = None
     input_len = input_ids.shape[1]
+    batch_size = input_ids.shape[0]
+    if attention_mask is not None:
+        model_kwargs["attention_mask"] = attention_mask
 
     eos_token_id_set = None
     if generation_config.eos_token_id is not None:
@@ -317,6 +391,20 @@ def lookup_generate(self,
             eos_token_id_set = set(generation_config.eos_token_id)
         else:
             eos_token_id_set = set([generation_config.eos_token_id])
+    if batch_size > 1 and eos_token_id_set is not None:
+        # finished sequences are padded until all sequences of the batch finish
+        pad_token_id = generation_config.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = next(iter(eos_token_id_set))
+        unfinished = torch.ones(batch_size, dtype=torch.bool, device=input_ids.device)
+        eos_token_ids = torch.tensor(list(eos_token_id_set), device=input_ids.device)
+
+    # Tree verification: the continuations of several matching n-grams are verified
+    # together as a token tree instead of a single candidate chain
+    tree_verify = num_branches > 1 and batch_size == 1 and not generation_config.do_sample
+    if num_branches > 1 and not tree_verify:
+        logger.warning("Tree verification only supports greedy search with batch size 1, "
+                       "fallback to verifying a single candidate chain.")
 
     while True:
         if step >= max_new_tokens:
@@ -343,13 +431,68 @@ def lookup_generate(self,
             candidates_generator.init_look_up_table(input_ids)
 
             past_key_values = output['past_key_values']
+            if tree_verify and not _tree_verify_supported(self, past_key_values):
+                logger.warning("Tree verification is not supported by this model or kv cache, "
+                               "fallback to verifying a single candidate chain.")
+                tree_verify = False
             step += 1
             if self.device.type == 'xpu':
                 torch.xpu.synchronize()
             toc = time.time()
             self.first_token_time = toc - tic
             e2e_tic = time.time()
+        elif tree_verify:
+            if draft_controller is not None:
+                candidates_generator.num_output_tokens = _next_draft_length(
+                    self, draft_controller, candidates_generator.max_candidates)
+            toc = time.time()
+            branches = candidates_generator.get_candidate_branches(num_branches)
+            candidate_length = max([len(branch) for branch in branches], default=0)
+            tic = time.time()
+            self.draft_time.append(tic - toc)
+            if attention_mask is None:
+                past_attention_mask = None
+            else:
+                ones_to_append = torch.ones(attention_mask.size(0), step - 1,
+                                            dtype=attention_mask.dtype, device=self.device)
+                past_attention_mask = torch.cat((attention_mask, ones_to_append), dim=1)
+            output_ids, n_matches, num_drafted, past_key_values = _tree_verify(
+                self, input_ids, branches, past_key_values, logits_processor,
+                past_attention_mask)
+            self.draft_num.append(num_drafted)
+
+            if self.device.type == 'xpu':
+                torch.xpu.synchronize()
+            toc = time.time()
+            self.verify_time.append(toc - tic)
+            mot = time.time()
+            self.match_time.append(mot-toc)
+
+            # The kv cache is already compacted to the accepted path, the accept rate
+            # is measured against the longest branch
+            self.accept_num.append(n_matches + 1)
+            self.n_matched += n_matches
+            self.n_drafted += candidate_length
+            accept_rate = self.n_matched/self.n_drafted if self.n_drafted > 0 else 1
+            self.accept_rate.append(accept_rate)
+            if draft_controller is not None:
+                draft_controller.update(candidate_length, n_matches,
+                                        self.draft_time[-1], self.verify_time[-1])
+            elif device_name not in ["mtl", "lnl"]:
+                candidates_generator.update_candidate_strategy(candidate_length, n_matches,
+                                                               accept_rate)
+
+            input_ids = torch.cat((input_ids, output_ids), dim=-1)
+            candidates_generator.update_look_up_table(input_ids)
+
+            step += output_ids.size(1)
+            step_verify += 1
+            pot = time.time()
+            self.post_time.append(pot-mot)
         else:
+            if draft_controller is not None:
+                candidates_generator.num_output_tokens = _next_draft_length(
+                    self, draft_controller, candidates_generator.max_candidates)
             cur_len = input_ids.shape[-1]
             toc = time.time()
             candidate_input_ids, _ = candidates_generator.get_candidates(input_ids=input_ids)
@@ -360,13 +503,20 @@ def lookup_generate(self,
             self.draft_time.append(tic - toc)
             if attention_mask is None:
                 cur_attention_mask = None
+                position_ids = None
             else:
                 appended_len = verify_input_ids.size(1) + step - 1
                 ones_to_append = torch.ones(attention_mask.size(0), appended_len,
                                             device=self.device)
                 cur_attention_mask = torch.cat((attention_mask, ones_to_append), dim=1)
+                position_ids = None
+                if batch_size > 1:
+                    # left padded sequences start their positions after the padding
+                    position_ids = cur_attention_mask.long().cumsum(-1) - 1
+                    position_ids = position_ids[:, -verify_input_ids.size(1):]
             output = _non_cpu_ipex_verify(self, verify_input_ids, past_key_values,
-                                          cur_attention_mask, return_dict=True, use_cache=True)
+                                          cur_attention_mask, return_dict=True, use_cache=True,
+                                          position_ids=position_ids)
             if isinstance(output, dict):
                 logits = output['logits']
                 past_key_values = output['past_key_values']
@@ -381,7 +531,7 @@ def lookup_generate(self,
                                                         top_k=generation_config.top_k,
                                                         top_p=generation_config.top_p,
                                                         temperature=generation_config.temperature)
-                output_ids = output_ids.transpose(0, 1)
+                output_ids = output_ids.view(batch_size, -1)
             else:
                 output_ids = greedy(logits)
 
@@ -394,9 +544,10 @@ def lookup_generate(self,
             # Drafts start from [1, k]
             # Verified output start from [0, k - 1]
             # including the one generated by the base model
+            # All sequences of a batch accept the same number of tokens
 
             n_matches = ((output_ids[:, :-1] != verify_input_ids[:, 1:])
-                         .cumsum(-1) == 0).sum(-1).item()
+                         .cumsum(-1) == 0).sum(-1).min().item()
 
             max_matched = n_matches + 1
             mot = time.time()
@@ -418,7 +569,10 @@ def lookup_generate(self,
             accept_rate = self.n_matched/self.n_drafted if self.n_drafted > 0 else 1
             self.accept_rate.append(accept_rate)
             # Update the candidate generation strategy if needed
-            if device_name not in ["mtl", "lnl"]:
+            if draft_controller is not None:
+                draft_controller.update(candidate_length, n_matches,
+                                        self.draft_time[-1], self.verify_time[-1])
+            elif device_name not in ["mtl", "lnl"]:
                 candidates_generator.update_candidate_strategy(candidate_length, n_matches,
                                                                accept_rate)
 
@@ -431,7 +585,19 @@ def lookup_generate(self,
             self.post_time.append(pot-mot)
 
         # Stop on eos and remove content after eos
-        if eos_token_id_set is not None:
+        if batch_size > 1 and eos_token_id_set is not None:
+            # pad the tokens of sequences after their eos
+            is_eos = torch.isin(output_ids, eos_token_ids)
+            after_eos = (is_eos.long().cumsum(-1) - is_eos.long()) > 0
+            keep = unfinished.unsqueeze(1) & ~after_eos
+            output_ids = torch.where(keep, output_ids, pad_token_id)
+            input_ids[:, -output_ids.size(1):] = output_ids
+            unfinished &= ~is_eos.any(-1)
+            if not unfinished.any():
+                if streamer is not None:
+                    streamer.put(output_ids.cpu())
+                break
+        elif eos_token_id_set is not None:
             output_ids_list = output_ids[0].tolist()
             first_eos_idx = -1
             for out_idx, out_id in enumerate(output_ids_list):
@@ -440,7 +606,7 @@ def lookup_generate(self,
                     break
             if first_eos_idx > -1:
                 if streamer is not None:
-                    streamer.put(output_ids[:(first_eos_idx + 1)].cpu())
+                    streamer.put(output_ids[:, :(first_eos_idx + 1)].cpu())
                 step -= (len(output_ids_list) - first_eos_idx - 1)
                 break
         if streamer is not None:
@@ -450,6 +616,9 @@ def lookup_generate(self,
     e2e_toc = time.time()
     self.n_token_generated = step
     self.e2e_time_without_first = e2e_toc - e2e_tic
+    self.accept_hist = accept_histogram(self.accept_num)
+    if draft_controller is not None and hasattr(draft_controller, "save"):
+        draft_controller.save()
 
     if streamer is not None:
         streamer.end()
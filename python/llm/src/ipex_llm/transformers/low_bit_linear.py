@@ -44,6 +44,9 @@
 from typing import Optional, TypeVar, Union, overload
 from ipex_llm.utils.common import invalidInputError
 import os
+import threading
+import weakref
+from collections import OrderedDict
 import torch
 import torch.distributed
 import torch.nn.functional as F
@@ -266,6 +269,87 @@ def ggml_int4_convert_fp32(tensor: torch.Tensor, weight_shape: tuple, k: int):
     return dst_tensor
 
 
+def ggml_int4_convert_fp32_chunks(tensor: torch.Tensor, weight_shape: tuple, chunk_rows: int):
+    # dequantize `chunk_rows` rows at a time, so the full fp32 weight is never materialized
+    rows, cols = weight_shape
+    row_bytes = tensor.numel() // rows
+    for start in range(0, rows, chunk_rows):
+        end = min(start + chunk_rows, rows)
+        chunk = tensor[start * row_bytes:end * row_bytes]
+        yield start, end, ggml_int4_convert_fp32(chunk, (end - start, cols), (end - start) * cols)
+
+
+def get_dequant_chunk_rows(cols: int):
+    return max(1, CPU_DEQUANT_CHUNK_BYTES // (cols * 4))
+
+
+def chunked_int4_linear(x_2d: torch.Tensor, tensor: torch.Tensor, weight_shape: tuple):
+    # streaming dequant + gemm, each chunk of weight is used while it is still in cache
+    x_2d = x_2d.to(torch.float)
+    result = torch.empty((x_2d.size(0), weight_shape[0]), dtype=torch.float)
+    chunk_rows = get_dequant_chunk_rows(weight_shape[1])
+    for start, end, w in ggml_int4_convert_fp32_chunks(tensor, weight_shape, chunk_rows):
+        result[:, start:end] = F.linear(x_2d, w)
+    return result
+
+
+class DequantWeightCache:
+    """
+    LRU cache of the dequantized weights of CPU `LowBitLinear` layers, within `max_bytes`.
+    It trades memory for not dequantizing the whole weight at every long prefill.
+    """
+
+    def __init__(self, max_bytes: int, dtype: torch.dtype):
+        self.max_bytes = max_bytes
+        self.dtype = dtype
+        self.nbytes = 0
+        # id(weight) -> (weakref to weight, data_ptr of weight, dequantized weight)
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _pop(self, key):
+        _, _, w = self.cache.pop(key)
+        self.nbytes -= w.numel() * w.element_size()
+
+    def get(self, weight: torch.Tensor, weight_shape: tuple):
+        key = id(weight)
+        data_ptr = weight.data.data_ptr()
+        with self.lock:
+            entry = self.cache.get(key, None)
+            if entry is not None:
+                if entry[0]() is weight and entry[1] == data_ptr:
+                    self.cache.move_to_end(key)
+                    return entry[2]
+                self._pop(key)
+
+        nbytes = weight_shape[0] * weight_shape[1] * torch.finfo(self.dtype).bits // 8
+        if nbytes > self.max_bytes:
+            return None
+        w = torch.empty(weight_shape, dtype=self.dtype)
+        chunk_rows = get_dequant_chunk_rows(weight_shape[1])
+        for start, end, chunk in ggml_int4_convert_fp32_chunks(weight.data, weight_shape,
+                                                               chunk_rows):
+            w[start:end] = chunk
+
+        with self.lock:
+            if key in self.cache:
+                self._pop(key)
+            self.cache[key] = (weakref.ref(weight), data_ptr, w)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                self._pop(next(iter(self.cache)))
+        return w
+
+
+CPU_DEQUANT_CHUNK_BYTES = int(os.environ.get("IPEX_LLM_CPU_DEQUANT_CHUNK_BYTES", 8 << 20))
+# opt-in, disabled by default
+CPU_DEQUANT_CACHE = DequantWeightCache(
+    int(os.environ.get("IPEX_LLM_CPU_DEQUANT_CACHE_BYTES", 0)),
+    torch.bfloat16 if os.environ.get("IPEX_LLM_CPU_DEQUANT_CACHE_DTYPE", "fp32") == "bf16"
+    else torch.float,
+)
+
+
 def ggml_convert_fp32(tensor: torch.Tensor, weight_shape: tuple, k: int, qtype: int):
     invalidInputError(tensor.dtype == torch.uint8,
                       "Input tensor must be uint8")
@@ -738,8 +822,14 @@ class LowBitLinear(nn.Linear):
                 # convert if necessary, and compute a linear result
                 if is_server() and (not is_spr()) and \
                         self.qtype == SYM_INT4 and x_2d.shape[0] >= TORCH_LINEAR_THRESHOLD:
-                    x0_fp32 = ggml_int4_convert_fp32(x0, self.weight_shape, self.weight_length)
-                    result = F.linear(x.to(dtype=x0_fp32.dtype), x0_fp32)
+                    x0_fp = None
+                    if CPU_DEQUANT_CACHE.max_bytes > 0:
+                        x0_fp = CPU_DEQUANT_CACHE.get(self.weight, self.weight_shape)
+                    if x0_fp is not None:
+                        result = F.linear(x.to(dtype=x0_fp.dtype), x0_fp)
+                    else:
+                        result = chunked_int4_linear(x_2d, x0, self.weight_shape)
+                        result = result.view(new_shape)
                 else:
                     # Weight does not need a convert
                     result = ggml_matmul_src1_x_src0_t(x0, x_2d, self.weight_shape, self.qtype)
@@ -67,7 +67,9 @@ def save_low_bit(self, *args, **kwargs):
     origin_device = self.device
     self.to('cpu')
 
-    kwargs['safe_serialization'] = False
+    # low-bit weights are kept in pickled `pytorch_model.bin` by default,
+    # `safe_serialization=True` writes packed weights into mmap-able safetensors instead
+    kwargs['safe_serialization'] = kwargs.get('safe_serialization', False)
 
     architectures = getattr(self.config, "architectures", None)
     model_type = getattr(self.config, "model_type", None)
@@ -97,6 +99,13 @@ def save_low_bit(self, *args, **kwargs):
     # it's not necessary to load the entire model to extract its keys
     # and we can avoid gc not triggered potentially.
     load_keys = {"all_checkpoint_keys": list(self.state_dict().keys())}
+    # Record the qtype of each packed weight, so that a loader can check the layout
+    # of the mmapped tensors before wrapping them.
+    from .low_bit_linear import FP4Params
+    load_keys["low_bit_params"] = {
+        name: param.qtype for name, param in self.named_parameters()
+        if isinstance(param, FP4Params)
+    }
     with open(os.path.join(args[0], "load_keys.json"), "w") as json_file:
         json.dump(load_keys, json_file)
     if origin_device != 'cpu':
@@ -135,7 +144,10 @@ class _BaseAutoModelClass:
         :param modules_to_not_convert: list of str value, modules (nn.Module) that are skipped when
                                        conducting model optimizations. Default to be ``None``.
         :param speculative: boolean value, Whether to use speculative decoding.
-                            Default to be ``False``.
+                            Default to be ``False``. On CPU, the kv storage of speculative
+                            decoding is kept for later calls within
+                            ``IPEX_LLM_SPECULATIVE_STORAGE_LIMIT_MB`` (1024 by default),
+                            ``model.release_past_key_values_storage()`` frees it.
         :param cpu_embedding: Whether to replace the Embedding layer, may need to set it
             to ``True`` when running BigDL-LLM on GPU on Windows. Default to be ``False``.
         :param disk_embedding: Whether to put the Embedding layer on disk to save memory.
@@ -365,7 +377,7 @@ class _BaseAutoModelClass:
                 torch.distributed.barrier()
             if speculative:
                 from .speculative import speculative_generate, clear_benchmarks,\
-                    _crop_past_key_values
+                    _crop_past_key_values, release_past_key_values_storage
                 # load a sym_int4 model as draft model
                 draft_model = cls.load_convert('sym_int4', optimize_model, *args, **kwargs)
                 model.draft_model = draft_model
@@ -374,6 +386,8 @@ class _BaseAutoModelClass:
                 model.clear_benchmarks = types.MethodType(clear_benchmarks, model)
                 model.speculative_generate = types.MethodType(speculative_generate, model)
                 model._crop_past_key_values = types.MethodType(_crop_past_key_values, model)
+                model.release_past_key_values_storage = \
+                    types.MethodType(release_past_key_values_storage, model)
 
             # add lookup_generate to pretrained model
             from .lookup import lookup_generate
@@ -716,27 +730,47 @@ class _BaseAutoModelClass:
         if dtype_orig is not None:
             torch.set_default_dtype(dtype_orig)
 
-        (
-            model,
-            missing_keys,
-            unexpected_keys,
-            mismatched_keys,
-            offload_index,
-            error_msgs,
-        ) = model_class._load_pretrained_model(
-            model,
-            None,
-            loaded_state_dict_keys,  # XXX: rename?
-            resolved_archive_file,
-            pretrained_model_name_or_path,
-            sharded_metadata=sharded_metadata,
-            _fast_init=False,  # always false to avoid pre-init behaviors
-            low_cpu_mem_usage=bigdl_lcmu_enabled,
-            offload_folder=offload_folder,
-            offload_state_dict=offload_state_dict,
-            dtype=torch_dtype,
-            keep_in_fp32_modules=[],
-        )
+        use_safetensors = str(resolved_archive_file if not is_sharded
+                              else resolved_archive_file[0]).endswith(".safetensors")
+        if use_safetensors:
+            import json
+            from .low_bit_linear import FP4Params
+            low_bit_params = {}
+            load_keys_file = os.path.join(pretrained_model_name_or_path, "load_keys.json")
+            if os.path.isfile(load_keys_file):
+                with open(load_keys_file, "r") as json_file:
+                    low_bit_params = json.load(json_file).get("low_bit_params", {})
+            for name, param in model.named_parameters():
+                if isinstance(param, FP4Params) and name in low_bit_params:
+                    invalidInputError(low_bit_params[name] == param.qtype,
+                                      f"{name} is saved with qtype {low_bit_params[name]},"
+                                      f" but the model is converted to qtype {param.qtype}.")
+
+        # safetensors shards are mmapped, so packed weights are wrapped without a copy
+        load_contexts = [patch("transformers.modeling_utils.load_state_dict",
+                               load_state_dict)] if use_safetensors else []
+        with ContextManagers(load_contexts):
+            (
+                model,
+                missing_keys,
+                unexpected_keys,
+                mismatched_keys,
+                offload_index,
+                error_msgs,
+            ) = model_class._load_pretrained_model(
+                model,
+                None,
+                loaded_state_dict_keys,  # XXX: rename?
+                resolved_archive_file,
+                pretrained_model_name_or_path,
+                sharded_metadata=sharded_metadata,
+                _fast_init=False,  # always false to avoid pre-init behaviors
+                low_cpu_mem_usage=bigdl_lcmu_enabled,
+                offload_folder=offload_folder,
+                offload_state_dict=offload_state_dict,
+                dtype=torch_dtype,
+                keep_in_fp32_modules=[],
+            )
 
         # make sure token embedding weights are still tied if needed
         model.tie_weights()
@@ -14,8 +14,11 @@
 # limitations under the License.
 
 
+import os
 import math
+import threading
 import torch
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 from ipex_llm.utils.common import invalidInputError
 
@@ -247,6 +250,56 @@ def prepare_mask(mask, bsz, n_heads, seq_length, kv_length, is_causal, dtype, de
     return mask
 
 
+CPU_QUANT_KV_CHUNK_LENGTH = 1024
+
+
+def cpu_quant_kv_attention(query: torch.Tensor, key: torch.Tensor, value: torch.Tensor,
+                           mask: torch.Tensor = None, is_causal: bool = False,
+                           scale: float = None) -> torch.Tensor:
+    # attention over an int8/int4 cpu kv cache (see `init_cpu_quant_kv_cache`), the kv
+    # is read chunk by chunk and its per-token scales and mins are applied to the scores
+    # and probabilities, so the dequantized kv is never materialized
+    from ipex_llm.transformers.models.utils import split_cpu_quant_kv
+    bsz, n_heads, seq_length, head_dim = query.shape
+    _, n_kv_heads, kv_length, _ = key.shape
+    n_rep = n_heads // n_kv_heads
+    scale = 1 / math.sqrt(head_dim) if scale is None else scale
+
+    # query heads sharing a kv head are stacked as rows
+    query_rows = query.float().reshape(bsz, n_kv_heads, n_rep * seq_length, head_dim) * scale
+    query_sum = query_rows.sum(-1, keepdim=True)
+    attn_weights = torch.empty(bsz, n_kv_heads, n_rep * seq_length, kv_length,
+                               dtype=torch.float32, device=query.device)
+    for start in range(0, kv_length, CPU_QUANT_KV_CHUNK_LENGTH):
+        end = min(start + CPU_QUANT_KV_CHUNK_LENGTH, kv_length)
+        values, scales, mins = split_cpu_quant_kv(key[:, :, start:end, :])
+        weights = torch.matmul(query_rows, values.transpose(2, 3)) * scales.transpose(2, 3)
+        if mins is not None:
+            weights += query_sum * mins.transpose(2, 3)
+        attn_weights[..., start:end] = weights
+
+    attn_weights = attn_weights.view(bsz, n_heads, seq_length, kv_length)
+    if mask is not None:
+        attn_weights += mask[..., :seq_length, :kv_length]
+    elif is_causal and seq_length > 1:
+        causal_mask = torch.ones(seq_length, kv_length, dtype=torch.bool, device=query.device)
+        causal_mask = causal_mask.tril_(kv_length - seq_length)
+        attn_weights.masked_fill_(~causal_mask, torch.finfo(torch.float32).min)
+    attn_weights = attn_weights.softmax(-1)
+    attn_weights = attn_weights.view(bsz, n_kv_heads, n_rep * seq_length, kv_length)
+
+    attn_output = torch.zeros(bsz, n_kv_heads, n_rep * seq_length, head_dim,
+                              dtype=torch.float32, device=query.device)
+    for start in range(0, kv_length, CPU_QUANT_KV_CHUNK_LENGTH):
+        end = min(start + CPU_QUANT_KV_CHUNK_LENGTH, kv_length)
+        values, scales, mins = split_cpu_quant_kv(value[:, :, start:end, :])
+        probs = attn_weights[..., start:end]
+        attn_output += torch.matmul(probs * scales.transpose(2, 3), values)
+        if mins is not None:
+            attn_output += torch.matmul(probs, mins)
+    return attn_output.view(bsz, n_heads, seq_length, head_dim).to(query.dtype)
+
+
 def scaled_dot_product_attention(query: torch.Tensor, key: torch.Tensor,
                                  value: torch.Tensor, mask: torch.Tensor = None,
                                  is_causal: bool = False, scale: float = None) -> torch.Tensor:
@@ -286,6 +339,8 @@ def scaled_dot_product_attention(query: torch.Tensor, key: torch.Tensor,
                 attn_output = xe_addons.sdp_non_causal(query, key, value, mask, scale)
 
         return attn_output
+    elif device.type == "cpu" and key.dtype in [torch.int8, torch.uint8]:
+        return cpu_quant_kv_attention(query, key, value, mask, is_causal, scale)
     else:
         mask = mask[..., :seq_length, :kv_length] if mask is not None else None
 
@@ -375,6 +430,75 @@ def moe_softmax_topk(router_logits: torch.Tensor, top_k: int, norm_topk_prob: bo
     return selected_experts, routing_weights
 
 
+_moe_executor = None
+_moe_executor_lock = threading.Lock()
+
+
+def _get_moe_executor(num_threads: int):
+    global _moe_executor
+    with _moe_executor_lock:
+        if _moe_executor is None or _moe_executor._max_workers != num_threads:
+            _moe_executor = ThreadPoolExecutor(max_workers=num_threads,
+                                               thread_name_prefix="moe_expert")
+    return _moe_executor
+
+
+def use_sorted_moe(hidden_states: torch.Tensor):
+    return hidden_states.device.type == "cpu" and hidden_states.size(0) > 1
+
+
+def moe_sorted_forward(experts, hidden_states: torch.Tensor, selected_experts: torch.Tensor,
+                       routing_weights: torch.Tensor = None):
+    """
+    Run the routed experts of a MoE block on cpu.
+
+    The (token, expert) pairs are sorted by expert once, so every expert runs one low-bit
+    GEMM on a contiguous slice of its tokens, and the outputs are scattered back to their
+    tokens with a single `index_add_`. With `IPEX_LLM_MOE_THREADS=n`, the experts run in
+    `n` threads, which helps when every expert only gets a few tokens.
+
+    :param experts: the expert modules, indexed by the values of `selected_experts`.
+    :param hidden_states: [num_tokens, hidden_dim]
+    :param selected_experts: [num_tokens, top_k]
+    :param routing_weights: [num_tokens, top_k], or None to sum the expert outputs unweighted.
+    """
+    num_tokens, hidden_dim = hidden_states.shape
+    top_k = selected_experts.size(1)
+    sorted_experts, order = torch.sort(selected_experts.view(-1), stable=True)
+    token_idx = order // top_k
+    counts = torch.bincount(sorted_experts, minlength=len(experts)).tolist()
+    sorted_states = hidden_states.index_select(0, token_idx)
+    outputs = torch.empty((num_tokens * top_k, hidden_dim),
+                          dtype=hidden_states.dtype, device=hidden_states.device)
+
+    slices = []
+    start = 0
+    for expert_idx, count in enumerate(counts):
+        if count > 0:
+            slices.append((expert_idx, start, start + count))
+            start += count
+
+    def run_expert(expert_idx, start, end):
+        outputs[start:end] = experts[expert_idx](sorted_states[start:end])
+
+    num_threads = int(os.environ.get("IPEX_LLM_MOE_THREADS", "0"))
+    if num_threads > 1 and len(slices) > 1:
+        executor = _get_moe_executor(num_threads)
+        for future in [executor.submit(run_expert, *args) for args in slices]:
+            future.result()
+    else:
+        for args in slices:
+            run_expert(*args)
+
+    if routing_weights is not None:
+        outputs.mul_(routing_weights.view(-1).index_select(0, order).unsqueeze(-1)
+                     .to(outputs.dtype))
+    final_hidden_states = torch.zeros((num_tokens, hidden_dim),
+                                      dtype=hidden_states.dtype, device=hidden_states.device)
+    final_hidden_states.index_add_(0, token_idx, outputs)
+    return final_hidden_states
+
+
 # q,k,v_proj should be ipex-llm quantized linears
 def merge_quantized_qkv(q_proj, k_proj, v_proj, module):
     from ipex_llm.transformers.low_bit_linear import FP4Params
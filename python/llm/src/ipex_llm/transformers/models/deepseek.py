@@ -32,6 +32,7 @@ from ipex_llm.utils.common.log4Error import invalidInputError
 from ipex_llm.transformers.kv import DynamicNormalCache
 from ipex_llm.transformers.models.common import padding_mla_v_hd_base
 from ipex_llm.transformers.models.common import scaled_dot_product_attention
+from ipex_llm.transformers.models.common import use_sorted_moe, moe_sorted_forward
 from ipex_llm.transformers.models.utils import rotate_half, use_fuse_moe
 
 
@@ -334,6 +335,8 @@ def deepseek_moe_forward(self, hidden_states: torch.Tensor):
         # IPEX-LLM OPT start: add special moe_infer implementation for decoding
         if topk_idx.size(0) == 1 and self.ep_size == 1:
             y = moe_infer_decode(self, hidden_states, topk_idx, topk_weight)
+        elif self.ep_size == 1 and use_sorted_moe(hidden_states):
+            y = moe_sorted_forward(self.experts, hidden_states, topk_idx, topk_weight)
         else:
             y = self.moe_infer(hidden_states, topk_idx, topk_weight)
         y = y.view(*orig_shape)
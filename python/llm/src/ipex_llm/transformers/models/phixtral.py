@@ -39,6 +39,7 @@
 """ PyTorch Phixtral model."""
 import torch
 import torch.nn.functional as F
+from ipex_llm.transformers.models.common import use_sorted_moe, moe_sorted_forward
 
 
 def phixtral_moeblock_forward(self, hidden_states: torch.Tensor):
@@ -57,7 +58,10 @@ def phixtral_moeblock_forward(self, hidden_states: torch.Tensor):
     # we cast back to the input dtype
     routing_weights = routing_weights.to(hidden_states.dtype)
 
-    if bs > 1:
+    if use_sorted_moe(hidden_states):
+        # phixtral sums the outputs of its experts without the routing weights
+        final_hidden_states = moe_sorted_forward(self.mlp, hidden_states, selected_experts)
+    elif bs > 1:
         final_hidden_states = torch.zeros(
             (batch_size * sequence_length, hidden_dim),
             dtype=hidden_states.dtype,
@@ -44,6 +44,7 @@ from torch.nn import CrossEntropyLoss
 from typing import Optional, Tuple, Union, List
 from ipex_llm.utils.common import invalidInputError
 from ipex_llm.transformers.models.common import merge_qkv_base
+from ipex_llm.transformers.models.common import use_sorted_moe, moe_sorted_forward
 from ipex_llm.transformers.models.utils import use_quantize_kv_cache
 from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicNormalCache
 
@@ -397,6 +398,9 @@ def qwen2moe_moeblock_forward(self, hidden_states: torch.Tensor):
                 final_hidden_states = expert_layer(hidden_states) * weight
             else:
                 final_hidden_states = final_hidden_states + expert_layer(hidden_states) * weight
+    elif use_sorted_moe(hidden_states):
+        final_hidden_states = moe_sorted_forward(self.experts, hidden_states,
+                                                 selected_experts, routing_weights)
     elif bs < 256 and hidden_states.device.type == 'xpu':
         final_hidden_states = torch.zeros((batch_size * sequence_length, hidden_dim),
                                           dtype=hidden_states.dtype, device=hidden_states.device)
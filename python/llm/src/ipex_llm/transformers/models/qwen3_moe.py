@@ -24,6 +24,7 @@ from transformers.models.qwen3_moe.modeling_qwen3_moe import Qwen3MoeModel, Qwen
 
 from ipex_llm.transformers.kv import DynamicNormalCache
 from ipex_llm.transformers.models.common import merge_qkv_base
+from ipex_llm.transformers.models.common import use_sorted_moe, moe_sorted_forward
 from ipex_llm.transformers.models.utils import use_fuse_moe
 
 
@@ -113,6 +114,9 @@ def qwen3_moe_moe_forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
             outs = torch.cat(outputs, dim=0)
             reshaped_topk_weight = routing_weights.squeeze(0).unsqueeze(-1)
             final_hidden_states = (outs * reshaped_topk_weight).sum(dim=0, keepdim=True)
+    elif use_sorted_moe(hidden_states):
+        final_hidden_states = moe_sorted_forward(self.experts, hidden_states,
+                                                 selected_experts, routing_weights)
     else:
         final_hidden_states = torch.zeros(
             (batch_size * sequence_length, hidden_dim),
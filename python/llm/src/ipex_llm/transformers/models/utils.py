@@ -181,7 +181,121 @@ def append_unbalanced_fp8_kv_cache(k_cache, v_cache, key, value):
     return new_k_cache, new_v_cache
 
 
+def get_cpu_kv_quant_type():
+    qtype = os.environ.get("IPEX_LLM_CPU_KV_QUANT_TYPE", "int8").lower()
+    invalidInputError(qtype in ["int8", "int4"],
+                      f"IPEX_LLM_CPU_KV_QUANT_TYPE should be int8 or int4, but got {qtype}")
+    return qtype
+
+
+# The cpu quantized kv cache stores every token of every head as one row of bytes:
+# int8: `head_dim` int8 values and a fp32 scale, symmetric
+# int4: `head_dim // 2` bytes of packed uint4 values, a fp32 scale and a fp32 min
+def init_cpu_quant_kv_cache(batch_size, num_heads, current_length, head_dim, qtype, device):
+    if qtype == "int4" and head_dim % 8 != 0:
+        qtype = "int8"
+    invalidInputError(head_dim % 4 == 0,
+                      f"Quantized cpu kv cache requires head_dim % 4 == 0, but got {head_dim}")
+    if qtype == "int8":
+        dtype, row_size = torch.int8, head_dim + 4
+    else:
+        dtype, row_size = torch.uint8, head_dim // 2 + 8
+    max_length = current_length + FP8_KV_ALLOC_LENGTH
+
+    k_cache_storage = torch.empty(batch_size, num_heads, max_length, row_size,
+                                  dtype=dtype, device=device)
+    k_cache = k_cache_storage.as_strided((batch_size, num_heads, 0, row_size),
+                                         k_cache_storage.stride(), storage_offset=0)
+
+    v_cache_storage = torch.empty(batch_size, num_heads, max_length, row_size,
+                                  dtype=dtype, device=device)
+    v_cache = v_cache_storage.as_strided((batch_size, num_heads, 0, row_size),
+                                         v_cache_storage.stride(), storage_offset=0)
+    return k_cache, v_cache
+
+
+def cpu_quant_kv_head_dim(cache: torch.Tensor):
+    if cache.dtype == torch.int8:
+        return cache.size(-1) - 4
+    return (cache.size(-1) - 8) * 2
+
+
+def quantize_cpu_kv(states: torch.Tensor, out: torch.Tensor):
+    # quantize `states` into the rows `out` of a cpu quantized kv cache
+    head_dim = states.size(-1)
+    states = states.float()
+    if out.dtype == torch.int8:
+        scale = states.abs().amax(-1, keepdim=True).clamp_(min=1e-8) / 127
+        out[..., :head_dim] = (states / scale).round_().clamp_(-127, 127).to(torch.int8)
+        out[..., head_dim:].view(torch.float32).copy_(scale)
+    else:
+        min_value = states.amin(-1, keepdim=True)
+        scale = (states.amax(-1, keepdim=True) - min_value).clamp_(min=1e-8) / 15
+        q = ((states - min_value) / scale).round_().clamp_(0, 15).to(torch.uint8)
+        out[..., :head_dim // 2] = q[..., 0::2] | (q[..., 1::2] << 4)
+        meta = out[..., head_dim // 2:].view(torch.float32)
+        meta[..., 0:1].copy_(scale)
+        meta[..., 1:2].copy_(min_value)
+
+
+def split_cpu_quant_kv(cache: torch.Tensor):
+    """
+    Split rows of a cpu quantized kv cache into fp32 quantized values, scales and mins
+    (None for int8), the kv is `values * scales + mins`.
+    """
+    head_dim = cpu_quant_kv_head_dim(cache)
+    if cache.dtype == torch.int8:
+        values = cache[..., :head_dim].float()
+        scales = cache[..., head_dim:].view(torch.float32)
+        return values, scales, None
+    packed = cache[..., :head_dim // 2]
+    values = torch.stack((packed & 0xF, packed >> 4), dim=-1)
+    values = values.reshape(*packed.shape[:-1], head_dim).float()
+    meta = cache[..., head_dim // 2:].view(torch.float32)
+    return values, meta[..., 0:1], meta[..., 1:2]
+
+
+def append_cpu_quant_kv_cache(k_cache, v_cache, key, value):
+    batch_size, num_heads, cur_length, row_size = k_cache.shape
+    new_length = cur_length + key.size(2)
+    new_size = (batch_size, num_heads, new_length, row_size)
+
+    if k_cache.stride(1) < new_length * row_size:
+        # grow geometrically, so that a long generation copies O(n) tokens in total
+        capacity = k_cache.stride(1) // row_size
+        qtype = "int8" if k_cache.dtype == torch.int8 else "int4"
+        new_k_cache, new_v_cache = init_cpu_quant_kv_cache(
+            batch_size, num_heads, max(new_length, capacity * 2), key.size(3), qtype,
+            key.device
+        )
+        new_k_cache = new_k_cache.as_strided(new_size, new_k_cache.stride(), storage_offset=0)
+        new_v_cache = new_v_cache.as_strided(new_size, new_v_cache.stride(), storage_offset=0)
+        new_k_cache[:, :, :cur_length, :] = k_cache
+        new_v_cache[:, :, :cur_length, :] = v_cache
+    else:
+        new_k_cache = k_cache.as_strided(new_size, k_cache.stride(), storage_offset=0)
+        new_v_cache = v_cache.as_strided(new_size, v_cache.stride(), storage_offset=0)
+
+    quantize_cpu_kv(key, new_k_cache[:, :, cur_length:new_length, :])
+    quantize_cpu_kv(value, new_v_cache[:, :, cur_length:new_length, :])
+
+    return new_k_cache, new_v_cache
+
+
 def restore_fp8_kv_cache(k_cache, v_cache, dtype):
+    if k_cache.device.type == "cpu":
+        if k_cache.is_floating_point():
+            # the first forward attends to the unquantized kv
+            return k_cache.to(dtype), v_cache.to(dtype)
+        k_values, k_scales, k_mins = split_cpu_quant_kv(k_cache)
+        v_values, v_scales, v_mins = split_cpu_quant_kv(v_cache)
+        key_states = k_values * k_scales
+        value_states = v_values * v_scales
+        if k_mins is not None:
+            key_states += k_mins
+            value_states += v_mins
+        return key_states.to(dtype), value_states.to(dtype)
+
     key_states = torch.empty(k_cache.shape, device=k_cache.device, dtype=dtype)
     value_states = torch.empty(v_cache.shape, device=v_cache.device, dtype=dtype)
 
@@ -32,10 +32,10 @@ from transformers import GenerationConfig, LogitsProcessorList, StoppingCriteria
 from transformers.modeling_outputs import BaseModelOutputWithPast, CausalLMOutputWithPast
 from ipex_llm.utils.common import invalidInputError
 from ipex_llm.ggml.quantize import ggml_tensor_qtype
+from ipex_llm.transformers.streamer import IncrementalDetokenizer
 import logging
 logger = logging.getLogger(__name__)
 import asyncio
-import uuid
 import threading
 import pickle
 try:
@@ -105,11 +105,60 @@ class Dummy_GLMBlock(nn.Module):
         return hidden_states, kv_cache
 
 
-def init_pipeline_parallel():
-    import oneccl_bindings_for_pytorch
+# device type of the pipeline stages, "xpu" for the ccl backend and "cpu" for gloo
+_pp_device_type = "xpu"
+
+
+def init_pipeline_parallel(backend: Optional[str] = None):
+    """
+    Initialize the process group of pipeline parallel.
+
+    :param backend: "ccl" runs one stage per Intel GPU, "gloo" runs one stage per
+           process on CPU, e.g. one process per NUMA node bound with `numactl`.
+           Default to `IPEX_LLM_PP_BACKEND`, or "ccl" if it is not set.
+    """
+    global _pp_device_type
+    if backend is None:
+        backend = os.environ.get("IPEX_LLM_PP_BACKEND", "ccl")
+    backend = backend.lower()
+    invalidInputError(backend in ["ccl", "gloo"],
+                      f"Unsupported pipeline parallel backend {backend}, "
+                      "only ccl and gloo are supported")
     os.environ["MASTER_ADDR"] = os.environ.get("MASTER_ADDR", "127.0.0.1")
     os.environ["MASTER_PORT"] = os.environ.get("MASTER_PORT", "29500")
-    dist.init_process_group('ccl')
+    if backend == "ccl":
+        import oneccl_bindings_for_pytorch
+        _pp_device_type = "xpu"
+    else:
+        _pp_device_type = "cpu"
+        _set_cpu_stage_threads()
+    dist.init_process_group(backend)
+
+
+def _set_cpu_stage_threads():
+    # split the cores of a host between its stages unless the user has
+    # bound each stage (e.g. with numactl) or set OMP_NUM_THREADS
+    if "OMP_NUM_THREADS" in os.environ or not hasattr(os, "sched_getaffinity"):
+        return
+    cores = len(os.sched_getaffinity(0))
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", "1"))
+    if cores == os.cpu_count() and local_world_size > 1:
+        cores = cores // local_world_size
+    torch.set_num_threads(max(cores, 1))
+
+
+def _pp_device(rank):
+    return "cpu" if _pp_device_type == "cpu" else f"xpu:{rank}"
+
+
+def _pp_synchronize(device=None):
+    if _pp_device_type == "xpu":
+        torch.xpu.synchronize(device)
+
+
+def _pp_empty_cache():
+    if _pp_device_type == "xpu":
+        torch.xpu.empty_cache()
 
 
 def low_mem_convert(model):
@@ -230,7 +279,7 @@ def pipeline_parallel(model, pipeline_parallel_stages, torch_dtype=torch.float32
     model.num_layers = num_layers
     if torch_dtype == torch.float16:
         model = model.half()
-    model = model.to(f'xpu:{local_rank}')
+    model = model.to(_pp_device(local_rank))
     return model
 
 
@@ -368,7 +417,7 @@ def pipeline_parallel_generate(self,
                 _images_feature = 1597 + _input_ids.shape[0] * 2 + _input_ids.shape[1]
                 _inputs_shape = (_input_ids.shape[0], _images_feature, self.config.hidden_size,)
             inputs_embeds = torch.empty(_inputs_shape,
-                                        device=f'xpu:{local_rank}', dtype=self.dtype)
+                                        device=_pp_device(local_rank), dtype=self.dtype)
             dist.recv(inputs_embeds, src=pre_rank)
             outputs = self(input_ids=None, inputs_embeds=inputs_embeds,
                            past_key_values=_past_key_values, use_cache=True, **model_kwargs)
@@ -379,7 +428,7 @@ def pipeline_parallel_generate(self,
             dist.broadcast(next_ids, src=local_rank)
         else:
             dist.send(outputs[0].to(self.dtype), dst=next_rank)
-            next_ids = torch.empty((bs, 1), device=f'xpu:{local_rank}', dtype=torch.int64)
+            next_ids = torch.empty((bs, 1), device=_pp_device(local_rank), dtype=torch.int64)
             dist.broadcast(next_ids, src=self.pipeline_parallel_stages - 1)
 
         _input_ids = next_ids
@@ -456,6 +505,7 @@ class PPConfig:
 
 class BatchTask(BaseModel):
     batch_id: str
+    batch_index: int
     request_ids: List[str]
     max_tokens: int
     batch_size: int
@@ -466,6 +516,78 @@ class BatchTask(BaseModel):
     prefilled_index: int
     partial_prefilling: int
 
+    # rows of the previous step kept in this step after finished requests are removed,
+    # and the number of leading kv positions which are padding of all kept rows
+    kept_rows: Optional[List[int]] = None
+    kv_trim: int = 0
+    # number of rows at the end of the batch which are prefilled in this step
+    joining: int = 0
+
+
+# Layout of the int64 control tensor rank 0 broadcasts to the other stages in every
+# serving step, followed by `prompt_lengths` and `kept_rows`, each padded to
+# `max_num_seqs`. Request ids and `max_tokens` are only used by rank 0 and are never sent.
+_CTRL_BATCH_INDEX = 0
+_CTRL_BATCH_SIZE = 1
+_CTRL_INPUT_LEN = 2
+_CTRL_PREFILLED_INDEX = 3
+_CTRL_PARTIAL_PREFILLING = 4
+_CTRL_STOPPED = 5
+_CTRL_NUM_KEPT_ROWS = 6
+_CTRL_KV_TRIM = 7
+_CTRL_JOINING = 8
+_CTRL_HEADER_LEN = 9
+
+
+def batch_control_length(max_num_seqs):
+    return _CTRL_HEADER_LEN + 2 * max_num_seqs
+
+
+def encode_batch_control(batch, max_num_seqs, device):
+    control = [0] * batch_control_length(max_num_seqs)
+    control[_CTRL_BATCH_INDEX] = batch.batch_index
+    control[_CTRL_BATCH_SIZE] = batch.batch_size
+    control[_CTRL_INPUT_LEN] = batch.input_len
+    control[_CTRL_PREFILLED_INDEX] = batch.prefilled_index
+    control[_CTRL_PARTIAL_PREFILLING] = batch.partial_prefilling
+    control[_CTRL_STOPPED] = int(batch.stopped)
+    control[_CTRL_KV_TRIM] = batch.kv_trim
+    control[_CTRL_JOINING] = batch.joining
+    control[_CTRL_HEADER_LEN:_CTRL_HEADER_LEN + batch.batch_size] = batch.prompt_lengths
+    if batch.kept_rows is None:
+        control[_CTRL_NUM_KEPT_ROWS] = -1
+    else:
+        control[_CTRL_NUM_KEPT_ROWS] = len(batch.kept_rows)
+        start = _CTRL_HEADER_LEN + max_num_seqs
+        control[start:start + len(batch.kept_rows)] = batch.kept_rows
+    return torch.tensor(control, dtype=torch.int64, device=device)
+
+
+def decode_batch_control(control, max_num_seqs):
+    control = control.tolist()
+    batch_index = control[_CTRL_BATCH_INDEX]
+    batch_size = control[_CTRL_BATCH_SIZE]
+    num_kept_rows = control[_CTRL_NUM_KEPT_ROWS]
+    kept_rows = None
+    if num_kept_rows >= 0:
+        start = _CTRL_HEADER_LEN + max_num_seqs
+        kept_rows = control[start:start + num_kept_rows]
+    return BatchTask(
+        batch_id=f"batch_{batch_index}",
+        batch_index=batch_index,
+        request_ids=[],
+        max_tokens=0,
+        batch_size=batch_size,
+        input_len=control[_CTRL_INPUT_LEN],
+        prompt_lengths=control[_CTRL_HEADER_LEN:_CTRL_HEADER_LEN + batch_size],
+        stopped=bool(control[_CTRL_STOPPED]),
+        prefilled_index=control[_CTRL_PREFILLED_INDEX],
+        partial_prefilling=control[_CTRL_PARTIAL_PREFILLING],
+        kept_rows=kept_rows,
+        kv_trim=control[_CTRL_KV_TRIM],
+        joining=control[_CTRL_JOINING],
+    )
+
 
 def make_attention_mask(prompt_lengths, device):
     max_length = max(prompt_lengths)
@@ -482,8 +604,10 @@ def make_attention_mask(prompt_lengths, device):
 class PPModelWorker:
     """Implementation for pipeline parallel multi-stage serving."""
     def __init__(self, checkpoint, rank, world_size, low_bit, max_num_seqs, max_prefilled_seqs,
-                 torch_dtype=torch.float16):
+                 torch_dtype=None):
         self.pp_config = PPConfig(rank, world_size)
+        if torch_dtype is None:
+            torch_dtype = torch.float32 if _pp_device_type == "cpu" else torch.float16
         self.dtype = torch_dtype
         start = time.perf_counter()
         model = self.load_model(checkpoint, world_size, low_bit)
@@ -500,18 +624,19 @@ class PPModelWorker:
         self.on_going_batches = [None] * self.world_size
         self.input_ids_dict = {}
         self.past_key_values_dict = {}
-        self.tokens = {}
+        self.request_tokens = {}
+        self.request_limits = {}
+        self.pending_ids_dict = {}
+        self.eos_token_ids = None
         self.token_times = {}
         self.waiting_requests = asyncio.Queue()
         self.send_buff = None
         self.dict_lock = threading.Lock()
         self.streamer = {}
-        self.token_cache = {}
-        self.print_len = {}
-        self.is_finish = {}
+        self.detokenizers = {}
         self.model_name = checkpoint
 
-        self.device = f"xpu:{self.rank}"
+        self.device = _pp_device(self.rank)
         # self.layer_start = 0
         # self.layer_end = 0
 
@@ -520,6 +645,10 @@ class PPModelWorker:
 
         self.stream_tasks = {}
 
+        self.num_batches = 0
+        self.control_buff = torch.empty((batch_control_length(self.max_num_seqs),),
+                                        dtype=torch.int64, device=self.device)
+
     def load_model(self, model_path, world_size, low_bit='sym_int4'):
         from ipex_llm.transformers import AutoModelForCausalLM, AutoModel
         try:
@@ -618,6 +747,97 @@ class PPModelWorker:
 
         return kv_cache
 
+    def kv_layout(self, kv_cache):
+        """
+        Return the batch dim and the sequence dim of the kv tensors in `kv_cache`,
+        or None if rows could not be removed from or added to a running batch.
+        """
+        model_type = self.model.config.model_type
+        if hasattr(kv_cache, "key_cache"):
+            return 0, 2
+        elif model_type == "chatglm":
+            # glm-4-9b-chat keeps its kv of all layers in one tensor
+            return None if self.model.config.num_layers == 40 else (1, 0)
+        elif model_type in ["baichuan", "mixtral"]:
+            return 0, 2
+        return None
+
+    def _map_kv_cache(self, fn, kv_cache, *other_kv_caches):
+        # apply `fn` to every kv tensor of `kv_cache` and the same tensors of `other_kv_caches`
+        if hasattr(kv_cache, "key_cache"):
+            kv_cache.key_cache = [fn(*ts) for ts in zip(kv_cache.key_cache,
+                                                        *[c.key_cache for c in other_kv_caches])]
+            kv_cache.value_cache = [fn(*ts) for ts in zip(kv_cache.value_cache,
+                                                          *[c.value_cache
+                                                            for c in other_kv_caches])]
+            return kv_cache
+        # placeholders of the layers on other stages are shared, map each of them once
+        mapped = {}
+
+        def map_tensor(*ts):
+            if not isinstance(ts[0], torch.Tensor):
+                return ts[0]
+            if id(ts[0]) not in mapped:
+                mapped[id(ts[0])] = fn(*ts)
+            return mapped[id(ts[0])]
+
+        return tuple(tuple(map_tensor(*ts) for ts in zip(*layers))
+                     if isinstance(layers[0], tuple) else map_tensor(*layers)
+                     for layers in zip(kv_cache, *other_kv_caches))
+
+    def select_kv_cache(self, kv_cache, kept_rows, trim):
+        """
+        Keep the batch rows `kept_rows` of `kv_cache` and drop its first `trim`
+        positions, which are left padding of all these rows.
+        """
+        batch_dim, seq_dim = self.kv_layout(kv_cache)
+        rows = torch.tensor(kept_rows, device=self.device)
+
+        def select(t):
+            t = t.index_select(batch_dim, rows)
+            if trim > 0:
+                t = t.narrow(seq_dim, trim, t.size(seq_dim) - trim).contiguous()
+            return t
+
+        kv_cache = self._map_kv_cache(select, kv_cache)
+        if trim > 0 and hasattr(kv_cache, "key_cache"):
+            self._add_seen_tokens(kv_cache, -trim)
+        return kv_cache
+
+    def merge_kv_cache(self, kv_cache_1, kv_cache_2):
+        """
+        Append the batch rows of `kv_cache_2` to `kv_cache_1`, left padding the
+        shorter one so that both end at the latest token.
+        """
+        batch_dim, seq_dim = self.kv_layout(kv_cache_1)
+        if hasattr(kv_cache_1, "key_cache"):
+            length_1 = kv_cache_1.key_cache[0].size(seq_dim)
+
+        def merge(t1, t2):
+            length = max(t1.size(seq_dim), t2.size(seq_dim))
+            shape = list(t1.shape)
+            shape[batch_dim] = t1.size(batch_dim) + t2.size(batch_dim)
+            shape[seq_dim] = length
+            t = t1.new_zeros(shape)
+            for start, src in [(0, t1), (t1.size(batch_dim), t2)]:
+                t.narrow(batch_dim, start, src.size(batch_dim)) \
+                    .narrow(seq_dim, length - src.size(seq_dim), src.size(seq_dim)).copy_(src)
+            return t
+
+        kv_cache = self._map_kv_cache(merge, kv_cache_1, kv_cache_2)
+        if hasattr(kv_cache, "key_cache"):
+            self._add_seen_tokens(kv_cache, kv_cache.key_cache[0].size(seq_dim) - length_1)
+        return kv_cache
+
+    @staticmethod
+    def _add_seen_tokens(kv_cache, num_tokens):
+        if hasattr(kv_cache, "_seen_tokens"):
+            # 4.39 uses `_seen_tokens`
+            kv_cache._seen_tokens += num_tokens
+        else:
+            # 4.37 uses `seen_tokens`
+            kv_cache.seen_tokens += num_tokens
+
     @torch.no_grad()
     def model_step(self, input, cur_batch):
         if cur_batch is None or cur_batch.stopped or input is None:
@@ -625,8 +845,20 @@ class PPModelWorker:
 
         # logger.info(f"{self.rank} {cur_batch} {input.shape}")
         cur_id = cur_batch.batch_id
+        if cur_batch.kept_rows is not None:
+            self.past_key_values_dict[cur_id] = self.select_kv_cache(
+                self.past_key_values_dict[cur_id], cur_batch.kept_rows, cur_batch.kv_trim)
+            cur_batch.kept_rows = None
+            cur_batch.kv_trim = 0
         _past_key_values = self.past_key_values_dict.get(cur_id, None)
-        attention_mask = make_attention_mask(cur_batch.prompt_lengths, input.device)
+        if cur_batch.joining > 0:
+            # prefill the joining rows alone, their kv is merged into the running rows below
+            attention_mask = make_attention_mask(cur_batch.prompt_lengths[-cur_batch.joining:],
+                                                 input.device)
+            running_past_key_values = _past_key_values
+            _past_key_values = None
+        else:
+            attention_mask = make_attention_mask(cur_batch.prompt_lengths, input.device)
 
         if self.rank == 0:
             input_ids = input
@@ -650,7 +882,7 @@ class PPModelWorker:
                 tmp_past_key_values = _past_key_values
                 _past_key_values = None
 
-        torch.xpu.empty_cache()
+        _pp_empty_cache()
         output = self.model(input_ids=input_ids,
                             inputs_embeds=inputs_embeds,
                             past_key_values=_past_key_values,
@@ -681,11 +913,15 @@ class PPModelWorker:
                 else:
                     _pre_output = torch.cat((_pre_output, tmp_output), dim=0)
                 self.partial_output_dict[cur_id] = _pre_output
+        elif cur_batch.joining > 0:
+            _past_key_values = self.update_kv_cache(output.past_key_values, prefill=True)
+            self.past_key_values_dict[cur_id] = self.merge_kv_cache(running_past_key_values,
+                                                                    _past_key_values)
         else:
             _prefill = self.past_key_values_dict.get(cur_id, None) is None
             _past_key_values = self.update_kv_cache(output.past_key_values, prefill=_prefill)
             self.past_key_values_dict[cur_id] = _past_key_values
-        torch.xpu.synchronize()
+        _pp_synchronize()
         if not self.pp_config.is_tail:
             _output = output[0]
             if _output.dtype != self.dtype:
@@ -702,9 +938,22 @@ class PPModelWorker:
     def is_initialized(self):
         return True
 
-    async def add_request(self, tokenizer):
+    def get_eos_token_ids(self, tokenizer):
+        if self.eos_token_ids is None:
+            eos_token_ids = self.model.generation_config.eos_token_id
+            if eos_token_ids is None:
+                eos_token_ids = []
+            elif isinstance(eos_token_ids, int):
+                eos_token_ids = [eos_token_ids]
+            eos_token_ids = set(eos_token_ids)
+            if tokenizer.eos_token_id is not None:
+                eos_token_ids.add(tokenizer.eos_token_id)
+            self.eos_token_ids = eos_token_ids
+        return self.eos_token_ids
+
+    async def pop_requests(self, tokenizer, max_num_seqs):
         request_ids, prompt_requests = [], []
-        for _ in range(self.max_num_seqs):
+        for _ in range(max_num_seqs):
             if self.waiting_requests.empty():
                 break
 
@@ -715,32 +964,93 @@ class PPModelWorker:
 
         plain_texts = [req.inputs for req in prompt_requests]
         inputs = tokenizer(plain_texts, return_tensors="pt", padding=True)
-        input_ids = inputs.input_ids.to(f'xpu:{self.rank}')
-        attention_mask = inputs.attention_mask.to(f'xpu:{self.rank}')
+        input_ids = inputs.input_ids.to(self.device)
+        prompt_lengths = inputs.attention_mask.sum(dim=1).tolist()
+        for request_id, req in zip(request_ids, prompt_requests):
+            self.request_tokens[request_id] = []
+            self.request_limits[request_id] = (req.parameters.min_new_tokens or 0,
+                                               req.parameters.max_new_tokens)
+        return request_ids, prompt_requests, input_ids, prompt_lengths
+
+    async def add_request(self, tokenizer):
+        request_ids, prompt_requests, input_ids, prompt_lengths = \
+            await self.pop_requests(tokenizer, self.max_num_seqs)
         new_batch = BatchTask(
-            batch_id="batch_" + str(uuid.uuid4()),
+            batch_id=f"batch_{self.num_batches}",
+            batch_index=self.num_batches,
             request_ids=request_ids,
             max_tokens=max([req.parameters.max_new_tokens for req in prompt_requests]),
             batch_size=input_ids.size(0),
             input_len=input_ids.size(1),
-            prompt_lengths=[sum(attention_mask[i, :]) for i in range(input_ids.size(0))],
+            prompt_lengths=prompt_lengths,
             stopped=False,
             prefilled_index=0,
             partial_prefilling=0,
         )
 
+        self.num_batches += 1
         self.input_ids_dict[new_batch.batch_id] = input_ids
         self.token_times[new_batch.batch_id] = [time.perf_counter()]
 
         return new_batch
 
+    async def join_requests(self, tokenizer, cur_batch, cur_input):
+        # admit waiting requests into the free rows of a running batch, they are
+        # prefilled in the next step while the running rows wait for one step
+        num_free = self.max_num_seqs - cur_batch.batch_size
+        if self.max_prefilled_seqs > 0:
+            num_free = min(num_free, self.max_prefilled_seqs)
+        if num_free <= 0 or self.waiting_requests.empty() or \
+                self.kv_layout(self.past_key_values_dict[cur_batch.batch_id]) is None:
+            return cur_input
+        request_ids, prompt_requests, input_ids, prompt_lengths = \
+            await self.pop_requests(tokenizer, num_free)
+        self.pending_ids_dict[cur_batch.batch_id] = cur_input
+        cur_batch.request_ids = cur_batch.request_ids + request_ids
+        cur_batch.prompt_lengths = cur_batch.prompt_lengths + prompt_lengths
+        cur_batch.max_tokens = max([cur_batch.max_tokens] +
+                                   [req.parameters.max_new_tokens for req in prompt_requests])
+        cur_batch.batch_size += len(request_ids)
+        cur_batch.prefilled_index = cur_batch.batch_size
+        cur_batch.input_len = input_ids.size(1)
+        cur_batch.joining = len(request_ids)
+        return input_ids
+
+    def update_requests(self, tokenizer, result_dict, request_ids, next_ids):
+        """
+        Record the new token of every request and return the remaining token budget of
+        each one, 0 for the requests finished by eos or `max_new_tokens` in this step and
+        None for the requests finished before, which are kept in batches whose kv rows
+        could not be removed.
+        """
+        ignore_eos = os.environ.get("IPEX_LLM_PP_IGNORE_EOS", "0") == "1"
+        eos_token_ids = self.get_eos_token_ids(tokenizer)
+        remains = []
+        for request_id, token_id in zip(request_ids, next_ids):
+            tokens = self.request_tokens.get(request_id, None)
+            if tokens is None:
+                remains.append(None)
+                continue
+            tokens.append(token_id)
+            min_new_tokens, max_new_tokens = self.request_limits[request_id]
+            remain = max_new_tokens - len(tokens)
+            if not ignore_eos and token_id in eos_token_ids and len(tokens) >= min_new_tokens:
+                remain = 0
+            if remain <= 0:
+                remain = 0
+                with self.dict_lock:
+                    result_dict[request_id] = tokenizer.decode(tokens,
+                                                               skip_special_tokens=False)
+                self.request_tokens.pop(request_id, None)
+                self.request_limits.pop(request_id, None)
+            remains.append(remain)
+        return remains
+
     def clear_batch(self, cur_id):
         self.input_ids_dict.pop(cur_id, None)
-        self.tokens.pop(cur_id, None)
         self.token_times.pop(cur_id, None)
         self.past_key_values_dict.pop(cur_id, None)
-
-        self.is_finish.pop(cur_id, None)
+        self.pending_ids_dict.pop(cur_id, None)
         self.partial_output_dict.pop(cur_id, None)
 
     async def wait_stream_output(self, cur_id):
@@ -748,69 +1058,36 @@ class PPModelWorker:
         if cur_task is not None:
             await cur_task
 
-    def get_printable_text(self, cur_text, request_id):
-        if cur_text.endswith("\n"):
-            printable_text = cur_text[self.print_len[request_id]:]
-            self.token_cache[request_id] = []
-            self.print_len[request_id] = 0
-        elif len(cur_text) > 0 and _is_chinese_char(ord(cur_text[-1])):
-            printable_text = cur_text[self.print_len[request_id]:]
-            self.print_len[request_id] += len(printable_text)
-            self.token_cache[request_id] = []
-            self.print_len[request_id] = 0
-        else:
-            r_index = cur_text.rfind(" ") + 1
-            if r_index > self.print_len[request_id]:
-                printable_text = cur_text[self.print_len[request_id]: r_index]
-                self.token_cache[request_id] = self.token_cache[request_id][-1:]
-                self.print_len[request_id] = 0
-            else:
-                printable_text = cur_text[self.print_len[request_id]: r_index]
-        return printable_text
-
-    async def stream_output(self, cur_batch, tokenizer, next_ids):
-        cur_id = cur_batch.batch_id
-        cur_cached_ids = []
+    async def stream_output(self, request_ids, tokenizer, next_ids, remains):
         _stream_tasks = []
-        for index, request_id in enumerate(cur_batch.request_ids):
-            if not self.is_finish.get(request_id, False):
-                if self.token_cache.get(request_id, None) is None:
-                    self.token_cache[request_id] = []
-                    self.print_len[request_id] = 0
-                self.token_cache[request_id].extend(next_ids[index].tolist())
-                cur_cached_ids.append(self.token_cache[request_id])
-
-        for index, request_id in enumerate(cur_batch.request_ids):
-            if not self.is_finish.get(request_id, False):
-                remain = cur_batch.max_tokens - len(self.tokens[cur_id])
-
-                if self.streamer.get(request_id, None) is None:
-                    self.streamer[request_id] = asyncio.Queue()
-
-                # Currently ignore eos for benchmark
-                # if next_ids[index].int() == tokenizer.eos_token_id:
-                #     remain = 0
-                #     self.is_finish[request_id] = True
-
-                cur_text = tokenizer.decode(self.token_cache[request_id])
-                printable_text = self.get_printable_text(cur_text, request_id)
-
-                if remain > 0:
-                    _stream_tasks.append(self.streamer[request_id].put((remain, printable_text)))
-                else:
-                    printable_text = printable_text + cur_text[self.print_len[request_id]:]
-                    self.token_cache.pop(request_id, None)
-                    self.print_len.pop(request_id, None)
-                    _stream_tasks.append(self.streamer[request_id].put((remain, printable_text)))
+        for request_id, token_id, remain in zip(request_ids, next_ids, remains):
+            if remain is None:
+                continue
+            detokenizer = self.detokenizers.get(request_id, None)
+            if detokenizer is None:
+                detokenizer = IncrementalDetokenizer(tokenizer)
+                self.detokenizers[request_id] = detokenizer
+
+            if self.streamer.get(request_id, None) is None:
+                self.streamer[request_id] = asyncio.Queue()
+
+            printable_text = detokenizer.put([token_id])
+            if remain == 0:
+                printable_text = printable_text + detokenizer.flush()
+                self.detokenizers.pop(request_id, None)
+            _stream_tasks.append(self.streamer[request_id].put((remain, printable_text)))
         await asyncio.gather(*_stream_tasks)
 
     async def process_step(self, tokenizer, result_dict, processor=None):
         cur_batch = None
-        torch.xpu.synchronize(self.device)
+        _pp_synchronize(self.device)
         if self.rank == 0:
-            if self.on_going_batches[0] is not None:
-                cur_batch = self.on_going_batches[0]
-                cur_input = None
+            cur_batch = self.on_going_batches[0]
+            cur_input = None
+            if cur_batch is not None and cur_batch.stopped:
+                # the other stages have cleared it when it was stopped,
+                # so the slot could take a new batch right away
+                cur_batch = None
 
             if cur_batch is None:
                 if not self.waiting_requests.empty():
@@ -818,105 +1095,117 @@ class PPModelWorker:
                     await asyncio.sleep(0.01)
                     cur_batch = await self.add_request(tokenizer)
                     cur_input = self.input_ids_dict[cur_batch.batch_id]
-                else:
-                    cur_batch = None
-                    cur_input = None
-
-            if (cur_batch is not None) and (not cur_batch.stopped) and (cur_input is None):
+            else:
                 cur_id = cur_batch.batch_id
                 if cur_batch.prefilled_index >= cur_batch.batch_size:
                     cur_batch.partial_prefilling = 0
                 if cur_batch.partial_prefilling > 0:
-                    next_ids = torch.empty((cur_batch.partial_prefilling, 1,),
-                                           device=f'xpu:{self.rank}', dtype=torch.int64)
+                    num_rows = cur_batch.partial_prefilling
+                elif cur_batch.joining > 0:
+                    num_rows = cur_batch.joining
                 else:
-                    next_ids = torch.empty((cur_batch.batch_size, 1,),
-                                           device=f'xpu:{self.rank}', dtype=torch.int64)
+                    num_rows = cur_batch.batch_size
+                next_ids = torch.empty((num_rows, 1,), device=self.device, dtype=torch.int64)
 
                 # logger.info(f"recv {self.rank} {next_ids.shape}")
                 dist.recv(next_ids, src=self.pre_rank)
-                torch.xpu.synchronize(self.device)
+                _pp_synchronize(self.device)
 
                 if cur_batch.partial_prefilling > 0:
                     cur_input = self.input_ids_dict[cur_batch.batch_id]
                 else:
-                    if self.tokens.get(cur_id, None) is None:
-                        self.tokens[cur_id] = []
                     if len(next_ids.shape) == 1:
                         next_ids = next_ids.unsqueeze(0)
-                    self.tokens[cur_id].append(next_ids)
+                    # only the joining rows have new tokens after they are prefilled
+                    first_row = cur_batch.batch_size - num_rows
+                    if cur_batch.joining > 0:
+                        next_ids = torch.cat([self.pending_ids_dict.pop(cur_id), next_ids],
+                                             dim=0)
+                        cur_batch.joining = 0
+                    new_request_ids = cur_batch.request_ids[first_row:]
+                    new_token_ids = next_ids[first_row:, 0].tolist()
+                    remains = self.update_requests(tokenizer, result_dict,
+                                                   new_request_ids, new_token_ids)
                     self.token_times[cur_id].append(time.perf_counter())
                     cur_input = next_ids
                     cur_batch.input_len = 1
-                    cur_batch.prompt_lengths = [x + 1 for x in cur_batch.prompt_lengths]
+                    cur_batch.prompt_lengths = cur_batch.prompt_lengths[:first_row] + \
+                        [x + 1 for x in cur_batch.prompt_lengths[first_row:]]
 
                     pre_task = self.stream_tasks.get(cur_id)
                     if pre_task is not None:
                         await pre_task
                         del self.stream_tasks[cur_id]
                     cur_task = asyncio.create_task(
-                        self.stream_output(cur_batch, tokenizer, next_ids)
+                        self.stream_output(new_request_ids, tokenizer, new_token_ids, remains)
                     )
                     self.stream_tasks[cur_id] = cur_task
 
-                    if len(self.tokens[cur_id]) >= cur_batch.max_tokens:
+                    finished = {request_id for request_id, remain
+                                in zip(new_request_ids, remains) if not remain}
+                    if len(finished) == cur_batch.batch_size:
                         # Finish a batch
-                        outputs = torch.cat(self.tokens[cur_id], dim=1)
-                        outputs = outputs.cpu()
-                        output_strs = tokenizer.batch_decode(outputs, skip_special_tokens=False)
-                        for request_id, output_str in zip(cur_batch.request_ids, output_strs):
-                            with self.dict_lock:
-                                result_dict[request_id] = output_str
-
                         cur_times = self.token_times[cur_id]
-                        first_token = cur_times[1] - cur_times[0]
-                        next_token = (cur_times[-1] - cur_times[1]) / (len(self.tokens[cur_id]) - 1)
-                        logger.info(f"First token latency: {first_token}, "
-                                    f"next token latency: {next_token}")
+                        num_tokens = len(cur_times) - 1
+                        if num_tokens > 1:
+                            first_token = cur_times[1] - cur_times[0]
+                            next_token = (cur_times[-1] - cur_times[1]) / (num_tokens - 1)
+                            logger.info(f"First token latency: {first_token}, "
+                                        f"next token latency: {next_token}")
                         await self.wait_stream_output(cur_id)
                         self.clear_batch(cur_id)
                         cur_batch.stopped = True
-            else:
-                if (cur_batch is not None) and cur_batch.stopped:
-                    cur_batch = None
+                    else:
+                        if len(finished) > 0 and \
+                                self.kv_layout(self.past_key_values_dict[cur_id]) is not None:
+                            # drop the finished rows, the kv of the other stages is
+                            # compacted in the same way in their next `model_step`
+                            kept_rows = [i for i, request_id in enumerate(cur_batch.request_ids)
+                                         if request_id not in finished]
+                            kept_lengths = [cur_batch.prompt_lengths[i] for i in kept_rows]
+                            cur_batch.kept_rows = kept_rows
+                            cur_batch.kv_trim = max(cur_batch.prompt_lengths) - max(kept_lengths)
+                            cur_batch.request_ids = [cur_batch.request_ids[i] for i in kept_rows]
+                            cur_batch.prompt_lengths = kept_lengths
+                            cur_batch.batch_size = len(kept_rows)
+                            cur_input = cur_input[kept_rows]
+                        cur_input = await self.join_requests(tokenizer, cur_batch, cur_input)
 
             if cur_batch is not None:
                 cur_batch = self.prepare_batch(cur_batch)
-                dist.broadcast_object_list([cur_batch], src=0)
+                control = encode_batch_control(cur_batch, self.max_num_seqs, self.device)
+                dist.broadcast(control, src=0)
             else:
                 await asyncio.sleep(0)
 
         else:
-            batch_list = [None]
-            dist.broadcast_object_list(batch_list, src=0)
-            cur_batch = batch_list[0]
+            dist.broadcast(self.control_buff, src=0)
+            cur_batch = decode_batch_control(self.control_buff, self.max_num_seqs)
             cur_input = None
 
-            if cur_batch is not None:
-                if cur_batch.stopped:
-                    self.clear_batch(cur_batch.batch_id)
+            if cur_batch.stopped:
+                self.clear_batch(cur_batch.batch_id)
+            else:
+                cur_batch = self.prepare_batch(cur_batch)
+                cur_len = cur_batch.input_len
+                if cur_batch.partial_prefilling:
+                    num_rows = cur_batch.partial_prefilling
+                elif cur_batch.joining:
+                    num_rows = cur_batch.joining
                 else:
-                    cur_batch = self.prepare_batch(cur_batch)
-                    cur_len = cur_batch.input_len
-                    if cur_batch.partial_prefilling:
-                        cur_input = torch.empty(
-                            (cur_batch.partial_prefilling, cur_len, self.hidden_size,),
-                            device=f'xpu:{self.rank}',
-                            dtype=self.dtype,
-                        )
-                    else:
-                        cur_input = torch.empty(
-                            (cur_batch.batch_size, cur_len, self.hidden_size,),
-                            device=f'xpu:{self.rank}',
-                            dtype=self.dtype,
-                        )
-                    # logger.info(f"recv {self.rank} {cur_input.shape}")
-                    dist.recv(cur_input, src=self.pre_rank)
-                    torch.xpu.synchronize(self.device)
+                    num_rows = cur_batch.batch_size
+                cur_input = torch.empty(
+                    (num_rows, cur_len, self.hidden_size,),
+                    device=self.device,
+                    dtype=self.dtype,
+                )
+                # logger.info(f"recv {self.rank} {cur_input.shape}")
+                dist.recv(cur_input, src=self.pre_rank)
+                _pp_synchronize(self.device)
 
         output, cur_batch = self.model_step(cur_input, cur_batch)
 
-        torch.xpu.synchronize(self.device)
+        _pp_synchronize(self.device)
         if self.send_buff is not None:
             self.send_buff.wait()
         if output is not None:
@@ -927,31 +1216,6 @@ class PPModelWorker:
             self.on_going_batches[self.world_size - 1] = cur_batch
 
 
-def _is_chinese_char(cp):
-    """Checks whether CP is the codepoint of a CJK character."""
-    # This defines a "chinese character" as anything in the CJK Unicode block:
-    #   https://en.wikipedia.org/wiki/CJK_Unified_Ideographs_(Unicode_block)
-    #
-    # Note that the CJK Unicode block is NOT all Japanese and Korean characters,
-    # despite its name. The modern Korean Hangul alphabet is a different block,
-    # as is Japanese Hiragana and Katakana. Those alphabets are used to write
-    # space-separated words, so they are not treated specially and handled
-    # like the all of the other languages.
-    if (
-        (cp >= 0x4E00 and cp <= 0x9FFF)
-        or (cp >= 0x3400 and cp <= 0x4DBF)  #
-        or (cp >= 0x20000 and cp <= 0x2A6DF)  #
-        or (cp >= 0x2A700 and cp <= 0x2B73F)  #
-        or (cp >= 0x2B740 and cp <= 0x2B81F)  #
-        or (cp >= 0x2B820 and cp <= 0x2CEAF)  #
-        or (cp >= 0xF900 and cp <= 0xFAFF)
-        or (cp >= 0x2F800 and cp <= 0x2FA1F)  #
-    ):  #
-        return True
-
-    return False
-
-
 def llama_causallm_forward_4_37_lowmem(
     self,
     input_ids: torch.LongTensor = None,
@@ -996,11 +1260,11 @@ def llama_causallm_forward_4_37_lowmem(
     else:
         # Only empty cache for first token
         if hidden_states.shape[1] > 1:
-            torch.xpu.empty_cache()
+            _pp_empty_cache()
         logits = self.lm_head(hidden_states)
         # Only empty cache for first token
         if hidden_states.shape[1] > 1:
-            torch.xpu.empty_cache()
+            _pp_empty_cache()
     # logits = logits.float()
 
     # ipex-llm change ends
@@ -1064,9 +1328,9 @@ def chatglm3_conditional_generation_forward_lowmem(
         hidden_states = hidden_states[-1:]
 
     # ipex-llm change starts
-    torch.xpu.empty_cache()
+    _pp_empty_cache()
     lm_logits = self.transformer.output_layer(hidden_states)
-    torch.xpu.empty_cache()
+    _pp_empty_cache()
     lm_logits = lm_logits.transpose(0, 1).contiguous()
 
     loss = None
@@ -1129,9 +1393,9 @@ def glm4_conditional_generation_forward_lowmem(
     if return_last_logit:
         hidden_states = hidden_states[:, -1:]
     # ipex-llm change starts
-    torch.xpu.empty_cache()
+    _pp_empty_cache()
     lm_logits = self.transformer.output_layer(hidden_states)
-    torch.xpu.empty_cache()
+    _pp_empty_cache()
 
     loss = None
     if labels is not None:
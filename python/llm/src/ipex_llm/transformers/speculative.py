@@ -43,6 +43,8 @@ import copy
 import logging
 import inspect
 import transformers
+from functools import reduce
+from operator import mul
 from packaging import version
 from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple, Union
 from transformers import GenerationConfig, \
@@ -84,7 +86,7 @@ def generate(
             )
             for var in ['max_step_draft', 'th_stop_draft', 'hf_adjust',
                         'auto_th_stop_draft', 'auto_parameters', 'min_step_draft',
-                        'th_batch_num']:
+                        'th_batch_num', 'num_branches', 'draft_controller']:
                 kwargs.pop(var, None)
             return original_generate(self,
                                      inputs=inputs,
@@ -102,7 +104,8 @@ def generate(
         for var in ['max_new_tokens', 'max_step_draft', 'th_stop_draft', 'do_sample',
                     'top_k', 'top_p', 'temperature', 'hf_adjust',
                     'auto_th_stop_draft', 'auto_parameters', 'repetition_penalty',
-                    'attention_mask', 'min_step_draft', 'eos_token_id']:
+                    'attention_mask', 'min_step_draft', 'eos_token_id', 'num_branches',
+                    'draft_controller']:
             value = kwargs.pop(var, None)
             if value is not None:
                 new_speculative_kwargs[var] = value
@@ -115,7 +118,7 @@ def generate(
         # related to speculative decoding should be removed
         for var in ['max_step_draft', 'th_stop_draft', 'hf_adjust',
                     'auto_th_stop_draft', 'auto_parameters', 'min_step_draft',
-                    'th_batch_num']:
+                    'th_batch_num', 'num_branches', 'draft_controller']:
             kwargs.pop(var, None)
         return original_generate(self,
                                  inputs=inputs,
@@ -186,10 +189,37 @@ def clear_benchmarks(self):
     self.post_time = []
     self.draft_num = []
     self.accept_num = []
+    self.accept_hist = []
+    self.draft_length_trace = []
     self.n_drafted = 0
     self.n_matched = 0
 
 
+def release_past_key_values_storage(self):
+    """Free the cpu kv storage kept on the model for later speculative decoding calls"""
+    self._past_key_values_storage_buffer = None
+
+
+def _trim_past_key_values_storage_cpu(self):
+    # keep the storage for the next call only if it is within
+    # IPEX_LLM_SPECULATIVE_STORAGE_LIMIT_MB, a long or large batch call may need GBs
+    buffer = getattr(self, "_past_key_values_storage_buffer", None)
+    limit = int(os.environ.get("IPEX_LLM_SPECULATIVE_STORAGE_LIMIT_MB", "1024")) * 1024 ** 2
+    if buffer is not None and buffer.numel() * buffer.element_size() > limit:
+        release_past_key_values_storage(self)
+
+
+def _allocate_past_key_values_storage_cpu(self, shape, num, dtype):
+    # `num` tensors of `shape` viewing one flat buffer, which is kept on the model and
+    # reused by later calls as long as it is large enough
+    numel = reduce(mul, shape, 1)
+    buffer = getattr(self, "_past_key_values_storage_buffer", None)
+    if buffer is None or buffer.dtype != dtype or buffer.numel() < numel * num:
+        buffer = torch.empty(numel * num, dtype=dtype)
+        self._past_key_values_storage_buffer = buffer
+    return [buffer[i * numel:(i + 1) * numel].view(shape) for i in range(num)]
+
+
 def _prepare_past_key_values_storage_cpu(self, past_key_values,
                                          max_new_tokens, _enable_ipex=False):
     past_key_values_storage = []
@@ -227,94 +257,74 @@ def _prepare_past_key_values_storage_cpu(self, past_key_values,
                     pkv[2].permute(1, 2, 0, 3)[:, :, :cur_len, :]]
                 for pkv in past_key_values
             ]
+    num_layers = len(past_key_values)
     if not _enable_ipex:
+        # the storage is a copy of the target kv, keep it in the same dtype
+        dtype = past_key_values[0][0].dtype
         len0 = past_key_values[0][0].size(0)
         len1 = past_key_values[0][0].size(1)
         # gpt_bigcode has only 2-dimension kv
         if len(past_key_values[0][0].shape) == 4:
             len2 = past_key_values[0][0].size(2)
             len3 = past_key_values[0][0].size(3)
-        for i in range(len(past_key_values)):
+        if self.config.model_type == "qwen":
+            storage = _allocate_past_key_values_storage_cpu(
+                self, (len0, len2, len1 + max_new_tokens, len3), num_layers * 2, dtype)
+            storage = [t.transpose(1, 2) for t in storage]
+        elif self.config.model_type == "chatglm":
+            storage = _allocate_past_key_values_storage_cpu(
+                self, (len1, len2, len0 + max_new_tokens, len3), num_layers * 2, dtype)
+            storage = [t.permute(2, 0, 1, 3) for t in storage]
+        elif self.config.model_type == "gpt_bigcode":
+            storage = _allocate_past_key_values_storage_cpu(
+                self, (len0 + max_new_tokens, len1), num_layers, dtype)
+        else:
+            storage = _allocate_past_key_values_storage_cpu(
+                self, (len0, len1, len2 + max_new_tokens, len3), num_layers * 2, dtype)
+        for i in range(num_layers):
             if self.config.model_type == "qwen":
-                k0 = torch.ones(len0, len2, len1 + max_new_tokens, len3,
-                                dtype=torch.float32)
-                v0 = torch.ones(len0, len2, len1 + max_new_tokens, len3,
-                                dtype=torch.float32)
-                k0 = k0.transpose(1, 2)
-                v0 = v0.transpose(1, 2)
-                past_key_values_storage.append((k0, v0))
-                past_key_values_storage[i][0][:, :len1, :, :] = past_key_values[i][0].to(
-                    torch.float32)
-                past_key_values_storage[i][1][:, :len1, :, :] = past_key_values[i][1].to(
-                    torch.float32)
+                past_key_values_storage.append((storage[2 * i], storage[2 * i + 1]))
+                past_key_values_storage[i][0][:, :len1, :, :] = past_key_values[i][0]
+                past_key_values_storage[i][1][:, :len1, :, :] = past_key_values[i][1]
             elif self.config.model_type == "chatglm":
-                k0 = torch.ones(len1, len2, len0 + max_new_tokens, len3,
-                                dtype=torch.float32)
-                v0 = torch.ones(len1, len2, len0 + max_new_tokens, len3,
-                                dtype=torch.float32)
-                k0 = k0.permute(2, 0, 1, 3)
-                v0 = v0.permute(2, 0, 1, 3)
-                past_key_values_storage.append((k0, v0))
-                past_key_values_storage[i][0][:len0, :, :, :] = past_key_values[i][0].to(
-                    torch.float32)
-                past_key_values_storage[i][1][:len0, :, :, :] = past_key_values[i][1].to(
-                    torch.float32)
+                past_key_values_storage.append((storage[2 * i], storage[2 * i + 1]))
+                past_key_values_storage[i][0][:len0, :, :, :] = past_key_values[i][0]
+                past_key_values_storage[i][1][:len0, :, :, :] = past_key_values[i][1]
             elif self.config.model_type == "gpt_bigcode":
-                kv = torch.ones(len0 + max_new_tokens, len1,
-                                dtype=torch.float32)
-                past_key_values_storage.append(kv[None, :, :])
-                past_key_values_storage[i][0][:len0, :] = past_key_values[i][0].to(
-                    torch.float32)
+                past_key_values_storage.append(storage[i][None, :, :])
+                past_key_values_storage[i][0][:len0, :] = past_key_values[i][0]
             else:
-                k0 = torch.ones(len0, len1, len2 + max_new_tokens, len3,
-                                dtype=torch.float32)
-                v0 = torch.ones(len0, len1, len2 + max_new_tokens, len3,
-                                dtype=torch.float32)
-                past_key_values_storage.append((k0, v0))
-                past_key_values_storage[i][0][:, :, :len2, :] = past_key_values[i][0].to(
-                    torch.float32)
-                past_key_values_storage[i][1][:, :, :len2, :] = past_key_values[i][1].to(
-                    torch.float32)
+                past_key_values_storage.append((storage[2 * i], storage[2 * i + 1]))
+                past_key_values_storage[i][0][:, :, :len2, :] = past_key_values[i][0]
+                past_key_values_storage[i][1][:, :, :len2, :] = past_key_values[i][1]
     else:
         len0 = past_key_values[0][1].size(1)
         len1 = past_key_values[0][1].size(2)
         len2 = past_key_values[0][0].size(2)  # seq length
         len3 = past_key_values[0][1].size(3)
-        for i in range(len(past_key_values)):
+        if self.config.model_type == "chatglm":
+            storage = _allocate_past_key_values_storage_cpu(
+                self, (len0, len1 * query_group_size, len2 + max_new_tokens, len3),
+                num_layers * 2, torch.float32)
+            storage = [t.permute(2, 0, 1, 3) for t in storage]
+        elif self.config.model_type == "qwen":
+            storage = _allocate_past_key_values_storage_cpu(
+                self, (len0, len1, len2 + max_new_tokens, len3), num_layers * 2, torch.float32)
+            storage = [t.permute(0, 2, 1, 3) for t in storage]
+        else:
+            storage = _allocate_past_key_values_storage_cpu(
+                self, (len0, len1, len2 + max_new_tokens, len3), num_layers * 2, torch.float32)
+        for i in range(num_layers):
+            past_key_values_storage.append((storage[2 * i], storage[2 * i + 1]))
             if self.config.model_type == "chatglm":
-                k0 = torch.ones(len0, len1 * query_group_size, len2 + max_new_tokens, len3,
-                                dtype=torch.float32)
-                v0 = torch.ones(len0, len1 * query_group_size, len2 + max_new_tokens, len3,
-                                dtype=torch.float32)
-                k0 = k0.permute(2, 0, 1, 3)
-                v0 = v0.permute(2, 0, 1, 3)
-                past_key_values_storage.append((k0, v0))
-                past_key_values_storage[i][0][:len2, :, :, :] = ipex_past_key_values[i][0].to(
-                    torch.float32)
-                past_key_values_storage[i][1][:len2, :, :, :] = ipex_past_key_values[i][1].to(
-                    torch.float32)
+                past_key_values_storage[i][0][:len2, :, :, :] = ipex_past_key_values[i][0]
+                past_key_values_storage[i][1][:len2, :, :, :] = ipex_past_key_values[i][1]
             elif self.config.model_type == "qwen":
-                k0 = torch.ones(len0, len1, len2 + max_new_tokens, len3,
-                                dtype=torch.float32)
-                v0 = torch.ones(len0, len1, len2 + max_new_tokens, len3,
-                                dtype=torch.float32)
-                k0 = k0.permute(0, 2, 1, 3)
-                v0 = v0.permute(0, 2, 1, 3)
-                past_key_values_storage.append((k0, v0))
-                past_key_values_storage[i][0][:, :len2, :, :] = ipex_past_key_values[i][0].to(
-                    torch.float32)
-                past_key_values_storage[i][1][:, :len2, :, :] = ipex_past_key_values[i][1].to(
-                    torch.float32)
+                past_key_values_storage[i][0][:, :len2, :, :] = ipex_past_key_values[i][0]
+                past_key_values_storage[i][1][:, :len2, :, :] = ipex_past_key_values[i][1]
             else:
-                k0 = torch.ones(len0, len1, len2 + max_new_tokens, len3,
-                                dtype=torch.float32)
-                v0 = torch.ones(len0, len1, len2 + max_new_tokens, len3,
-                                dtype=torch.float32)
-                past_key_values_storage.append((k0, v0))
-                past_key_values_storage[i][0][:, :, :len2, :] = ipex_past_key_values[i][0].to(
-                    torch.float32)
-                past_key_values_storage[i][1][:, :, :len2, :] = ipex_past_key_values[i][1].to(
-                    torch.float32)
+                past_key_values_storage[i][0][:, :, :len2, :] = ipex_past_key_values[i][0]
+                past_key_values_storage[i][1][:, :, :len2, :] = ipex_past_key_values[i][1]
 
     return past_key_values_storage
 
@@ -356,29 +366,29 @@ def _update_past_key_values_storage_cpu(self, past_key_values, past_key_values_s
                 size = original_draft_past_key_values[i][0].size(1)
                 size1 = past_key_values[i][0].size(1)
                 past_key_values_storage[i][0][:, size:size1, :, :] = \
-                    past_key_values[i][0][:, size:size1, :, :].to(torch.float32)
+                    past_key_values[i][0][:, size:size1, :, :]
                 past_key_values_storage[i][1][:, size:size1, :, :] = \
-                    past_key_values[i][1][:, size:size1, :, :].to(torch.float32)
+                    past_key_values[i][1][:, size:size1, :, :]
             elif self.config.model_type == "chatglm":
                 size = original_draft_past_key_values[i][0].size(0)
                 size1 = past_key_values[i][0].size(0)
                 past_key_values_storage[i][0][size:size1, :, :, :] = \
-                    past_key_values[i][0][size:size1, :, :, :].to(torch.float32)
+                    past_key_values[i][0][size:size1, :, :, :]
                 past_key_values_storage[i][1][size:size1, :, :, :] = \
-                    past_key_values[i][1][size:size1, :, :, :].to(torch.float32)
+                    past_key_values[i][1][size:size1, :, :, :]
             elif self.config.model_type == "gpt_bigcode":
                 size = original_draft_past_key_values[i][0].size(0)
                 size1 = past_key_values[i][0].size(0)
                 if size < size1:
                     past_key_values_storage[i][0][size:size1, :] = \
-                        past_key_values[i][0][size:size1, :].to(torch.float32)
+                        past_key_values[i][0][size:size1, :]
             else:
                 size = original_draft_past_key_values[i][0].size(2)
                 size1 = past_key_values[i][0].size(2)
                 past_key_values_storage[i][0][:, :, size:size1, :] = \
-                    past_key_values[i][0][:, :, size:size1, :].to(torch.float32)
+                    past_key_values[i][0][:, :, size:size1, :]
                 past_key_values_storage[i][1][:, :, size:size1, :] = \
-                    past_key_values[i][1][:, :, size:size1, :].to(torch.float32)
+                    past_key_values[i][1][:, :, size:size1, :]
         else:
             size = original_draft_past_key_values[i][0].size(2)
             size1 = past_key_values[i][0].size(1)
@@ -436,6 +446,9 @@ def _check_and_extend_kv_cache(past_key_values, max_step_draft, kv_alloc_block_l
     enough_kv_room = True
     if model_type not in ["chatglm", "qwen", "baichuan", "llama", "mistral", "opt"]:
         return past_key_values, False
+    if hasattr(past_key_values, "key_cache"):
+        # ipex-llm's cache classes grow their own storage in `update`
+        return past_key_values, False
     cache_k = past_key_values[0][0]
     if model_type == "chatglm":
         cache_k = cache_k.permute(1, 2, 0, 3)
@@ -480,21 +493,11 @@ def _check_and_extend_kv_cache(past_key_values, max_step_draft, kv_alloc_block_l
 def _crop_past_key_values(self, past_key_values, new_cache_size, _enable_ipex=False):
     if version.parse(trans_version) >= version.parse("4.36.0"):
         from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicNormalCache,\
-            DynamicCompressCache
+            DynamicCompressCache, DynamicUnbalancedFp8Cache
         if isinstance(past_key_values, (DynamicFp8Cache, DynamicNormalCache,
-                                        DynamicCompressCache)):
-            if hasattr(past_key_values, "_seen_tokens"):
-                past_key_values._seen_tokens -= new_cache_size
-            else:
-                past_key_values.seen_tokens -= new_cache_size
-            if isinstance(past_key_values, DynamicCompressCache):
-                past_key_values.real_kv_len -= new_cache_size
-
-            for i, k in enumerate(past_key_values.key_cache):
-                past_key_values.key_cache[i] = k[:, :, :-new_cache_size, :]
-            for i, v in enumerate(past_key_values.value_cache):
-                past_key_values.value_cache[i] = v[:, :, :-new_cache_size, :]
-
+                                        DynamicCompressCache, DynamicUnbalancedFp8Cache)):
+            # only narrows the views, the rejected slots are overwritten by the next append
+            past_key_values.crop(-new_cache_size)
             return past_key_values
 
     if _enable_ipex:
@@ -775,7 +778,7 @@ def _prepare_generate_args_4_45(self, inputs, generation_config, streamer=None,
 
 
 def _non_cpu_ipex_verify(self, verify_input_ids, past_key_values, cur_attention_mask=None,
-                         return_dict=True, use_cache=True):
+                         return_dict=True, use_cache=True, position_ids=None):
     forward_args = {
         "input_ids": verify_input_ids,
         "past_key_values": past_key_values,
@@ -784,6 +787,8 @@ def _non_cpu_ipex_verify(self, verify_input_ids, past_key_values, cur_attention_
     }
     if cur_attention_mask is not None:
         forward_args["attention_mask"] = cur_attention_mask
+    if position_ids is not None:
+        forward_args["position_ids"] = position_ids
 
     if self.config.model_type == "chatglm":
         if isinstance(self.config.eos_token_id, list) and not hasattr(self.transformer, "vision") \
@@ -801,6 +806,393 @@ def _non_cpu_ipex_verify(self, verify_input_ids, past_key_values, cur_attention_
     return self(**forward_args)
 
 
+def _batch_position_ids(attention_mask, length):
+    # positions skip the left padding and the kv slots of rejected draft tokens
+    position_ids = attention_mask.long().cumsum(-1) - 1
+    position_ids.masked_fill_(attention_mask == 0, 1)
+    return position_ids[:, -length:]
+
+
+def _batch_logits_process(logits_processor, sequences, logits, extra_ids=None):
+    # rows have token histories of different lengths, so process them one by one
+    if len(logits_processor) == 0:
+        return logits
+    for i, sequence in enumerate(sequences):
+        sequence = torch.tensor([sequence], dtype=torch.long, device=logits.device)
+        if extra_ids is not None:
+            sequence = torch.cat((sequence, extra_ids[i:i + 1]), dim=-1)
+        logits[i:i + 1] = logits_processor(sequence, logits[i:i + 1])
+    return logits
+
+
+def _speculative_sample_accept(draft_tokens, draft_probs, target_probs, random_probs):
+    # q: target prob, p: draft prob
+    # q >= p: always accept draft token
+    # q < p: q/p prob to accept draft token
+    drafted_n_tokens = draft_tokens.size(0)
+    idx = torch.arange(drafted_n_tokens, device=draft_tokens.device)
+    p = draft_probs[idx, draft_tokens]
+    q = target_probs[idx, draft_tokens]
+    accept_draft_prob = torch.minimum(torch.ones(()), q / p)
+    rejected_locations = (random_probs > accept_draft_prob).nonzero()
+    if rejected_locations.shape[0] == 0:    # All draft tokens have been accepted
+        last_token = multinomial_sample_one_no_sync(target_probs[-1])
+        return torch.cat([draft_tokens, last_token]), drafted_n_tokens + 1
+    max_matched = rejected_locations[0].item()
+    resample_prob = target_probs[max_matched] - draft_probs[max_matched]
+    resample_prob = torch.where(resample_prob > 0, resample_prob, 0.0)
+    resample_prob = resample_prob / resample_prob.sum()
+    next_token = multinomial_sample_one_no_sync(resample_prob)
+    return torch.cat([draft_tokens[:max_matched], next_token]), max_matched + 1
+
+
+def _tree_verify_supported(self, past_key_values):
+    # tree verification passes a custom 4D attention mask, which transformers only
+    # accepts in inverted form since 4.40, and compacts the kv cache along dim 2
+    if version.parse(trans_version) < version.parse("4.40.0"):
+        return False
+    from ipex_llm.transformers.kv import DynamicNormalCache, DynamicFp8Cache, \
+        DynamicCompressCache
+    if self.config.model_type == "chatglm" or isinstance(past_key_values, DynamicCompressCache):
+        return False
+    return isinstance(past_key_values, (DynamicNormalCache, DynamicFp8Cache))
+
+
+def _build_token_tree(root_token, branches):
+    # merge the branches into a trie rooted at `root_token`, nodes are numbered in
+    # insertion order so a parent always comes before its children
+    tokens = [root_token]
+    parents = [-1]
+    depths = [0]
+    children = [{}]
+    for branch in branches:
+        node = 0
+        for token in branch:
+            child = children[node].get(token, None)
+            if child is None:
+                child = len(tokens)
+                tokens.append(token)
+                parents.append(node)
+                depths.append(depths[node] + 1)
+                children.append({})
+                children[node][token] = child
+            node = child
+    return tokens, parents, depths, children
+
+
+def _tree_attention_mask(parents, past_len, dtype, device, attention_mask=None):
+    # every tree node attends to the kv cache and to its ancestors (including itself)
+    num_nodes = len(parents)
+    visible = torch.eye(num_nodes, dtype=torch.bool)
+    for node in range(1, num_nodes):
+        visible[node] |= visible[parents[node]]
+    mask = torch.zeros(1, 1, num_nodes, past_len + num_nodes, dtype=dtype)
+    mask[..., past_len:].masked_fill_(~visible, torch.finfo(dtype).min)
+    if attention_mask is not None:
+        mask[..., :past_len].masked_fill_(attention_mask.cpu()[0] == 0, torch.finfo(dtype).min)
+    return mask.to(device)
+
+
+def _compact_tree_kv_cache(self, past_key_values, past_len, num_nodes, keep_nodes):
+    # move the kv of the accepted path right after the committed cache and drop the
+    # kv of all other tree nodes
+    num_keep = len(keep_nodes)
+    if keep_nodes != list(range(num_keep)):
+        for cache in past_key_values.key_cache + past_key_values.value_cache:
+            keep = torch.tensor(keep_nodes, dtype=torch.long, device=cache.device) + past_len
+            cache[:, :, past_len:past_len + num_keep] = cache.index_select(2, keep)
+    if num_keep < num_nodes:
+        past_key_values = _crop_past_key_values(self, past_key_values, num_nodes - num_keep)
+    return past_key_values
+
+
+def _tree_verify(self, input_ids, branches, past_key_values, logits_processor,
+                 attention_mask=None):
+    """
+    Verify several draft branches of a single sequence in one target model forward.
+
+    The branches are merged into a token tree rooted at the last token of `input_ids`,
+    whose kv is not in `past_key_values` yet. Each node only attends to the kv cache and
+    its ancestors, the longest path the target model agrees with (greedily) is accepted,
+    and the kv of that path is compacted in place right after the committed cache.
+
+    :return: accepted token ids (ending with the target token after the path), number
+             of accepted draft tokens, number of draft tokens in the tree and the cache.
+    """
+    tokens, parents, depths, children = _build_token_tree(input_ids[0, -1].item(), branches)
+    past_len = input_ids.size(1) - 1
+    device = input_ids.device
+    tree_input_ids = torch.tensor([tokens], dtype=torch.long, device=device)
+    position_ids = torch.tensor([depths], dtype=torch.long, device=device) + past_len
+    tree_mask = _tree_attention_mask(parents, past_len, self.dtype, device, attention_mask)
+    output = self(input_ids=tree_input_ids,
+                  past_key_values=past_key_values,
+                  attention_mask=tree_mask,
+                  position_ids=position_ids,
+                  return_dict=True,
+                  use_cache=True)
+    logits = output['logits']
+    past_key_values = output['past_key_values']
+
+    # only the logits along the accepted path are processed
+    path = [0]
+    while True:
+        node_logits = logits[:, path[-1], :]
+        if len(logits_processor) > 0:
+            history = torch.cat((input_ids, tree_input_ids[:, path[1:]]), dim=-1)
+            node_logits = logits_processor(history, node_logits)
+        target_id = greedy(node_logits).item()
+        child = children[path[-1]].get(target_id, None)
+        if child is None:
+            break
+        path.append(child)
+
+    output_ids = torch.tensor([[tokens[node] for node in path[1:]] + [target_id]],
+                              dtype=torch.long, device=device)
+    past_key_values = _compact_tree_kv_cache(self, past_key_values, past_len,
+                                             len(tokens), path)
+    return output_ids, len(path) - 1, len(tokens) - 1, past_key_values
+
+
+@torch.no_grad()
+def _speculative_generate_batch(self, input_ids, draft_model, generation_config,
+                                logits_processor, attention_mask, max_new_tokens,
+                                max_step_draft, th_stop_draft, auto_th_stop_draft,
+                                auto_parameters, min_step_draft, draft_controller=None):
+    """
+    Speculative decoding for batch size > 1.
+
+    Each row accepts its own number of draft tokens. The kv of tokens rejected by some
+    rows is kept, so that the kv cache stays rectangular, and masked out by the
+    attention mask of the following forwards.
+    """
+    from ipex_llm.transformers.draft_controller import accept_histogram
+    batch_size = input_ids.size(0)
+    device = input_ids.device
+    do_sample = generation_config.do_sample
+    eos_token_id = generation_config.eos_token_id
+    if eos_token_id is None:
+        eos_token_ids = []
+    elif isinstance(eos_token_id, int):
+        eos_token_ids = [eos_token_id]
+    else:
+        eos_token_ids = list(eos_token_id)
+    pad_token_id = generation_config.pad_token_id
+    if pad_token_id is None:
+        pad_token_id = eos_token_ids[0] if eos_token_ids else 0
+    if attention_mask is None:
+        attention_mask = torch.ones_like(input_ids)
+    # mask of all positions in the kv cache
+    kv_mask = attention_mask.to(device)
+
+    sequences = input_ids.tolist()
+    generated = [[] for _ in range(batch_size)]
+    unfinished = [True] * batch_size
+
+    def accept_tokens(i, tokens):
+        for token in tokens:
+            generated[i].append(token)
+            sequences[i].append(token)
+            if token in eos_token_ids or len(generated[i]) >= max_new_tokens:
+                unfinished[i] = False
+                break
+
+    tic = time.time()
+    output = self(input_ids=input_ids,
+                  past_key_values=None,
+                  attention_mask=kv_mask,
+                  position_ids=_batch_position_ids(kv_mask, input_ids.size(1)),
+                  return_dict=True,
+                  use_cache=True)
+    logits = output['logits'][:, -1:]
+    _batch_logits_process(logits_processor, sequences, logits[:, -1, :])
+    if do_sample:
+        output_ids, _ = deepmind_sample(logits,
+                                        top_k=generation_config.top_k,
+                                        top_p=generation_config.top_p,
+                                        temperature=generation_config.temperature)
+    else:
+        output_ids = greedy(logits)
+    past_key_values = output['past_key_values']
+    current_input_ids = output_ids
+    for i in range(batch_size):
+        accept_tokens(i, [output_ids[i, 0].item()])
+    if self.device.type == 'xpu':
+        torch.xpu.synchronize()
+    self.first_token_time = time.time() - tic
+    e2e_tic = time.time()
+
+    past_key_values_storage = None
+    storage_capacity = 0
+    tmp_matchness = 0
+    step_verify = 0
+    extend_kv = False
+    max_draft_length = max_step_draft
+    while any(unfinished):
+        active = [i for i in range(batch_size) if unfinished[i]]
+        if draft_controller is not None:
+            max_step_draft = min(max(draft_controller.next_length(), 1), max_draft_length)
+            self.draft_length_trace.append(max_step_draft)
+        remaining = max_new_tokens - min(len(generated[i]) for i in active)
+        kv_len = kv_mask.size(1)
+        if self.device.type == 'cpu':
+            if kv_len + max_step_draft + 1 > storage_capacity:
+                # rejected draft tokens also take kv slots, so the storage may need to grow
+                extra_len = max_new_tokens + max_step_draft + 1
+                past_key_values_storage = \
+                    _prepare_past_key_values_storage_cpu(self, past_key_values, extra_len)
+                storage_capacity = kv_len + extra_len
+            draft_past_key_values = \
+                _prepare_draft_past_key_values_cpu(self, past_key_values,
+                                                   past_key_values_storage, False)
+            original_draft_past_key_values = draft_past_key_values
+        else:
+            past_key_values, extend_kv = _check_and_extend_kv_cache(past_key_values,
+                                                                    max_step_draft,
+                                                                    max_new_tokens + 40,
+                                                                    self.config.model_type)
+            draft_past_key_values = past_key_values
+
+        # Draft model auto-regressively generate k tokens for all rows,
+        # stop once no unfinished row is confident about its draft any more
+        draft_ids = [current_input_ids]
+        draft_prob_list = []
+        random_probs = None
+        if do_sample:
+            random_probs = torch.rand(batch_size, max_step_draft,
+                                      device=self.device, dtype=self.dtype)
+        tic = time.time()
+        for step_draft in range(max_step_draft):
+            draft_attention_mask = torch.cat((kv_mask, kv_mask.new_ones(batch_size,
+                                                                        step_draft + 1)), dim=1)
+            draft_output = draft_model(input_ids=draft_ids[-1],
+                                       past_key_values=draft_past_key_values,
+                                       attention_mask=draft_attention_mask,
+                                       position_ids=_batch_position_ids(draft_attention_mask, 1),
+                                       return_dict=True,
+                                       use_cache=True)
+            logits = draft_output['logits'][:, -1:]
+            _batch_logits_process(logits_processor, sequences, logits[:, -1, :],
+                                  torch.cat(draft_ids[1:], dim=-1) if step_draft > 0 else None)
+            if do_sample:
+                draft_output_ids, draft_probs, draft_output_probs = deepmind_sample(
+                    logits,
+                    return_probs=True,
+                    top_k=generation_config.top_k,
+                    top_p=generation_config.top_p,
+                    temperature=generation_config.temperature)
+                draft_prob_list.append(draft_probs)
+            else:
+                draft_output_ids, draft_output_probs = greedy(logits, return_probs=True)
+            draft_ids.append(draft_output_ids)
+            draft_past_key_values = draft_output['past_key_values']
+            confident = (draft_output_probs.view(-1)[active] >= th_stop_draft).any().item()
+            if (not confident and step_draft + 1 >= min_step_draft) or \
+                    step_draft + 2 >= remaining:
+                break
+        if self.device.type == 'xpu':
+            torch.xpu.synchronize()
+        self.draft_time.append(time.time() - tic)
+        drafted_n_tokens = step_draft + 1
+        drafted_input_ids = torch.cat(draft_ids, dim=-1)
+        self.draft_num.append(drafted_n_tokens)
+
+        # Target model verify drafts of all rows in one forward
+        tic = time.time()
+        cur_attention_mask = torch.cat((kv_mask, kv_mask.new_ones(batch_size,
+                                                                  drafted_n_tokens + 1)), dim=1)
+        output = _non_cpu_ipex_verify(self, drafted_input_ids, past_key_values,
+                                      cur_attention_mask, return_dict=True, use_cache=True,
+                                      position_ids=_batch_position_ids(cur_attention_mask,
+                                                                       drafted_n_tokens + 1))
+        logits = output['logits']
+        past_key_values = output['past_key_values']
+        for j in range(logits.size(1)):
+            _batch_logits_process(logits_processor, sequences, logits[:, j, :],
+                                  drafted_input_ids[:, 1:j + 1] if j > 0 else None)
+        if do_sample:
+            target_probs = logits_to_probs(logits,
+                                           top_k=generation_config.top_k,
+                                           top_p=generation_config.top_p,
+                                           temperature=generation_config.temperature)
+            target_probs = target_probs.view(batch_size, drafted_n_tokens + 1, -1)
+            draft_probs = torch.stack(draft_prob_list, dim=1)
+        else:
+            output_ids = greedy(logits)
+        if self.device.type == 'xpu':
+            torch.xpu.synchronize()
+            if extend_kv:
+                torch.xpu.empty_cache()
+        self.verify_time.append(time.time() - tic)
+        self.generate_time.append(self.draft_time[-1] + self.verify_time[-1])
+
+        # Per-row acceptance, finished rows keep only their input token
+        matched = [1] * batch_size
+        next_ids = [pad_token_id] * batch_size
+        for i in active:
+            if do_sample:
+                row_output_ids, matched[i] = _speculative_sample_accept(
+                    drafted_input_ids[i, 1:], draft_probs[i], target_probs[i],
+                    random_probs[i, :drafted_n_tokens])
+            else:
+                # Compare drafts with target verified outputs
+                row_matched = (output_ids[i, :-1] != drafted_input_ids[i, 1:]).cumsum(-1) == 0
+                matched[i] = row_matched.sum().item() + 1
+                row_output_ids = output_ids[i, :matched[i]]
+            row_output_ids = row_output_ids.tolist()
+            next_ids[i] = row_output_ids[-1]
+            accept_tokens(i, row_output_ids)
+
+        # Crop the kv of tokens rejected by all rows, and mask the ones rejected by some
+        max_matched = max(matched)
+        if drafted_n_tokens + 1 != max_matched:
+            past_key_values = self._crop_past_key_values(past_key_values,
+                                                         drafted_n_tokens + 1 - max_matched)
+        new_mask = torch.arange(max_matched, device=device)[None, :] < \
+            torch.tensor(matched, device=device)[:, None]
+        kv_mask = torch.cat((kv_mask, new_mask.to(kv_mask.dtype)), dim=1)
+        if self.device.type == 'cpu':
+            _update_past_key_values_storage_cpu(self, past_key_values, past_key_values_storage,
+                                                original_draft_past_key_values)
+        current_input_ids = torch.tensor(next_ids, dtype=torch.long, device=device)[:, None]
+
+        accepted = [matched[i] - 1 for i in active]
+        self.accept_num.extend(matched[i] for i in active)
+        self.n_matched += sum(accepted)
+        self.n_drafted += drafted_n_tokens * len(active)
+        step_verify += 1
+
+        if draft_controller is not None:
+            draft_controller.update(drafted_n_tokens, accepted,
+                                    self.draft_time[-1], self.verify_time[-1])
+        elif auto_th_stop_draft and step_verify % auto_parameters[0] == 0:
+            matchness = sum(accepted) / len(active) / drafted_n_tokens
+            tmp_matchness = auto_parameters[1]*(tmp_matchness) + \
+                (1-auto_parameters[1])*matchness
+            if tmp_matchness < auto_parameters[2]:
+                new_th_stop_draft = th_stop_draft+auto_parameters[3]
+            else:
+                if drafted_n_tokens == max_step_draft:
+                    new_th_stop_draft = th_stop_draft
+                else:
+                    new_th_stop_draft = th_stop_draft - auto_parameters[3]
+            th_stop_draft = auto_parameters[4] * th_stop_draft + \
+                (1-auto_parameters[4]) * new_th_stop_draft
+
+    self.n_token_generated = max(len(tokens) for tokens in generated)
+    self.e2e_time_without_first = time.time() - e2e_tic
+    self.accept_hist = accept_histogram(self.accept_num)
+    if draft_controller is not None and hasattr(draft_controller, "save"):
+        draft_controller.save()
+    _trim_past_key_values_storage_cpu(self)
+
+    generate_ids = torch.full((batch_size, self.n_token_generated), pad_token_id,
+                              dtype=torch.long, device=device)
+    for i, tokens in enumerate(generated):
+        generate_ids[i, :len(tokens)] = torch.tensor(tokens, dtype=torch.long)
+    return torch.cat([input_ids, generate_ids], dim=-1)
+
+
 @torch.no_grad()
 def speculative_generate(self,
                          inputs: Optional[torch.Tensor] = None,
@@ -812,6 +1204,8 @@ def speculative_generate(self,
                          auto_parameters=[1, 0.5, 0.9, 1e-2, 0.9],
                          hf_adjust=False,
                          min_step_draft=3,
+                         num_branches=1,
+                         draft_controller=None,
                          generation_config: Optional[GenerationConfig] = None,
                          attention_mask=None,
                          streamer: Optional["BaseStreamer"] = None,
@@ -826,6 +1220,28 @@ def speculative_generate(self,
         model_kwargs = _prepare_generate_args(self, inputs, generation_config, streamer,
                                               **sampling_kwargs)
 
+    from ipex_llm.transformers.draft_controller import get_draft_controller, accept_histogram
+
+    if input_ids.size(0) > 1:
+        from ipex_llm.transformers.convert import get_enable_ipex
+        invalidInputError(not get_enable_ipex(),
+                          "Speculative decoding with IPEX only supports batch size 1.")
+        invalidInputError(streamer is None,
+                          "Streamer only supports batch size 1 in speculative decoding.")
+        invalidInputError(self.config.model_type != "chatglm",
+                          "Speculative decoding of ChatGLM only supports batch size 1.")
+        # batched steps verify all rows in one forward, so their statistics are kept
+        # apart from the batch size 1 ones
+        draft_controller = get_draft_controller(self, draft_controller, "speculative_batch",
+                                                1, max_step_draft)
+        self.clear_benchmarks()
+        if self.device.type == 'xpu':
+            torch.xpu.empty_cache()
+        return _speculative_generate_batch(self, input_ids, draft_model, generation_config,
+                                           logits_processor, attention_mask, max_new_tokens,
+                                           max_step_draft, th_stop_draft, auto_th_stop_draft,
+                                           auto_parameters, min_step_draft, draft_controller)
+
     step = 0
     step_draft = 0
     step_verify = 0
@@ -855,6 +1271,19 @@ def speculative_generate(self,
             query_group_size = draft_model.config.num_attention_heads // \
                 draft_model.config.multi_query_group_num
 
+    # Tree verification: besides the greedy draft chain, the top `num_branches - 1`
+    # alternatives of every draft token are verified as extra leaves of a token tree
+    tree_verify = num_branches > 1 and not generation_config.do_sample and \
+        not _enable_ipex and self.device.type == 'cpu'
+    if num_branches > 1 and not tree_verify:
+        logger.warning("Tree verification only supports greedy search on CPU without IPEX, "
+                       "fallback to verifying a single draft chain.")
+
+    # The draft controller replaces `auto_th_stop_draft` and `hf_adjust` and picks
+    # max_step_draft of every step from the measured acceptance and latencies
+    draft_controller = get_draft_controller(self, draft_controller, "speculative",
+                                            1, draft_gen_length - 1)
+
     tmp_matchness = 0
     e2e_tic = 0.0
 
@@ -905,6 +1334,10 @@ def speculative_generate(self,
             generate_ids[:, step] = output_ids
             current_input_ids = output_ids
             past_key_values = output['past_key_values']
+            if tree_verify and not _tree_verify_supported(self, past_key_values):
+                logger.warning("Tree verification is not supported by this model or kv cache, "
+                               "fallback to verifying a single draft chain.")
+                tree_verify = False
             step += 1
             if self.device.type == 'xpu':
                 torch.xpu.synchronize()
@@ -912,6 +1345,10 @@ def speculative_generate(self,
             self.first_token_time = toc - tic
             e2e_tic = time.time()
         else:
+            if draft_controller is not None:
+                max_step_draft = min(max(draft_controller.next_length(), 1),
+                                     draft_gen_length - 1)
+                self.draft_length_trace.append(max_step_draft)
             draft_current_input_ids = current_input_ids
             # Target model KV cache to draft model
 
@@ -937,6 +1374,7 @@ def speculative_generate(self,
                 draft_past_key_values = past_key_values
             draft_generate_ids[:, 0] = current_input_ids
             draft_prob_list = []
+            draft_alternatives = []
             tic = time.time()
             random_probs = None
             if generation_config.do_sample:
@@ -1042,6 +1480,9 @@ def speculative_generate(self,
                     draft_output_ids, draft_output_probs = greedy(
                         logits,
                         return_probs=True)
+                    if tree_verify:
+                        draft_alternatives.append(
+                            logits[0, -1, :].topk(num_branches).indices[1:].tolist())
                 draft_generate_ids[:, step_draft+1] = draft_output_ids
                 draft_current_input_ids = draft_output_ids
                 draft_past_key_values = draft_output['past_key_values']
@@ -1072,7 +1513,20 @@ def speculative_generate(self,
                 ones_to_append = torch.ones(attention_mask.size(0), appended_len,
                                             device=self.device)
                 cur_attention_mask = torch.cat((attention_mask, ones_to_append), dim=1)
-            if _enable_ipex and hasattr(self, "trace_graph"):
+            if tree_verify:
+                # the greedy chain plus every alternative as a leaf after its prefix
+                chain = drafted_input_ids[0, 1:].tolist()
+                branches = [chain] + [chain[:i] + [token]
+                                      for i, alternatives in enumerate(draft_alternatives)
+                                      for token in alternatives]
+                tree_attention_mask = None if cur_attention_mask is None else \
+                    cur_attention_mask[:, :-drafted_input_ids.size(1)]
+                output_ids, max_matched, _, past_key_values = _tree_verify(
+                    self, torch.cat((input_ids, generate_ids[:, :step]), dim=-1),
+                    branches, past_key_values, logits_processor, tree_attention_mask)
+                max_matched += 1
+                output = None
+            elif _enable_ipex and hasattr(self, "trace_graph"):
                 if self.config.model_type == "baichuan":
                     if self.config.hidden_size == 4096:
                         past_key_value_len = past_key_values[0][0].shape[2]
@@ -1138,18 +1592,19 @@ def speculative_generate(self,
             if isinstance(output, dict):
                 logits = output['logits']
                 past_key_values = output['past_key_values']
-            temp_input_ids = torch.cat((input_ids, generate_ids[:, :step],
-                                        draft_generate_ids[:, 1:step_draft + 2]), dim=-1)
-            for i in range(logits.size(1)):
-                logits[:, i, :] = logits_processor(temp_input_ids[:, :input_ids.size(1)+step+i],
-                                                   logits[:, i, :])
-            if generation_config.do_sample:
-                target_probs = logits_to_probs(logits,
-                                               top_k=generation_config.top_k,
-                                               top_p=generation_config.top_p,
-                                               temperature=generation_config.temperature)
-            else:
-                output_ids = greedy(logits)
+            if not tree_verify:
+                temp_input_ids = torch.cat((input_ids, generate_ids[:, :step],
+                                            draft_generate_ids[:, 1:step_draft + 2]), dim=-1)
+                for i in range(logits.size(1)):
+                    logits[:, i, :] = logits_processor(
+                        temp_input_ids[:, :input_ids.size(1)+step+i], logits[:, i, :])
+                if generation_config.do_sample:
+                    target_probs = logits_to_probs(logits,
+                                                   top_k=generation_config.top_k,
+                                                   top_p=generation_config.top_p,
+                                                   temperature=generation_config.temperature)
+                else:
+                    output_ids = greedy(logits)
             if self.device.type == 'xpu':
                 torch.xpu.synchronize()
                 if extend_kv:
@@ -1188,7 +1643,7 @@ def speculative_generate(self,
                     output_ids = torch.cat([draft_tokens[:max_matched], next_token])
                     max_matched += 1
                 output_ids = output_ids.unsqueeze(0)
-            else:
+            elif not tree_verify:
                 # Compare drafts with target verified outputs
                 # Drafts start from [1, k]
                 # Verified output start from [0, k - 1]
@@ -1224,7 +1679,10 @@ def speculative_generate(self,
             self.n_drafted += drafted_n_tokens
             step_verify += 1
 
-            if auto_th_stop_draft and step_verify % auto_parameters[0] == 0:
+            if draft_controller is not None:
+                draft_controller.update(drafted_n_tokens, max_matched - 1,
+                                        self.draft_time[-1], self.verify_time[-1])
+            elif auto_th_stop_draft and step_verify % auto_parameters[0] == 0:
                 tmp_matchness = auto_parameters[1]*(tmp_matchness) + \
                     (1-auto_parameters[1])*((max_matched - 1)/drafted_n_tokens)
                 if tmp_matchness < auto_parameters[2]:
@@ -1237,7 +1695,7 @@ def speculative_generate(self,
                 th_stop_draft = auto_parameters[4] * th_stop_draft + \
                     (1-auto_parameters[4]) * new_th_stop_draft
 
-            if hf_adjust:
+            if hf_adjust and draft_controller is None:
                 if (max_matched - 1) == max_step_draft:
                     max_step_draft = min(draft_gen_length - 1, max_step_draft + 1)
                 else:
@@ -1265,6 +1723,10 @@ def speculative_generate(self,
     e2e_toc = time.time()
     self.n_token_generated = step
     self.e2e_time_without_first = e2e_toc - e2e_tic
+    self.accept_hist = accept_histogram(self.accept_num)
+    if draft_controller is not None and hasattr(draft_controller, "save"):
+        draft_controller.save()
+    _trim_past_key_values_storage_cpu(self)
 
     generate_ids = torch.cat([input_ids, generate_ids[:, :step]], dim=-1)
 
@@ -17,10 +17,70 @@
 # https://github.com/huggingface/transformers/blob/main/src/transformers/generation/streamers.py
 #
 
+import asyncio
 from typing import Optional, List
 
 import torch
 from transformers import TextIteratorStreamer
+from ipex_llm.utils.common import invalidInputError
+
+
+class IncrementalDetokenizer:
+    """
+    Decodes a growing sequence of token ids into text, where every new token only
+    decodes the last few tokens, so the cost per token does not grow with the output.
+
+    The text of new tokens is the decoded text since `prefix_offset` minus the decoded
+    text between `prefix_offset` and `read_offset`. Decoding with the previous tokens as
+    context keeps tokenizers which decode a token differently at the start of a sequence
+    (e.g. the leading space of sentencepiece) consistent with decoding the whole output.
+    Tokens ending in an incomplete utf-8 sequence (e.g. the first bytes of a CJK character
+    from a byte-fallback tokenizer) decode to "\ufffd" and are held back until the
+    character is complete.
+
+        Parameters:
+                tokenizer (`AutoTokenizer`):
+                        The tokenized used to decode the tokens.
+                decode_kwargs (`dict`, *optional*):
+                        Additional keyword arguments to pass to the tokenizer's `decode` method.
+    """
+
+    def __init__(self, tokenizer: "AutoTokenizer", **decode_kwargs):
+        self.tokenizer = tokenizer
+        self.decode_kwargs = decode_kwargs
+        self.reset()
+
+    def reset(self):
+        self.token_ids = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def _decode_new_text(self):
+        prefix_text = self.tokenizer.decode(self.token_ids[self.prefix_offset:self.read_offset],
+                                            **self.decode_kwargs)
+        new_text = self.tokenizer.decode(self.token_ids[self.prefix_offset:],
+                                         **self.decode_kwargs)
+        if len(new_text) <= len(prefix_text):
+            return None
+        return new_text[len(prefix_text):]
+
+    def put(self, token_ids: List[int]) -> str:
+        """Add new token ids and return the text which is complete with them"""
+        self.token_ids.extend(token_ids)
+        text = self._decode_new_text()
+        if text is None or text.endswith("\ufffd"):
+            return ""
+        # only the tokens since `read_offset` are needed as the context of later tokens
+        self.token_ids = self.token_ids[self.read_offset:]
+        self.prefix_offset = 0
+        self.read_offset = len(self.token_ids)
+        return text
+
+    def flush(self) -> str:
+        """Return the text held back at the end of the output, and reset"""
+        text = self._decode_new_text()
+        self.reset()
+        return "" if text is None else text
 
 
 class BatchTextIteratorStreamer(TextIteratorStreamer):
@@ -57,8 +117,8 @@ class BatchTextIteratorStreamer(TextIteratorStreamer):
     ):
         super().__init__(tokenizer, skip_prompt, timeout, **decode_kwargs)
         self.batch_size = batch_size
-        self.token_cache = [[] for _ in range(batch_size)]
-        self.print_len = [0 for _ in range(batch_size)]
+        self.detokenizers = [IncrementalDetokenizer(tokenizer, **decode_kwargs)
+                             for _ in range(batch_size)]
         self.generate_exception = None
 
     def put(self, value):
@@ -71,39 +131,12 @@ class BatchTextIteratorStreamer(TextIteratorStreamer):
             self.next_tokens_are_prompt = False
             return
 
-        printable_texts = list()
-        for idx in range(self.batch_size):
-            self.token_cache[idx].extend(value[idx].tolist())
-            text = self.tokenizer.decode(self.token_cache[idx], **self.decode_kwargs)
-
-            if text.endswith("\n"):
-                printable_text = text[self.print_len[idx]:]
-                self.token_cache[idx] = []
-                self.print_len[idx] = 0
-                # If the last token is a CJK character, we print the characters.
-            elif len(text) > 0 and self._is_chinese_char(ord(text[-1])):
-                printable_text = text[self.print_len[idx]:]
-                self.print_len[idx] += len(printable_text)
-            else:
-                printable_text = text[self.print_len[idx]:text.rfind(" ") + 1]
-                self.print_len[idx] += len(printable_text)
-            printable_texts.append(printable_text)
-
+        printable_texts = [self.detokenizers[idx].put(value[idx].tolist())
+                           for idx in range(self.batch_size)]
         self.on_finalized_text(printable_texts)
 
     def end(self):
-        printable_texts = list()
-        for idx in range(self.batch_size):
-            if len(self.token_cache[idx]) > 0:
-                text = self.tokenizer.decode(
-                    self.token_cache[idx], **self.decode_kwargs
-                )
-                printable_text = text[self.print_len[idx]:]
-                self.token_cache[idx] = []
-                self.print_len[idx] = 0
-            else:
-                printable_text = ""
-            printable_texts.append(printable_text)
+        printable_texts = [detokenizer.flush() for detokenizer in self.detokenizers]
 
         self.next_tokens_are_prompt = True
         self.on_finalized_text(printable_texts, stream_end=True)
@@ -112,3 +145,69 @@ class BatchTextIteratorStreamer(TextIteratorStreamer):
         self.text_queue.put(texts, timeout=self.timeout)
         if stream_end:
             self.text_queue.put(self.stop_signal, timeout=self.timeout)
+
+
+class AsyncTextIteratorStreamer(TextIteratorStreamer):
+    """
+    A TextIteratorStreamer whose text queue is an `asyncio.Queue`, so that coroutines can await
+    the next text without blocking the event loop while `.generate()` runs in another thread.
+    Texts are handed to the event loop with `loop.call_soon_threadsafe`.
+
+        Parameters:
+                tokenizer (`AutoTokenizer`):
+                        The tokenized used to decode the tokens.
+                skip_prompt (`bool`, *optional*, defaults to `False`):
+                        Whether to skip the prompt to `.generate()` or not.
+                timeout (`float`, *optional*):
+                        The timeout in seconds to wait for the next text when iterating with
+                        `async for`. If `None`, it waits indefinitely.
+                loop (`asyncio.AbstractEventLoop`, *optional*):
+                        The event loop consuming the texts. Defaults to the running event loop,
+                        so it must be given when the streamer is created outside of it.
+                decode_kwargs (`dict`, *optional*):
+                        Additional keyword arguments to pass to the tokenizer's `decode` method.
+    """
+
+    def __init__(
+        self,
+        tokenizer: "AutoTokenizer",
+        skip_prompt: bool = False,
+        timeout: Optional[float] = None,
+        loop: Optional[asyncio.AbstractEventLoop] = None,
+        **decode_kwargs
+    ):
+        super().__init__(tokenizer, skip_prompt, timeout, **decode_kwargs)
+        self.loop = loop if loop is not None else asyncio.get_running_loop()
+        self.text_queue = asyncio.Queue()
+        self.detokenizer = IncrementalDetokenizer(tokenizer, **decode_kwargs)
+
+    def put(self, value):
+        if len(value.shape) > 1:
+            invalidInputError(value.shape[0] == 1,
+                              "AsyncTextIteratorStreamer only supports batch size 1")
+            value = value[0]
+
+        if self.skip_prompt and self.next_tokens_are_prompt:
+            self.next_tokens_are_prompt = False
+            return
+
+        text = self.detokenizer.put(value.tolist())
+        if len(text) > 0:
+            self.on_finalized_text(text)
+
+    def end(self):
+        text = self.detokenizer.flush()
+        self.next_tokens_are_prompt = True
+        self.on_finalized_text(text, stream_end=True)
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        self.loop.call_soon_threadsafe(self.text_queue.put_nowait, text)
+        if stream_end:
+            self.loop.call_soon_threadsafe(self.text_queue.put_nowait, self.stop_signal)
+
+    async def __aiter__(self):
+        while True:
+            value = await asyncio.wait_for(self.text_queue.get(), self.timeout)
+            if value == self.stop_signal:
+                return
+            yield value
@@ -56,6 +56,24 @@ logger = logging.getLogger(__name__)
 
 WEIGHTS_NAME = "pytorch_model.bin"
 WEIGHTS_INDEX_NAME = "pytorch_model.bin.index.json"
+SAFE_WEIGHTS_NAME = "model.safetensors"
+SAFE_WEIGHTS_INDEX_NAME = "model.safetensors.index.json"
+
+SAFETENSORS_DTYPES = {
+    "BOOL": torch.bool,
+    "U8": torch.uint8,
+    "I8": torch.int8,
+    "I16": torch.int16,
+    "I32": torch.int32,
+    "I64": torch.int64,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "F32": torch.float32,
+    "F64": torch.float64,
+}
+if hasattr(torch, "float8_e5m2"):
+    SAFETENSORS_DTYPES["F8_E5M2"] = torch.float8_e5m2
+    SAFETENSORS_DTYPES["F8_E4M3"] = torch.float8_e4m3fn
 
 
 def extract_local_archive_file(pretrained_model_name_or_path, subfolder, variant=None):
@@ -79,6 +97,27 @@ def extract_local_archive_file(pretrained_model_name_or_path, subfolder, variant
         )
         is_sharded = True
         return archive_file, is_sharded
+    elif os.path.isfile(
+        os.path.join(pretrained_model_name_or_path,
+                     subfolder,
+                     _add_variant(SAFE_WEIGHTS_NAME, variant))
+    ):
+        # Load from a low-bit safetensors checkpoint
+        archive_file = os.path.join(
+            pretrained_model_name_or_path, subfolder, _add_variant(SAFE_WEIGHTS_NAME, variant)
+        )
+        return archive_file, False
+    elif os.path.isfile(
+        os.path.join(pretrained_model_name_or_path,
+                     subfolder,
+                     _add_variant(SAFE_WEIGHTS_INDEX_NAME, variant))
+    ):
+        # Load from a sharded low-bit safetensors checkpoint
+        archive_file = os.path.join(
+            pretrained_model_name_or_path, subfolder, _add_variant(SAFE_WEIGHTS_INDEX_NAME, variant)
+        )
+        is_sharded = True
+        return archive_file, is_sharded
     else:
         invalidInputError(False,
                           f"Error no file named {_add_variant(WEIGHTS_NAME, variant)}"
@@ -86,8 +125,50 @@ def extract_local_archive_file(pretrained_model_name_or_path, subfolder, variant
                           f" {pretrained_model_name_or_path}.")
 
 
-def load_state_dict(checkpoint_file: Union[str, os.PathLike]):
+def load_safetensors_mmap(checkpoint_file: Union[str, os.PathLike]):
+    """
+    Map a safetensors checkpoint into memory and return tensors viewing the mapping.
+
+    The file is mapped copy-on-write, so no tensor data is read until it is touched
+    and all processes loading the same checkpoint share one copy in the page cache.
+    Low-bit weights stored as packed uint8 can then be wrapped by ``FP4Params``
+    without any copy.
+    """
+    import json
+    import struct
+
+    checkpoint_file = str(checkpoint_file)
+    with open(checkpoint_file, "rb") as f:
+        header_size, = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+    file_size = os.path.getsize(checkpoint_file)
+    storage = torch.UntypedStorage.from_file(checkpoint_file, False, file_size)
+    data_start = 8 + header_size
+
+    state_dict = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        dtype = SAFETENSORS_DTYPES.get(info["dtype"], None)
+        invalidInputError(dtype is not None,
+                          f"Unsupported dtype {info['dtype']} of {name} in {checkpoint_file}.")
+        begin, end = info["data_offsets"]
+        offset = data_start + begin
+        invalidInputError(0 <= begin <= end and offset + (end - begin) <= file_size,
+                          f"Invalid data offsets of {name} in {checkpoint_file}.")
+        tensor = torch.empty(0, dtype=torch.uint8).set_(storage, offset, (end - begin,))
+        if offset % torch.empty(0, dtype=dtype).element_size() != 0:
+            # unaligned tensors cannot be viewed as a wider dtype in place
+            tensor = tensor.clone()
+        state_dict[name] = tensor.view(dtype).reshape(info["shape"])
+    return state_dict
+
+
+def load_state_dict(checkpoint_file: Union[str, os.PathLike], **kwargs):
+    # extra kwargs passed by transformers' own `load_state_dict` are ignored
     try:
+        if str(checkpoint_file).endswith(".safetensors"):
+            return load_safetensors_mmap(checkpoint_file)
         return torch.load(checkpoint_file, map_location="cpu")
     except Exception as e:
         invalidInputError(False,
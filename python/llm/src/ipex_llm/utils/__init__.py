@@ -18,19 +18,30 @@
 # physically located elsewhere.
 # Otherwise there would be module not found error in non-pip's setting as Python would
 # only search the first bigdl package and end up finding only one sub-package.
-import transformers
+import importlib
+from importlib.metadata import version
 
-trans_version = transformers.__version__
+# read the version from the package metadata, importing transformers takes seconds
+trans_version = version("transformers")
 
 if trans_version >= "4.47.0":
-    from .benchmark_util_4_47 import BenchmarkWrapper
+    _benchmark_module = "benchmark_util_4_47"
 elif trans_version >= "4.45.0":
-    from .benchmark_util_4_45 import BenchmarkWrapper
+    _benchmark_module = "benchmark_util_4_45"
 elif trans_version >= "4.44.0":
-    from .benchmark_util_4_44 import BenchmarkWrapper
+    _benchmark_module = "benchmark_util_4_44"
 elif trans_version >= "4.43.0":
-    from .benchmark_util_4_43 import BenchmarkWrapper
+    _benchmark_module = "benchmark_util_4_43"
 elif trans_version >= "4.42.0":
-    from .benchmark_util_4_42 import BenchmarkWrapper
+    _benchmark_module = "benchmark_util_4_42"
 else:
-    from .benchmark_util_4_29 import BenchmarkWrapper
+    _benchmark_module = "benchmark_util_4_29"
+
+
+def __getattr__(name):
+    # imported on first access (PEP 562), the benchmark utils import transformers
+    if name != "BenchmarkWrapper":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = importlib.import_module(f"{__name__}.{_benchmark_module}").BenchmarkWrapper
+    globals()[name] = value
+    return value
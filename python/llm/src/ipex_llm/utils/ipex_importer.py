@@ -19,7 +19,6 @@ import logging
 import builtins
 import sys
 import os
-import inspect
 from ipex_llm.utils.common import log4Error
 
 
@@ -28,6 +27,7 @@ BIGDL_CHECK_DUPLICATE_IMPORT = os.getenv("BIGDL_CHECK_DUPLICATE_IMPORT",
                                          'True').lower() in ('true', '1', 't')
 RAW_IMPORT = None
 IS_IMPORT_REPLACED = False
+IPEX_MODULE_NAMES = ("ipex", "intel_extension_for_pytorch")
 ipex_duplicate_import_error = "intel_extension_for_pytorch has already been automatically " + \
     "imported. Please avoid importing it again!"
 
@@ -52,34 +52,15 @@ def revert_import():
         IS_IMPORT_REPLACED = False
 
 
-def get_calling_package():
-    """
-    Return calling package name, e.g., ipex_llm.transformers
-    """
-    # Get the current stack frame
-    frame = inspect.currentframe()
-    # Get the caller's frame
-    caller_frame = frame.f_back.f_back
-    # Get the caller's module
-    module = inspect.getmodule(caller_frame)
-    if module:
-        # Return the module's package name
-        return module.__package__
-    return None
-
-
 def custom_ipex_import(name, globals=None, locals=None, fromlist=(), level=0):
     """
     Custom import function to avoid importing ipex again
     """
-    if fromlist is not None or '.' in name:
-        return RAW_IMPORT(name, globals, locals, fromlist, level)
-    # Avoid errors in submodule import
-    calling = get_calling_package()
-    if calling is not None:
-        return RAW_IMPORT(name, globals, locals, fromlist, level)
-    # Only check ipex for main thread
-    if name == "ipex" or name == "intel_extension_for_pytorch":
+    # This hook runs for every import in the process, so it only does a name lookup.
+    # Only check `import ipex` in the main script, where `__package__` is None,
+    # imported modules (e.g. ipex_llm.transformers) have a `__package__`.
+    if fromlist is None and name in IPEX_MODULE_NAMES and \
+            (globals is None or globals.get("__package__", None) is None):
         log4Error.invalidInputError(False,
                                     ipex_duplicate_import_error)
     return RAW_IMPORT(name, globals, locals, fromlist, level)
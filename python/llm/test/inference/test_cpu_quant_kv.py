@@ -0,0 +1,87 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import pytest
+import torch
+
+import ipex_llm.transformers.models.common as common
+from ipex_llm.transformers.models.common import cpu_quant_kv_attention
+from ipex_llm.transformers.models.utils import init_cpu_quant_kv_cache, \
+    append_cpu_quant_kv_cache, split_cpu_quant_kv
+
+
+def quantize_kv(key, value, qtype):
+    bsz, n_kv_heads, kv_length, head_dim = key.shape
+    k_cache, v_cache = init_cpu_quant_kv_cache(bsz, n_kv_heads, 0, head_dim, qtype, key.device)
+    # prefill, then decode the last token, so that appending is covered too
+    k_cache, v_cache = append_cpu_quant_kv_cache(k_cache, v_cache, key[:, :, :-1],
+                                                 value[:, :, :-1])
+    k_cache, v_cache = append_cpu_quant_kv_cache(k_cache, v_cache, key[:, :, -1:],
+                                                 value[:, :, -1:])
+    return k_cache, v_cache
+
+
+def dequantize_kv(cache):
+    values, scales, mins = split_cpu_quant_kv(cache)
+    states = values * scales
+    return states if mins is None else states + mins
+
+
+@pytest.mark.parametrize("qtype, max_step", [("int8", 1 / 127), ("int4", 1 / 15)])
+def test_cpu_quant_kv_dequantize(qtype, max_step):
+    torch.manual_seed(0)
+    key = torch.randn(2, 2, 33, 64)
+    value = torch.randn(2, 2, 33, 64)
+    k_cache, v_cache = quantize_kv(key, value, qtype)
+    assert k_cache.size(2) == key.size(2)
+    for states, cache in [(key, k_cache), (value, v_cache)]:
+        # every value is rounded to the nearest of the quantization levels of its row
+        value_range = states.amax(-1, keepdim=True) - states.amin(-1, keepdim=True)
+        bound = value_range * max_step / 2 if qtype == "int4" else \
+            states.abs().amax(-1, keepdim=True) * max_step / 2
+        assert ((dequantize_kv(cache) - states).abs() <= bound + 1e-5).all()
+
+
+@pytest.mark.parametrize("qtype", ["int8", "int4"])
+@pytest.mark.parametrize("seq_length, use_mask", [(1, False), (5, False), (5, True),
+                                                  (40, False)])
+def test_cpu_quant_kv_attention(monkeypatch, qtype, seq_length, use_mask):
+    # small chunks, so that the kv is read in several chunks
+    monkeypatch.setattr(common, "CPU_QUANT_KV_CHUNK_LENGTH", 16)
+    torch.manual_seed(0)
+    bsz, n_heads, n_kv_heads, kv_length, head_dim = 2, 8, 2, 40, 64
+    query = torch.randn(bsz, n_heads, seq_length, head_dim)
+    key = torch.randn(bsz, n_kv_heads, kv_length, head_dim)
+    value = torch.randn(bsz, n_kv_heads, kv_length, head_dim)
+    k_cache, v_cache = quantize_kv(key, value, qtype)
+
+    # reference: sdpa on the dequantized kv, with kv heads repeated for GQA
+    n_rep = n_heads // n_kv_heads
+    ref_key = dequantize_kv(k_cache).repeat_interleave(n_rep, dim=1)
+    ref_value = dequantize_kv(v_cache).repeat_interleave(n_rep, dim=1)
+    causal_mask = torch.ones(seq_length, kv_length, dtype=torch.bool)
+    causal_mask = causal_mask.tril_(kv_length - seq_length)
+    expected = torch.nn.functional.scaled_dot_product_attention(query, ref_key, ref_value,
+                                                                attn_mask=causal_mask)
+
+    if use_mask:
+        mask = torch.zeros(bsz, 1, seq_length, kv_length)
+        mask.masked_fill_(~causal_mask, torch.finfo(torch.float32).min)
+        output = cpu_quant_kv_attention(query, k_cache, v_cache, mask=mask)
+    else:
+        output = cpu_quant_kv_attention(query, k_cache, v_cache, is_causal=True)
+    torch.testing.assert_close(output, expected, rtol=1e-4, atol=1e-4)
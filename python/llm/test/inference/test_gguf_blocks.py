@@ -0,0 +1,210 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import functools
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+
+from ipex_llm.transformers.gguf.gguf import GGUFTensorLoader, GGUFQuantizedTensor
+from ipex_llm.ggml.quantize import ggml_tensor_qtype
+
+
+# gguf qtype -> (block bytes, elements in a block, offsets of the fp16 scales in a block)
+BLOCKS = {
+    2: (18, 32, [0]),           # q4_0
+    10: (84, 256, [80, 82]),    # q2_k
+    11: (110, 256, [108]),      # q3_k
+    12: (144, 256, [0, 2]),     # q4_k
+    13: (176, 256, [0, 2]),     # q5_k
+}
+
+
+def make_blocks(gguf_qtype, num_blocks, seed=0):
+    rng = np.random.default_rng(seed)
+    block_size, _, scale_offsets = BLOCKS[gguf_qtype]
+    blocks = rng.integers(0, 256, size=(num_blocks, block_size), dtype=np.uint8)
+    for offset in scale_offsets:
+        scales = rng.uniform(1e-3, 4e-3, size=num_blocks).astype(np.float16)
+        blocks[:, offset:offset + 2] = scales.view(np.uint8).reshape(num_blocks, 2)
+    return blocks
+
+
+def fp16(block, offset):
+    return float(block[offset:offset + 2].view(np.float16)[0])
+
+
+# scalar ports of `dequantize_row_q*_K` in llama.cpp ggml-quants.c
+
+def ref_q2_k(block):
+    scales, q, d, dmin = block[:16], block[16:80], fp16(block, 80), fp16(block, 82)
+    y = []
+    idx = 0
+    for n in range(2):
+        shift = 0
+        for j in range(4):
+            for half in range(2):
+                sc = int(scales[idx])
+                idx += 1
+                dl, ml = d * (sc & 0xF), dmin * (sc >> 4)
+                for l in range(16):
+                    y.append(dl * ((int(q[32 * n + 16 * half + l]) >> shift) & 3) - ml)
+            shift += 2
+    return y
+
+
+def ref_q3_k(block):
+    hm, q, raw, d = block[:32], block[32:96], block[96:108], fp16(block, 108)
+    aux = [int(a) for a in raw.view(np.uint32)]
+    kmask1, kmask2 = 0x03030303, 0x0f0f0f0f
+    tmp = aux[2]
+    aux = [(aux[0] & kmask2) | (((tmp >> 0) & kmask1) << 4),
+           (aux[1] & kmask2) | (((tmp >> 2) & kmask1) << 4),
+           ((aux[0] >> 4) & kmask2) | (((tmp >> 4) & kmask1) << 4),
+           ((aux[1] >> 4) & kmask2) | (((tmp >> 6) & kmask1) << 4)]
+    scales = np.array(aux, dtype=np.uint32).view(np.int8)
+    y = []
+    idx = 0
+    m = 1
+    for n in range(2):
+        shift = 0
+        for j in range(4):
+            for half in range(2):
+                dl = d * (int(scales[idx]) - 32)
+                idx += 1
+                for l in range(16):
+                    k = 16 * half + l
+                    v = (int(q[32 * n + k]) >> shift) & 3
+                    y.append(dl * (v - (0 if int(hm[k]) & m else 4)))
+            shift += 2
+            m <<= 1
+    return y
+
+
+def scale_min_k4(j, q):
+    if j < 4:
+        return int(q[j]) & 63, int(q[j + 4]) & 63
+    return ((int(q[j + 4]) & 0xF) | ((int(q[j - 4]) >> 6) << 4),
+            (int(q[j + 4]) >> 4) | ((int(q[j]) >> 6) << 4))
+
+
+def ref_q4_k(block):
+    d, dmin, scales, q = fp16(block, 0), fp16(block, 2), block[4:16], block[16:]
+    y = []
+    for j in range(4):
+        sc1, m1 = scale_min_k4(2 * j, scales)
+        sc2, m2 = scale_min_k4(2 * j + 1, scales)
+        ql = q[32 * j:32 * j + 32]
+        y += [d * sc1 * (int(v) & 0xF) - dmin * m1 for v in ql]
+        y += [d * sc2 * (int(v) >> 4) - dmin * m2 for v in ql]
+    return y
+
+
+def ref_q5_k(block):
+    d, dmin, scales = fp16(block, 0), fp16(block, 2), block[4:16]
+    qh, q = block[16:48], block[48:]
+    y = []
+    u1, u2 = 1, 2
+    for j in range(4):
+        sc1, m1 = scale_min_k4(2 * j, scales)
+        sc2, m2 = scale_min_k4(2 * j + 1, scales)
+        ql = q[32 * j:32 * j + 32]
+        y += [d * sc1 * ((int(v) & 0xF) + (16 if int(h) & u1 else 0)) - dmin * m1
+              for v, h in zip(ql, qh)]
+        y += [d * sc2 * ((int(v) >> 4) + (16 if int(h) & u2 else 0)) - dmin * m2
+              for v, h in zip(ql, qh)]
+        u1 <<= 2
+        u2 <<= 2
+    return y
+
+
+def make_loader():
+    return GGUFTensorLoader("", SimpleNamespace(infos=[], base_offset=0))
+
+
+@pytest.mark.parametrize("gguf_qtype, ref", [(10, ref_q2_k), (11, ref_q3_k),
+                                             (12, ref_q4_k), (13, ref_q5_k)])
+def test_convert_k_quant_tensor(gguf_qtype, ref):
+    loader = make_loader()
+    num_blocks = 4
+    blocks = make_blocks(gguf_qtype, num_blocks)
+    expected = torch.tensor([ref(block) for block in blocks], dtype=torch.float)
+    result = loader.convert_funcs[gguf_qtype](torch.from_numpy(blocks.reshape(-1)),
+                                              blocks.size, 2, (num_blocks, 256))
+    atol = 1e-2 * expected.abs().max().item()
+    torch.testing.assert_close(result.float(), expected, rtol=1e-2, atol=atol)
+
+
+def relative_error(actual, expected):
+    return ((actual - expected).norm() / expected.norm()).item()
+
+
+@pytest.mark.parametrize("gguf_qtype, low_bit", [(2, "sym_int4"), (12, "q4_k")])
+def test_gguf_blocks_low_bit_linear(gguf_qtype, low_bit):
+    from ipex_llm.transformers.convert import replace_with_low_bit_linear_for_module
+    from ipex_llm.transformers.low_bit_linear import LowBitLinear
+
+    out_features, in_features = 32, 512
+    qtype = ggml_tensor_qtype[low_bit]
+    loader = make_loader()
+    block_size, block_elements, _ = BLOCKS[gguf_qtype]
+    num_blocks = out_features * in_features // block_elements
+    size = num_blocks * block_size
+    blocks = torch.from_numpy(make_blocks(gguf_qtype, num_blocks))
+    dequantize = functools.partial(loader.convert_funcs[gguf_qtype], size=size, ndims=2,
+                                   dims=(out_features, in_features))
+    tensor = GGUFQuantizedTensor(blocks.reshape(out_features, -1), (out_features, in_features),
+                                 qtype, dequantize)
+    assert tensor.same_layout()
+    weight = tensor.dequantize().float()
+
+    def make_model():
+        return torch.nn.Sequential(torch.nn.Sequential(
+            torch.nn.Linear(in_features, out_features, bias=False)))
+
+    model = make_model()
+    assert tensor.to_low_bit_linear(model, "0.0.weight")
+    assert isinstance(model[0][0], LowBitLinear)
+
+    # dequantize the gguf blocks, then requantize them with ipex-llm
+    requantized = make_model()
+    requantized[0][0].weight.data = weight
+    requantized = replace_with_low_bit_linear_for_module(requantized, qtype=qtype,
+                                                         module_name="0.0.weight")
+
+    x = torch.randn(4, in_features)
+    with torch.inference_mode():
+        output = model(x)
+        expected = torch.nn.functional.linear(x, weight)
+        requantized_output = requantized(x)
+    # activations are quantized to 8 bits in the low-bit matmul
+    assert relative_error(output, expected) < 3e-2
+    assert relative_error(output, requantized_output) < 0.15
+
+
+def test_gguf_blocks_wrong_layout():
+    loader = make_loader()
+    blocks = torch.from_numpy(make_blocks(2, 16))
+    # q4_0 blocks read as q4_k blocks of the same size in bytes
+    size = blocks.numel()
+    dequantize = functools.partial(loader.convert_funcs[2], size=size, ndims=2,
+                                   dims=(2, 256))
+    tensor = GGUFQuantizedTensor(blocks.reshape(2, -1), (2, 256),
+                                 ggml_tensor_qtype["q4_k"], dequantize)
+    assert not tensor.same_layout()
@@ -0,0 +1,93 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import pytest
+import torch
+
+from ipex_llm.transformers.kv import DynamicNormalCache, DynamicCompressCache
+from ipex_llm.transformers.models.utils import init_kv_cache, append_kv_cache
+
+
+NUM_LAYERS = 2
+
+
+def make_normal_cache(kv_length):
+    torch.manual_seed(0)
+    cache = DynamicNormalCache()
+    for layer_idx in range(NUM_LAYERS):
+        cache.update(torch.randn(1, 2, kv_length, 8), torch.randn(1, 2, kv_length, 8),
+                     layer_idx)
+    return cache
+
+
+def make_compress_cache(seen_length, kv_length):
+    # a cache which has seen `seen_length` tokens, compressed to the last `kv_length` ones
+    torch.manual_seed(0)
+    cache = DynamicCompressCache()
+    for _ in range(NUM_LAYERS):
+        k_cache, v_cache = init_kv_cache(1, 2, 8, 0, kv_length + 16, torch.float32,
+                                         torch.device("cpu"))
+        k_cache, v_cache = append_kv_cache(k_cache, v_cache, torch.randn(1, 2, kv_length, 8),
+                                           torch.randn(1, 2, kv_length, 8))
+        cache.key_cache.append(k_cache)
+        cache.value_cache.append(v_cache)
+    cache.update_seen_tokens(0, seen_length)
+    return cache
+
+
+def cached_lengths(cache):
+    return [k.size(2) for k in cache.key_cache] + [v.size(2) for v in cache.value_cache]
+
+
+@pytest.mark.parametrize("max_length, expected", [(-3, 7), (6, 6), (10, 10), (12, 10),
+                                                  (-10, 0)])
+def test_rollback_normal_cache(max_length, expected):
+    cache = make_normal_cache(10)
+    keys = [k.clone() for k in cache.key_cache]
+    cache.crop(max_length)
+    assert cache.get_seq_length() == expected
+    assert cached_lengths(cache) == [expected] * NUM_LAYERS * 2
+    for key, k in zip(keys, cache.key_cache):
+        torch.testing.assert_close(k, key[:, :, :expected])
+
+    # the next token is appended into the rolled back slots, without reallocating
+    data_ptr = cache.key_cache[0].data_ptr()
+    cache.update(torch.randn(1, 2, 1, 8), torch.randn(1, 2, 1, 8), 0)
+    assert cache.key_cache[0].size(2) == expected + 1
+    assert cache.key_cache[0].data_ptr() == data_ptr
+
+
+def test_rollback_compress_cache():
+    cache = make_compress_cache(20, 8)
+    cache.crop(-3)
+    assert cache.get_seq_length() == 17
+    assert cached_lengths(cache) == [5] * NUM_LAYERS * 2
+
+    # lengths count all seen tokens, not only the ones kept by compression
+    cache.crop(14)
+    assert cache.get_seq_length() == 14
+    assert cached_lengths(cache) == [2] * NUM_LAYERS * 2
+
+
+@pytest.mark.parametrize("max_length", [-9, 11])
+def test_rollback_compress_cache_past_window(max_length):
+    cache = make_compress_cache(20, 8)
+    with pytest.raises(RuntimeError):
+        cache.crop(max_length)
+    # a rejected rollback leaves the cache untouched
+    assert cache.get_seq_length() == 20
+    assert cached_lengths(cache) == [8] * NUM_LAYERS * 2
@@ -0,0 +1,147 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import tempfile
+
+import pytest
+import torch
+
+import ipex_llm.transformers.speculative as speculative
+from ipex_llm.transformers import AutoModelForCausalLM
+from ipex_llm.transformers.kv import DynamicNormalCache, DynamicFp8Cache
+from ipex_llm.transformers.speculative import _build_token_tree, _tree_attention_mask, \
+    _compact_tree_kv_cache
+
+
+ROOT_TOKEN = 5
+BRANCHES = [[1, 2, 3], [1, 4], [6, 7], [1, 2, 8]]
+
+
+def test_build_token_tree():
+    tokens, parents, depths, children = _build_token_tree(ROOT_TOKEN, BRANCHES)
+    assert tokens == [5, 1, 2, 3, 4, 6, 7, 8]
+    assert parents == [-1, 0, 1, 2, 1, 0, 5, 2]
+    assert depths == [0, 1, 2, 3, 2, 1, 2, 3]
+    assert children[2] == {3: 3, 8: 7}
+
+
+def tree_paths(parents):
+    # the nodes from the root to every leaf
+    leaves = set(range(len(parents))) - set(parents)
+    paths = []
+    for leaf in sorted(leaves):
+        path = [leaf]
+        while parents[path[-1]] != -1:
+            path.append(parents[path[-1]])
+        paths.append(path[::-1])
+    return paths
+
+
+@pytest.mark.parametrize("num_padding", [0, 2])
+def test_tree_attention_mask_matches_causal(num_padding):
+    torch.manual_seed(0)
+    _, parents, _, _ = _build_token_tree(ROOT_TOKEN, BRANCHES)
+    num_nodes, past_len, n_heads, head_dim = len(parents), 6, 4, 16
+    query = torch.randn(1, n_heads, num_nodes, head_dim)
+    key = torch.randn(1, n_heads, past_len + num_nodes, head_dim)
+    value = torch.randn(1, n_heads, past_len + num_nodes, head_dim)
+    attention_mask = torch.ones(1, past_len + num_nodes, dtype=torch.long)
+    attention_mask[:, :num_padding] = 0
+
+    tree_mask = _tree_attention_mask(parents, past_len, torch.float32, torch.device("cpu"),
+                                     attention_mask[:, :past_len])
+    output = torch.nn.functional.scaled_dot_product_attention(query, key, value,
+                                                              attn_mask=tree_mask)
+
+    # reference: every root-to-leaf path alone, with a causal mask
+    for path in tree_paths(parents):
+        kv_index = list(range(past_len)) + [past_len + node for node in path]
+        causal_mask = torch.ones(len(path), len(kv_index), dtype=torch.bool)
+        causal_mask = causal_mask.tril_(past_len)
+        causal_mask[:, :num_padding] = False
+        expected = torch.nn.functional.scaled_dot_product_attention(
+            query[:, :, path], key[:, :, kv_index], value[:, :, kv_index],
+            attn_mask=causal_mask
+        )
+        torch.testing.assert_close(output[:, :, path], expected, rtol=1e-5, atol=1e-5)
+
+
+def make_tree_kv_cache(cache_cls, past_len, num_nodes):
+    torch.manual_seed(0)
+    cache = cache_cls()
+    for layer_idx in range(2):
+        # the committed kv, then the kv of the tree nodes appended by the verify forward
+        for length in [past_len, num_nodes]:
+            cache.update(torch.randn(1, 2, length, 16), torch.randn(1, 2, length, 16),
+                         layer_idx)
+    return cache
+
+
+@pytest.mark.parametrize("cache_cls, qtype", [(DynamicNormalCache, None),
+                                              (DynamicFp8Cache, "int8"),
+                                              (DynamicFp8Cache, "int4")])
+@pytest.mark.parametrize("keep_nodes", [[0], [0, 1, 2, 3], [0, 1, 2, 7], [0, 5, 6]])
+def test_compact_tree_kv_cache(monkeypatch, cache_cls, qtype, keep_nodes):
+    if qtype is not None:
+        monkeypatch.setenv("IPEX_LLM_CPU_KV_QUANT_TYPE", qtype)
+    past_len, num_nodes = 6, 8
+    cache = make_tree_kv_cache(cache_cls, past_len, num_nodes)
+    keys = [k.clone() for k in cache.key_cache]
+    values = [v.clone() for v in cache.value_cache]
+
+    cache = _compact_tree_kv_cache(None, cache, past_len, num_nodes, keep_nodes)
+
+    # exactly the committed kv followed by the kv of the accepted path
+    index = list(range(past_len)) + [past_len + node for node in keep_nodes]
+    assert cache.get_seq_length() == len(index)
+    for full, compacted in zip(keys + values, cache.key_cache + cache.value_cache):
+        torch.testing.assert_close(compacted, full[:, :, index], rtol=0, atol=0)
+
+
+def test_tree_verify_greedy_matches_single_branch(monkeypatch):
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    torch.manual_seed(0)
+    config = LlamaConfig(vocab_size=128, hidden_size=64, intermediate_size=128,
+                         num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2,
+                         max_position_embeddings=256, pad_token_id=0, eos_token_id=1)
+    prompt = torch.tensor([[5, 17, 42, 9, 88, 23, 61]])
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        LlamaForCausalLM(config).save_pretrained(tempdir)
+        model = AutoModelForCausalLM.from_pretrained(tempdir, load_in_low_bit="sym_int8",
+                                                     torch_dtype=torch.float32,
+                                                     speculative=True)
+
+    num_tree_verify = 0
+    tree_verify = speculative._tree_verify
+
+    def counting_tree_verify(*args, **kwargs):
+        nonlocal num_tree_verify
+        num_tree_verify += 1
+        return tree_verify(*args, **kwargs)
+
+    monkeypatch.setattr(speculative, "_tree_verify", counting_tree_verify)
+
+    with torch.inference_mode():
+        expected = model.generate(prompt, do_sample=False, max_new_tokens=16,
+                                  eos_token_id=-1, num_branches=1)
+        assert num_tree_verify == 0
+        output = model.generate(prompt, do_sample=False, max_new_tokens=16,
+                                eos_token_id=-1, num_branches=3)
+    assert num_tree_verify > 0
+    assert output.tolist() == expected.tolist()
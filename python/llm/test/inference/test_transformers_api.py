@@ -118,7 +118,9 @@ class TestTransformersAPI(unittest.TestCase):
     (AutoModel, AutoTokenizer, os.environ.get('ORIGINAL_CHATGLM2_6B_PATH')),
     (AutoModelForCausalLM, AutoTokenizer, os.environ.get('MISTRAL_ORIGIN_PATH')),
     ])
-def test_load_low_bit_completion(Model, Tokenizer, model_path, prompt, answer):
+@pytest.mark.parametrize('safe_serialization', [False, True])
+def test_load_low_bit_completion(Model, Tokenizer, model_path, prompt, answer,
+                                 safe_serialization):
     tokenizer = Tokenizer.from_pretrained(model_path, trust_remote_code=True)
     model = Model.from_pretrained(model_path,
                                   load_in_4bit=True,
@@ -126,7 +128,10 @@ def test_load_low_bit_completion(Model, Tokenizer, model_path, prompt, answer):
                                   trust_remote_code=True)
 
     with tempfile.TemporaryDirectory() as tempdir:
-        model.save_low_bit(tempdir)
+        model.save_low_bit(tempdir, safe_serialization=safe_serialization)
+        if safe_serialization:
+            # packed weights are loaded by mmap from safetensors
+            assert any(f.endswith(".safetensors") for f in os.listdir(tempdir))
         loaded_model = Model.load_low_bit(tempdir,
                                           optimize_model=True,
                                           trust_remote_code=True)
@@ -169,5 +174,42 @@ def test_optimize_model(Model, Tokenizer, model_path, prompt):
         assert (diff/logits_base_model.flatten()).mean()<0.05
 
 
+def test_speculative_batch_greedy_matches_single():
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    torch.manual_seed(0)
+    config = LlamaConfig(vocab_size=128, hidden_size=64, intermediate_size=128,
+                         num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2,
+                         max_position_embeddings=256, pad_token_id=0, eos_token_id=1)
+    prompts = [[5, 17, 42, 9, 88, 23, 61], [70, 3, 99], [12, 54, 7, 31, 2]]
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        LlamaForCausalLM(config).save_pretrained(tempdir)
+        model = AutoModelForCausalLM.from_pretrained(tempdir, load_in_low_bit="sym_int8",
+                                                     torch_dtype=torch.float32,
+                                                     speculative=True)
+
+    with torch.inference_mode():
+        expected = []
+        for prompt in prompts:
+            output = model.generate(torch.tensor([prompt]), do_sample=False, max_new_tokens=16,
+                                    eos_token_id=-1)
+            expected.append(output[0, len(prompt):].tolist())
+
+        # left padding
+        max_len = max(len(prompt) for prompt in prompts)
+        input_ids = torch.tensor([[0] * (max_len - len(prompt)) + prompt for prompt in prompts])
+        attention_mask = torch.tensor([[0] * (max_len - len(prompt)) + [1] * len(prompt)
+                                       for prompt in prompts])
+        output = model.generate(input_ids, attention_mask=attention_mask, do_sample=False,
+                                max_new_tokens=16, eos_token_id=-1)
+
+    for i in range(len(prompts)):
+        assert output[i, max_len:].tolist() == expected[i]
+
+    model.release_past_key_values_storage()
+    assert model._past_key_values_storage_buffer is None
+
+
 if __name__ == '__main__':
     pytest.main([__file__])
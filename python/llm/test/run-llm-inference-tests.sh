@@ -17,6 +17,10 @@ fi
 export OMP_NUM_THREADS=$THREAD_NUM
 python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_transformers_api.py -v
 python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_optimize_model_api.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_gguf_blocks.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_cpu_quant_kv.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_kv_rollback.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_speculative_tree.py -v
 
 now=$(date "+%s")
 time=$((now-start))